@@ -95,4 +95,20 @@ module Transform
     
     funcdef convert(ConvertParameters args) returns (list<string> result);
 
+
+    /*
+       Bulk variants of upload, download and convert:
+
+       These methods take a list of job parameters, validate all of them
+       before any job is started, and return the result of each job in the
+       order given.  Identical parameters start a single job whose result is
+       returned for each of them.
+    */
+
+    funcdef upload_bulk(list<UploadParameters> args) returns (list<list<string>> results);
+
+    funcdef download_bulk(list<DownloadParameters> args) returns (list<list<string>> results);
+
+    funcdef convert_bulk(list<ConvertParameters> args) returns (list<list<string>> results);
+
 };
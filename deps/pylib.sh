@@ -1 +1,2 @@
 pip install requests_toolbelt filemagic ftputil
+pip install backports.lzma zstandard lz4
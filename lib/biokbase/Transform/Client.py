@@ -189,3 +189,18 @@ class Transform(object):
         resp = self._call('Transform.convert',
                           [args])
         return resp[0]
+
+    def upload_bulk(self, args):
+        resp = self._call('Transform.upload_bulk',
+                          [args])
+        return resp[0]
+
+    def download_bulk(self, args):
+        resp = self._call('Transform.download_bulk',
+                          [args])
+        return resp[0]
+
+    def convert_bulk(self, args):
+        resp = self._call('Transform.convert_bulk',
+                          [args])
+        return resp[0]
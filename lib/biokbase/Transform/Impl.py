@@ -5,12 +5,19 @@ import time
 import logging
 import logging.handlers
 import base64
+import collections
+import multiprocessing.pool
 
 #import pymemcache.client
 import simplejson
 
 from biokbase.workflow.KBW import run_async
 import biokbase.Transform.handler_utils as handler_utils
+import biokbase.Transform.script_utils as script_utils
+import biokbase.Transform.job_cache as job_cache
+
+# most jobs of a bulk request submitted at the same time
+BULK_SUBMIT_THREADS = 8
 
 #END_HEADER
 
@@ -56,7 +63,7 @@ type but different versions.
     #        raise
 
 
-    def _run_job(self, method, ctx, args):
+    def _prepare_job(self, method, args, job_details=None):
         if "optional_arguments" not in args:
             args["optional_arguments"] = dict()
         
@@ -71,13 +78,222 @@ type but different versions.
         #memcacheClient = self._get_memcache_client()
 
         # filter the config information for this request so that the script arguments are proper
-        args["job_details"] = self.pluginManager.get_job_details(method, args)
+        if job_details is None:
+            job_details = self.pluginManager.get_job_details(method, args)
+
+        args["job_details"] = job_details
 
         for x in args:
             if type(args[x]) == type(dict()):
                 args[x] = base64.urlsafe_b64encode(simplejson.dumps(args[x]))
         
-        return run_async(self.config, ctx, args)
+        return args
+
+
+    def _input_size(self, method, ctx, args):
+        """
+        Return a function that looks up the size of the input of a job, for
+        costing chains of plugins only when the planner has a choice of them.
+        """
+
+        def size():
+            if method == "upload":
+                return script_utils.get_urls_size(self.logger, args.get("url_mapping", dict()),
+                                                  token=ctx["token"])
+            elif method == "download":
+                return handler_utils.get_object_size(self.logger, self.config["workspace_service_url"], ctx["token"],
+                                                     args.get("workspace_name"), args.get("object_name"),
+                                                     args.get("object_id"))
+            else:
+                return handler_utils.get_object_size(self.logger, self.config["workspace_service_url"], ctx["token"],
+                                                     args.get("source_workspace_name"), args.get("source_object_name"),
+                                                     args.get("source_object_id"))
+
+        return size
+
+
+    def _job_key(self, method, ctx, args, job_details):
+        """
+        Return the cache key of a job and the hash of its plugins, or
+        (None, None) if the job can not be reused or its input can not be
+        identified.
+        """
+
+        if not job_cache.cacheable(method, job_details):
+            return None, None
+
+        try:
+            identity = job_cache.input_identity(method, args, self.config, ctx["token"])
+
+            if identity is None:
+                return None, None
+
+            plugins = job_cache.plugin_hash(job_details)
+
+            return job_cache.make_key(method, self._job_types(method, args), plugins,
+                                      args.get("optional_arguments"), identity), plugins
+        except Exception, e:
+            self.logger.warning("Unable to identify the input of a {0} job : {1}".format(method, e))
+            return None, None
+
+
+    def _cached_job(self, method, ctx, args, key):
+        """
+        Answer a job from the cache if an identical job has run, returning
+        its job ids or None if the job needs to be run.  A job that is still
+        running is only shared with the user that started it, for the same
+        destination.
+        """
+
+        entry = self.job_cache.lookup(key)
+
+        if entry is None:
+            return None
+
+        owner = entry["user_id"] == ctx["user_id"]
+
+        try:
+            results = entry["result"]
+
+            if results is None:
+                # only works for another user if the job has been shared with them
+                from biokbase.userandjobstate.client import UserAndJobState
+
+                ujs = UserAndJobState(url=self.config["ujs_service_url"], token=ctx["token"])
+
+                # last update, stage, status, progress, estimated completion, complete, error
+                status = ujs.get_job_status(entry["ujs_id"])
+
+                if status[6]:
+                    self.job_cache.forget(key)
+                    return None
+
+                if not status[5]:
+                    if not owner or entry["destination"] != job_cache.destination(method, args):
+                        return None
+
+                    self.logger.info("Sharing running {0} job {1}".format(method, entry["ujs_id"]))
+                    return [entry["awe_id"], entry["ujs_id"]]
+
+                results = ujs.get_results(entry["ujs_id"])
+                self.job_cache.resolve(key, results)
+
+            results = job_cache.clone_results(method, args, results, owner, self.config, ctx["token"])
+
+            ujs_job_id = job_cache.complete_job(self.config["ujs_service_url"], ctx["token"],
+                                                "Transform {0} of {1} to {2}".format(method, *self._job_types(method, args)),
+                                                results)
+
+            self.logger.info("Answered {0} job {1} from job {2}".format(method, ujs_job_id, entry["ujs_id"]))
+
+            # the AWE job is the one that made the result, so debugging the job shows how it was made
+            return [entry["awe_id"], ujs_job_id]
+        except Exception, e:
+            self.logger.warning("Unable to reuse {0} job {1}, running it again : {2}".format(method, entry["ujs_id"], e))
+            self.job_cache.forget(key)
+            return None
+
+
+    def _submit(self, method, ctx, args, job_details=None):
+        """
+        Start a job, or answer it from the job cache if one is configured.
+        """
+
+        if job_details is None:
+            job_details = self.pluginManager.get_job_details(method, args, self._input_size(method, ctx, args))
+
+        key = None
+
+        if self.job_cache is not None:
+            key, plugins = self._job_key(method, ctx, args, job_details)
+
+            if key is not None:
+                job_ids = self._cached_job(method, ctx, args, key)
+
+                if job_ids is not None:
+                    return job_ids
+
+            types = self._job_types(method, args)
+            destination = job_cache.destination(method, args)
+
+        job_ids = run_async(self.config, ctx, self._prepare_job(method, args, job_details))
+
+        if key is not None:
+            try:
+                self.job_cache.record(key, method, types, plugins, ctx["user_id"], job_ids, destination)
+            except Exception, e:
+                self.logger.warning("Unable to record {0} job {1} in the job cache : {2}".format(method, job_ids[1], e))
+
+        return job_ids
+
+
+    def _run_job(self, method, ctx, args):
+        return self._submit(method, ctx, args)
+
+
+    def _job_types(self, method, args):
+        # the fields that get_job_details plans a job from
+        if method == "upload":
+            return (args.get("external_type"), args.get("kbase_type"))
+        elif method == "download":
+            return (args.get("kbase_type"), args.get("external_type"))
+        else:
+            return (args.get("source_kbase_type"), args.get("destination_kbase_type"))
+
+
+    def _run_jobs(self, method, ctx, args_list):
+        """
+        Start a list of jobs and return their results in order.  Every job is
+        checked before any is started, the plugins for each pair of types are
+        looked up once, for the size of the first job with those types, and
+        identical jobs are started once.  Jobs already
+        started are left running if a later one fails to start.
+        """
+
+        keys = [simplejson.dumps(x, sort_keys=True) for x in args_list]
+
+        unique = collections.OrderedDict()
+        for k, args in zip(keys, args_list):
+            unique.setdefault(k, args)
+
+        job_details = dict()
+        prepared = collections.OrderedDict()
+        errors = list()
+
+        for k, args in unique.items():
+            types = self._job_types(method, args)
+
+            try:
+                if types not in job_details:
+                    job_details[types] = self.pluginManager.get_job_details(method, args,
+                                                                            self._input_size(method, ctx, args))
+
+                # checks the arguments the same way starting the job will
+                self._prepare_job(method, simplejson.loads(k), job_details[types])
+                prepared[k] = (dict(args), job_details[types])
+            except KeyError, e:
+                errors.append("job {0:d} : missing {1}".format(keys.index(k), e))
+            except Exception, e:
+                errors.append("job {0:d} : {1}".format(keys.index(k), e))
+
+        if len(errors) > 0:
+            raise Exception("Invalid {0} jobs, none were started\n{1}".format(method, "\n".join(errors)))
+
+        if len(prepared) == 0:
+            return list()
+
+        self.logger.info("Starting {0:d} {1} jobs for {2:d} requests".format(len(prepared), method, len(keys)))
+
+        pool = multiprocessing.pool.ThreadPool(min(BULK_SUBMIT_THREADS, len(prepared)))
+        try:
+            results = dict(zip(prepared.keys(),
+                               pool.map(lambda x: self._submit(method, ctx, *x), prepared.values())))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return [results[k] for k in keys]
 
     #END_CLASS_HEADER
 
@@ -121,8 +337,17 @@ type but different versions.
         self.logger.debug("plugins directory : {0}".format(pluginsDir))
         self.logger.debug(config)
                 
-        # read in the plugin configs and later filter them appropriately per request in _run_job()
-        self.pluginManager = handler_utils.PluginManager(pluginsDir, logger=self.logger)
+        # read in the plugin configs and later filter them appropriately per request in _run_job(),
+        # picking up plugins that are added or changed while the service is running
+        # chains of plugins are costed from the job metrics that workers append to
+        self.pluginManager = handler_utils.PluginManager(pluginsDir, logger=self.logger, watch=True,
+                                                         metrics_file=self.config.get('job_metrics_file'))
+
+        # results of earlier jobs that identical jobs are answered from, if configured
+        self.job_cache = None
+
+        if self.config.get('job_cache_file'):
+            self.job_cache = job_cache.JobCache(self.config['job_cache_file'], logger=self.logger)
         
         #END_CONSTRUCTOR
         pass
@@ -203,3 +428,48 @@ type but different versions.
                              'result is not type list as required.')
         # return the results
         return [result]
+
+    def upload_bulk(self, ctx, args):
+        # ctx is the context object
+        # return variables are: results
+        #BEGIN upload_bulk
+        self.logger.debug("Calling upload_bulk")
+        results = self._run_jobs("upload", ctx, args)
+        #END upload_bulk
+
+        # At some point might do deeper type checking...
+        if not isinstance(results, list):
+            raise ValueError('Method upload_bulk return value ' +
+                             'results is not type list as required.')
+        # return the results
+        return [results]
+
+    def download_bulk(self, ctx, args):
+        # ctx is the context object
+        # return variables are: results
+        #BEGIN download_bulk
+        self.logger.debug("Calling download_bulk")
+        results = self._run_jobs("download", ctx, args)
+        #END download_bulk
+
+        # At some point might do deeper type checking...
+        if not isinstance(results, list):
+            raise ValueError('Method download_bulk return value ' +
+                             'results is not type list as required.')
+        # return the results
+        return [results]
+
+    def convert_bulk(self, ctx, args):
+        # ctx is the context object
+        # return variables are: results
+        #BEGIN convert_bulk
+        self.logger.debug("Calling convert_bulk")
+        results = self._run_jobs("convert", ctx, args)
+        #END convert_bulk
+
+        # At some point might do deeper type checking...
+        if not isinstance(results, list):
+            raise ValueError('Method convert_bulk return value ' +
+                             'results is not type list as required.')
+        # return the results
+        return [results]
@@ -284,6 +284,18 @@ class Application(object):
                              name='Transform.convert',
                              types=[dict])
         self.method_authentication['Transform.convert'] = 'required'
+        self.rpc_service.add(impl_Transform.upload_bulk,
+                             name='Transform.upload_bulk',
+                             types=[list])
+        self.method_authentication['Transform.upload_bulk'] = 'required'
+        self.rpc_service.add(impl_Transform.download_bulk,
+                             name='Transform.download_bulk',
+                             types=[list])
+        self.method_authentication['Transform.download_bulk'] = 'required'
+        self.rpc_service.add(impl_Transform.convert_bulk,
+                             name='Transform.convert_bulk',
+                             types=[list])
+        self.method_authentication['Transform.convert_bulk'] = 'required'
         self.auth_client = biokbase.nexus.Client(
             config={'server': 'nexus.api.globusonline.org',
                     'verify_ssl': True,
@@ -0,0 +1,345 @@
+"""
+Provides a zip archive writer that compresses members on all available cores.
+
+Members are cut into chunks that are deflated independently by a pool of
+threads, each chunk ending on a byte boundary with a sync flush, so that the
+compressed chunks can be joined back into one deflate stream in order.  The
+archive is written strictly front to back with data descriptors and zip64
+records, which means it can be written to a pipe or socket as well as a file,
+and members or archives larger than 4 GB need no special handling.  Members
+that are already compressed are stored as they are.
+"""
+
+import os
+import io
+import time
+import zlib
+import struct
+import collections
+import multiprocessing.pool
+
+from biokbase.Transform import compression_utils
+
+
+DEFAULT_CHUNK_SIZE = 2**20
+DEFAULT_LEVEL = 6
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# extensions of formats that do not shrink when deflated again, in addition
+# to the compressed formats recognized from the leading bytes of a member
+COMPRESSED_EXTENSIONS = [".gz", ".tgz", ".bz2", ".tbz2", ".xz", ".txz", ".zst",
+                         ".lz4", ".zip", ".bam", ".cram", ".sra", ".7z",
+                         ".png", ".jpg", ".jpeg", ".gif"]
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_VERSION = 45
+ZIP_VERSION = 20
+UNIX_SYSTEM = 3
+
+DATA_DESCRIPTOR_FLAG = 0x08
+UTF8_FLAG = 0x800
+
+LOCAL_HEADER = struct.Struct("<4sHHHHHLLLHH")
+CENTRAL_HEADER = struct.Struct("<4sBBBBHHHHLLLHHHHHLL")
+DATA_DESCRIPTOR = struct.Struct("<4sLLL")
+DATA_DESCRIPTOR_64 = struct.Struct("<4sLQQ")
+ZIP64_EXTRA = struct.Struct("<HHQQ")
+END_OF_CENTRAL_DIRECTORY = struct.Struct("<4sHHHHLLH")
+ZIP64_END_OF_CENTRAL_DIRECTORY = struct.Struct("<4sQHHLLQQQQ")
+ZIP64_LOCATOR = struct.Struct("<4sLQL")
+
+
+def is_compressed(filePath=None, header=None):
+    """
+    Check whether a member is already compressed, from its extension or from
+    the leading bytes of its contents.
+    """
+
+    if os.path.splitext(filePath)[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+
+    return compression_utils.sniff_format(header) in compression_utils.COMPRESSED_FORMATS + ["zip", "document"]
+
+
+def _dos_time(mtime):
+    t = time.localtime(mtime)
+
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def _compress_chunk(data, method, level, last):
+    """
+    Deflate one chunk of a member as part of a raw deflate stream, ending with
+    the final block for the last chunk and a sync flush otherwise.
+    """
+
+    if method == ZIP_STORED:
+        return data
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    if last:
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH)
+
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class _Member(object):
+
+    def __init__(self, filePath, arcname):
+        info = os.stat(filePath)
+
+        if isinstance(arcname, unicode):
+            self.name = arcname.encode("utf-8")
+            self.flags = DATA_DESCRIPTOR_FLAG | UTF8_FLAG
+        else:
+            self.name = arcname
+            self.flags = DATA_DESCRIPTOR_FLAG
+
+            try:
+                arcname.decode("ascii")
+            except UnicodeDecodeError:
+                self.flags |= UTF8_FLAG
+
+        self.path = filePath
+        self.size = info.st_size
+        self.mode = info.st_mode
+        self.time, self.date = _dos_time(info.st_mtime)
+
+        # sizes are only known after the data, so a member that may not fit
+        # the 32 bit fields carries zip64 sizes from the start
+        self.zip64 = self.size >= ZIP64_LIMIT - 2**20
+
+        self.method = ZIP_DEFLATED
+        self.offset = 0
+        self.crc = 0
+        self.compressed_size = 0
+        self.file_size = 0
+
+
+class ZipWriter(object):
+    """
+    Write a zip archive to a file object in a single pass, with members
+    compressed in parallel by a pool of threads.  The file object only needs
+    a write method.
+    """
+
+    def __init__(self, fileobj = None,
+                 threads = None,
+                 chunk_size = DEFAULT_CHUNK_SIZE,
+                 level = DEFAULT_LEVEL,
+                 logger = None):
+        if fileobj is None:
+            raise Exception("Must provide a file object to write the archive to!")
+
+        if threads is None:
+            threads = compression_utils.default_threads()
+
+        self.fileobj = fileobj
+        self.threads = max(threads, 1)
+        self.chunk_size = chunk_size
+        self.level = level
+        self.logger = logger
+
+        self.offset = 0
+        self.members = list()
+
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+
+    def _chunks(self, members):
+        """
+        Yield (member, data, first, last) for every chunk of every member,
+        choosing the compression method of a member from its first chunk.
+        """
+
+        for member in members:
+            with io.open(member.path, 'rb') as f:
+                data = f.read(self.chunk_size)
+
+                if is_compressed(member.path, data[:compression_utils.SNIFF_SIZE]):
+                    member.method = ZIP_STORED
+
+                first = True
+                while 1:
+                    next_data = f.read(self.chunk_size)
+
+                    yield member, data, first, not next_data
+
+                    if not next_data:
+                        break
+
+                    data = next_data
+                    first = False
+
+
+    def _write_local_header(self, member):
+        member.offset = self.offset
+
+        if member.zip64:
+            extra = ZIP64_EXTRA.pack(0x0001, 16, 0, 0)
+            sizes = ZIP64_LIMIT
+        else:
+            extra = ""
+            sizes = 0
+
+        self._write(LOCAL_HEADER.pack("PK\x03\x04", ZIP64_VERSION if member.zip64 else ZIP_VERSION,
+                                      member.flags, member.method, member.time, member.date,
+                                      0, sizes, sizes, len(member.name), len(extra)))
+        self._write(member.name)
+        self._write(extra)
+
+
+    def _write_data_descriptor(self, member):
+        member.crc &= 0xFFFFFFFF
+
+        if member.zip64:
+            self._write(DATA_DESCRIPTOR_64.pack("PK\x07\x08", member.crc,
+                                                member.compressed_size, member.file_size))
+        else:
+            self._write(DATA_DESCRIPTOR.pack("PK\x07\x08", member.crc,
+                                             member.compressed_size, member.file_size))
+
+        self.members.append(member)
+
+
+    def _emit(self, member, data, first, last, compressed):
+        if first:
+            self._write_local_header(member)
+
+        member.crc = zlib.crc32(data, member.crc)
+        member.file_size += len(data)
+        member.compressed_size += len(compressed)
+        self._write(compressed)
+
+        if last:
+            self._write_data_descriptor(member)
+
+            if self.logger is not None:
+                self.logger.debug("Added {0} to the archive".format(member.name))
+
+
+    def add_files(self, files=None):
+        """
+        Add a list of (filePath, arcname) pairs to the archive, keeping a
+        bounded number of chunks in flight so memory use does not depend on
+        the size of the members.
+        """
+
+        members = [_Member(filePath, arcname) for filePath, arcname in files]
+        window = 2 * self.threads
+
+        pool = multiprocessing.pool.ThreadPool(self.threads)
+        try:
+            pending = collections.deque()
+
+            for member, data, first, last in self._chunks(members):
+                pending.append((member, data, first, last,
+                                pool.apply_async(_compress_chunk, (data, member.method, self.level, last))))
+
+                while len(pending) >= window:
+                    x = pending.popleft()
+                    self._emit(*(x[:4] + (x[4].get(),)))
+
+            while len(pending) > 0:
+                x = pending.popleft()
+                self._emit(*(x[:4] + (x[4].get(),)))
+
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def close(self):
+        """
+        Write the central directory and the end records.  The file object is
+        left open.
+        """
+
+        start = self.offset
+
+        for member in self.members:
+            fields = list()
+
+            if member.file_size >= ZIP64_LIMIT:
+                fields.append(member.file_size)
+
+            if member.compressed_size >= ZIP64_LIMIT:
+                fields.append(member.compressed_size)
+
+            if member.offset >= ZIP64_LIMIT:
+                fields.append(member.offset)
+
+            if len(fields) > 0:
+                extra = struct.pack("<HH" + "Q" * len(fields), 0x0001, 8 * len(fields), *fields)
+                version = ZIP64_VERSION
+            else:
+                extra = ""
+                version = ZIP64_VERSION if member.zip64 else ZIP_VERSION
+
+            self._write(CENTRAL_HEADER.pack("PK\x01\x02", ZIP64_VERSION, UNIX_SYSTEM, version, 0,
+                                            member.flags, member.method, member.time, member.date,
+                                            member.crc,
+                                            min(member.compressed_size, ZIP64_LIMIT),
+                                            min(member.file_size, ZIP64_LIMIT),
+                                            len(member.name), len(extra), 0, 0, 0,
+                                            (member.mode & 0xFFFF) << 16,
+                                            min(member.offset, ZIP64_LIMIT)))
+            self._write(member.name)
+            self._write(extra)
+
+        size = self.offset - start
+        count = len(self.members)
+
+        if count >= 0xFFFF or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            end64 = self.offset
+            self._write(ZIP64_END_OF_CENTRAL_DIRECTORY.pack("PK\x06\x06", 44, ZIP64_VERSION, ZIP64_VERSION,
+                                                            0, 0, count, count, size, start))
+            self._write(ZIP64_LOCATOR.pack("PK\x06\x07", 0, end64, 1))
+
+        self._write(END_OF_CENTRAL_DIRECTORY.pack("PK\x05\x06", 0, 0,
+                                                  min(count, 0xFFFF), min(count, 0xFFFF),
+                                                  min(size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0))
+
+
+def write_zip(logger = None,
+              fileobj = None,
+              files = None,
+              threads = None,
+              chunk_size = DEFAULT_CHUNK_SIZE,
+              level = DEFAULT_LEVEL):
+    """
+    Write a zip archive of a list of (filePath, arcname) pairs to a writable
+    file object in a single pass.  Returns the number of bytes written.
+    """
+
+    writer = ZipWriter(fileobj, threads, chunk_size, level, logger)
+    writer.add_files(files)
+    writer.close()
+
+    return writer.offset
+
+
+def create_zip(logger = None,
+               archive_name = None,
+               files = None,
+               threads = None,
+               chunk_size = DEFAULT_CHUNK_SIZE,
+               level = DEFAULT_LEVEL):
+    """
+    Write a zip archive of a list of (filePath, arcname) pairs to archive_name.
+    Returns the size of the archive.
+    """
+
+    with io.open(archive_name, 'wb') as f:
+        return write_zip(logger, f, files, threads, chunk_size, level)
@@ -0,0 +1,704 @@
+"""
+Provides format detection from the leading bytes of a file, and decompression
+streams that make use of all available cores where the compressed format
+allows it, falling back to sequential decoding otherwise.
+
+Every stream returned from open_decompressed() is a read-only file object, so
+callers can copy it to disk in chunks or hand it to tarfile in stream mode.
+Input that is truncated or corrupt raises an exception saying so instead of
+ending the stream early.
+"""
+
+import os
+import io
+import bz2
+import gzip
+import zlib
+import struct
+import tarfile
+import tempfile
+import subprocess
+import collections
+import multiprocessing
+import multiprocessing.pool
+import distutils.spawn
+
+# optional in-process decoders, the command line tools are used without them
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# external tools that decode a single compressed stream on multiple cores,
+# in order of preference
+PARALLEL_BZIP2_TOOLS = ["lbzip2", "pbzip2"]
+PARALLEL_GZIP_TOOLS = ["pigz"]
+XZ_TOOLS = ["xz"]
+ZSTD_TOOLS = ["zstd"]
+LZ4_TOOLS = ["lz4"]
+
+GZIP_MAGIC = "\x1f\x8b"
+BGZF_HEADER_SIZE = 18
+
+# leading bytes of each format, tar is recognized from its header checksum
+SIGNATURES = [("gzip", GZIP_MAGIC),
+              ("bzip2", "BZh"),
+              ("xz", "\xfd7zXZ\x00"),
+              ("zstd", "\x28\xb5\x2f\xfd"),
+              ("lz4", "\x04\x22\x4d\x18"),
+              ("zip", "PK\x03\x04"),
+              ("zip", "PK\x05\x06"),
+              ("zip", "PK\x07\x08")]
+
+COMPRESSED_FORMATS = ["gzip", "bzip2", "xz", "zstd", "lz4"]
+
+# zip based document formats, such as spreadsheets, are reported as "document"
+# so they are never unpacked, recognized from the name of their first member
+# or from the file extension
+DOCUMENT_MEMBERS = ["[Content_Types].xml", "mimetype", "META-INF/", "META-INF/MANIFEST.MF"]
+DOCUMENT_EXTENSIONS = [".xlsx", ".xlsm", ".docx", ".pptx", ".ods", ".odt", ".odp", ".jar"]
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s22xH2x")
+
+ZSTD_MAGIC = 0xFD2FB528
+
+# skippable zstd frames carry any magic number in this range
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+ZSTD_SKIPPABLE_MASK = 0xFFFFFFF0
+
+SNIFF_SIZE = tarfile.BLOCKSIZE
+
+
+def default_threads():
+    """
+    Number of decompression threads to use when none is given.
+    """
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def find_tool(names=None):
+    """
+    Return the path of the first executable found on PATH from a list of names.
+    """
+
+    for name in names:
+        path = distutils.spawn.find_executable(name)
+
+        if path is not None:
+            return path
+
+    return None
+
+
+def is_tar_header(block=None):
+    """
+    Check whether a block of bytes is a valid tar header, which allows us to
+    recognize a tar stream without writing it to disk first.
+    """
+
+    if block is None or len(block) < tarfile.BLOCKSIZE:
+        return False
+
+    if block[257:262] == "ustar":
+        return True
+
+    try:
+        return tarfile.nti(block[148:156]) in tarfile.calc_chksums(block)
+    except Exception:
+        return False
+
+
+def is_zip_document(header=None):
+    """
+    Check whether the first local header of a zip file names a member that
+    marks an OOXML, ODF or jar container rather than an archive.
+    """
+
+    if header is None or len(header) < ZIP_LOCAL_HEADER.size:
+        return False
+
+    signature, name_length = ZIP_LOCAL_HEADER.unpack(header[:ZIP_LOCAL_HEADER.size])
+
+    if signature != "PK\x03\x04":
+        return False
+
+    name = header[ZIP_LOCAL_HEADER.size:ZIP_LOCAL_HEADER.size + name_length]
+
+    return name in DOCUMENT_MEMBERS
+
+
+def sniff_format(header=None):
+    """
+    Identify a format from the first SNIFF_SIZE bytes of a file or stream.
+    Returns one of COMPRESSED_FORMATS, "zip", "document", "tar" or None.
+    """
+
+    if not header:
+        return None
+
+    for name, signature in SIGNATURES:
+        if header.startswith(signature):
+            if name == "zip" and is_zip_document(header):
+                return "document"
+
+            return name
+
+    if is_tar_header(header[:tarfile.BLOCKSIZE]):
+        return "tar"
+
+    return None
+
+
+def detect_format(filePath=None):
+    """
+    Identify the format of a file from its leading bytes, see sniff_format().
+    """
+
+    with io.open(filePath, 'rb') as f:
+        dataFormat = sniff_format(f.read(SNIFF_SIZE))
+
+    if dataFormat == "zip" and os.path.splitext(filePath)[1].lower() in DOCUMENT_EXTENSIONS:
+        return "document"
+
+    return dataFormat
+
+
+def is_bgzf(header=None):
+    """
+    Check whether the first bytes of a gzip file carry the BGZF block size
+    extra field, which lets us find every member without decompressing.
+    """
+
+    if header is None or len(header) < BGZF_HEADER_SIZE:
+        return False
+
+    if header[:2] != GZIP_MAGIC or ord(header[2]) != 8 or not ord(header[3]) & 4:
+        return False
+
+    xlen = struct.unpack("<H", header[10:12])[0]
+
+    return xlen >= 6 and header[12:14] == "BC" and struct.unpack("<H", header[14:16])[0] == 2
+
+
+def open_decompressed(filePath=None, compression=None, threads=None, logger=None):
+    """
+    Open a compressed file and return a readable stream of its decompressed
+    contents.
+
+    BGZF gzip files are inflated block by block on a pool of threads, bzip2
+    files are handed to lbzip2 or pbzip2 when installed, plain gzip files use
+    pigz when installed, and xz files use a multi-threaded xz when installed.
+    Everything else is decoded sequentially, in process when the lzma,
+    zstandard or lz4 module is available and with the command line tool
+    otherwise.
+    """
+
+    if filePath is None:
+        raise Exception("No file given to decompress!")
+
+    if threads is None:
+        threads = default_threads()
+
+    if compression == "gzip":
+        with io.open(filePath, 'rb') as f:
+            header = f.read(BGZF_HEADER_SIZE)
+
+        if threads > 1 and is_bgzf(header):
+            if logger is not None:
+                logger.info("Decompressing {0} as BGZF using {1:d} threads".format(filePath, threads))
+
+            return BGZFReader(filePath, threads)
+
+        tool = find_tool(PARALLEL_GZIP_TOOLS)
+
+        if threads > 1 and tool is not None:
+            if logger is not None:
+                logger.info("Decompressing {0} with {1}".format(filePath, tool))
+
+            return ProcessReader([tool, "-dc", "-p", str(threads), filePath])
+
+        return GzipReader(filePath)
+    elif compression == "bzip2":
+        tool = find_tool(PARALLEL_BZIP2_TOOLS)
+
+        if threads > 1 and tool is not None:
+            if logger is not None:
+                logger.info("Decompressing {0} with {1} using {2:d} threads".format(filePath, tool, threads))
+
+            if os.path.basename(tool) == "lbzip2":
+                return ProcessReader([tool, "-dc", "-n", str(threads), filePath])
+            else:
+                return ProcessReader([tool, "-dc", "-p{0:d}".format(threads), filePath])
+
+        return BZ2StreamReader(filePath)
+    elif compression == "xz":
+        tool = find_tool(XZ_TOOLS)
+
+        if threads > 1 and tool is not None:
+            if logger is not None:
+                logger.info("Decompressing {0} with {1} using {2:d} threads".format(filePath, tool, threads))
+
+            return ProcessReader([tool, "-dc", "-T", str(threads), filePath])
+
+        if lzma is not None:
+            return ConcatenatedStreamReader(filePath, lzma.LZMADecompressor, "xz")
+    elif compression == "zstd":
+        if zstandard is not None:
+            return ZstdReader(filePath)
+
+        tool = find_tool(ZSTD_TOOLS)
+    elif compression == "lz4":
+        if lz4 is not None:
+            return ConcatenatedStreamReader(filePath, lz4.frame.LZ4FrameDecompressor, "lz4")
+
+        tool = find_tool(LZ4_TOOLS)
+    else:
+        raise Exception("Unsupported compression format {0}".format(compression))
+
+    if tool is None:
+        raise Exception("Unable to decompress {0}, no {1} module or command is installed".format(filePath, compression))
+
+    if logger is not None:
+        logger.info("Decompressing {0} with {1}".format(filePath, tool))
+
+    return ProcessReader([tool, "-dc", filePath])
+
+
+class DecompressedStream(object):
+    """
+    Base class for the read-only decompressed streams, which only need to
+    provide _next_chunk() returning decompressed bytes or an empty string at
+    the end of the data.
+    """
+
+    def __init__(self):
+        self._buffer = str()
+        self._eof = False
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _next_chunk(self):
+        raise NotImplementedError()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self._buffer]
+            self._buffer = str()
+
+            while not self._eof:
+                chunk = self._next_chunk()
+
+                if not chunk:
+                    self._eof = True
+                else:
+                    chunks.append(chunk)
+
+            return "".join(chunks)
+
+        chunks = [self._buffer]
+        available = len(self._buffer)
+
+        while available < size and not self._eof:
+            chunk = self._next_chunk()
+
+            if not chunk:
+                self._eof = True
+            else:
+                chunks.append(chunk)
+                available += len(chunk)
+
+        data = "".join(chunks)
+        self._buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.closed = True
+
+
+def corrupt_input(filePath=None, compression=None, reason=None):
+    """
+    Return the exception raised for compressed input that can not be read to
+    the end of its data.
+    """
+
+    return Exception("Truncated or corrupt {0} input {1} : {2}".format(compression, filePath, reason))
+
+
+class GzipReader(DecompressedStream):
+    """
+    Sequential gzip reader, for every member of the file, that reports a
+    truncated or corrupt file instead of the bare error gzip raises.
+    """
+
+    def __init__(self, filePath=None, chunkSize=2**20):
+        super(GzipReader, self).__init__()
+
+        self._filePath = filePath
+        self._chunkSize = chunkSize
+        self._file = gzip.GzipFile(filePath, 'rb')
+
+    def _next_chunk(self):
+        try:
+            return self._file.read(self._chunkSize)
+        except (IOError, EOFError, struct.error, zlib.error), e:
+            # a missing trailer fails to unpack, a short member fails its CRC check
+            raise corrupt_input(self._filePath, "gzip", e)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+
+        super(GzipReader, self).close()
+
+
+def _inflate_bgzf_block(block):
+    """
+    Inflate one complete BGZF member and verify its CRC and length.
+    """
+
+    xlen = struct.unpack("<H", block[10:12])[0]
+    crc, isize = struct.unpack("<II", block[-8:])
+
+    data = zlib.decompress(block[12 + xlen:-8], -zlib.MAX_WBITS)
+
+    if len(data) != isize or zlib.crc32(data) & 0xffffffff != crc:
+        raise Exception("BGZF block failed CRC check")
+
+    return data
+
+
+class BGZFReader(DecompressedStream):
+    """
+    Reads a BGZF file, inflating a bounded window of blocks ahead of the reader
+    on a thread pool.  zlib releases the GIL while inflating, so this scales
+    with the number of threads.
+    """
+
+    def __init__(self, filePath=None, threads=None):
+        super(BGZFReader, self).__init__()
+
+        self._file = io.open(filePath, 'rb')
+        self._pool = multiprocessing.pool.ThreadPool(threads)
+        self._pending = collections.deque()
+        self._window = threads * 4
+        self._exhausted = False
+
+    def _read_block(self):
+        header = self._file.read(BGZF_HEADER_SIZE)
+
+        if not header:
+            return None
+
+        if not is_bgzf(header):
+            raise Exception("Found a gzip member without a BGZF block size")
+
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        remainder = self._file.read(block_size - BGZF_HEADER_SIZE)
+
+        if len(remainder) != block_size - BGZF_HEADER_SIZE:
+            raise Exception("Truncated BGZF block")
+
+        return header + remainder
+
+    def _next_chunk(self):
+        while not self._exhausted and len(self._pending) < self._window:
+            block = self._read_block()
+
+            if block is None:
+                self._exhausted = True
+            else:
+                self._pending.append(self._pool.apply_async(_inflate_bgzf_block, (block,)))
+
+        while self._pending:
+            data = self._pending.popleft().get()
+
+            # skip empty blocks, such as the BGZF end of file marker
+            if data:
+                return data
+
+        return str()
+
+    def close(self):
+        if not self.closed:
+            self._pool.terminate()
+            self._file.close()
+
+        super(BGZFReader, self).close()
+
+
+class ConcatenatedStreamReader(DecompressedStream):
+    """
+    Sequential reader that continues across concatenated compressed streams,
+    such as those written by pbzip2, given a factory for decompressor objects
+    that report leftover input in unused_data.  The file must end where a
+    stream ends.
+    """
+
+    def __init__(self, filePath=None, new_decompressor=None, compression=None, chunkSize=2**20):
+        super(ConcatenatedStreamReader, self).__init__()
+
+        self._filePath = filePath
+        self._compression = compression
+        self._file = io.open(filePath, 'rb')
+        self._chunkSize = chunkSize
+        self._new_decompressor = new_decompressor
+        self._decompressor = new_decompressor()
+        # whether the current decompressor has been given any input
+        self._started = False
+        self._unused = str()
+
+    def _stream_ended(self):
+        if hasattr(self._decompressor, "eof"):
+            return self._decompressor.eof
+
+        # bz2 in Python 2 only says so when given more input
+        try:
+            self._decompressor.decompress(str())
+        except EOFError:
+            return True
+
+        return False
+
+    def _decompress(self, compressed):
+        self._started = True
+
+        try:
+            return self._decompressor.decompress(compressed)
+        except EOFError:
+            raise
+        except Exception, e:
+            raise corrupt_input(self._filePath, self._compression, e)
+
+    def _next_chunk(self):
+        while 1:
+            if self._unused:
+                compressed = self._unused
+                self._unused = str()
+            else:
+                compressed = self._file.read(self._chunkSize)
+
+                if not compressed:
+                    if self._started and not self._stream_ended():
+                        raise corrupt_input(self._filePath, self._compression,
+                                            "the file ends before the end of the stream")
+
+                    return str()
+
+            # the previous stream ended exactly on a read boundary
+            if getattr(self._decompressor, "eof", False):
+                self._decompressor = self._new_decompressor()
+                self._started = False
+
+            try:
+                data = self._decompress(compressed)
+            except EOFError:
+                self._decompressor = self._new_decompressor()
+                data = self._decompress(compressed)
+
+            # the current stream ended, keep the leftover bytes for a new one
+            if self._decompressor.unused_data:
+                self._unused = self._decompressor.unused_data
+                self._decompressor = self._new_decompressor()
+                self._started = False
+
+            if data:
+                return data
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+
+        super(ConcatenatedStreamReader, self).close()
+
+
+class BZ2StreamReader(ConcatenatedStreamReader):
+    """
+    Sequential bzip2 reader that continues across concatenated streams, which
+    bz2.BZ2File stops reading after the first.
+    """
+
+    def __init__(self, filePath=None, chunkSize=2**20):
+        super(BZ2StreamReader, self).__init__(filePath, bz2.BZ2Decompressor, "bzip2", chunkSize)
+
+
+def zstd_frames_complete(filePath=None):
+    """
+    Walk the frame and block headers of a zstd file, without decompressing
+    anything, and return whether it ends exactly where its last frame ends.
+    """
+
+    def read_exactly(f, size):
+        data = f.read(size)
+
+        if len(data) != size:
+            raise EOFError()
+
+        return data
+
+    # block payloads are seeked over, not read, so the data is not read twice
+    def skip(f, size):
+        if f.tell() + size > file_size:
+            raise EOFError()
+
+        f.seek(size, 1)
+
+    with io.open(filePath, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+
+        try:
+            while 1:
+                magic = f.read(4)
+
+                if not magic:
+                    return True
+                elif len(magic) != 4:
+                    return False
+
+                magic = struct.unpack("<I", magic)[0]
+
+                if magic & ZSTD_SKIPPABLE_MASK == ZSTD_SKIPPABLE_MAGIC:
+                    size = struct.unpack("<I", read_exactly(f, 4))[0]
+                    skip(f, size)
+                    continue
+                elif magic != ZSTD_MAGIC:
+                    return False
+
+                descriptor = ord(read_exactly(f, 1))
+                single_segment = descriptor & 0x20
+                checksum = descriptor & 0x04
+                content_size_bytes = [1 if single_segment else 0, 2, 4, 8][descriptor >> 6]
+                dictionary_bytes = [0, 1, 2, 4][descriptor & 0x03]
+
+                skip(f, (0 if single_segment else 1) + dictionary_bytes + content_size_bytes)
+
+                while 1:
+                    header = read_exactly(f, 3)
+                    header = ord(header[0]) | ord(header[1]) << 8 | ord(header[2]) << 16
+
+                    block_type = (header >> 1) & 0x03
+                    block_size = header >> 3
+
+                    if block_type == 3:
+                        return False
+
+                    # an RLE block holds the one byte that is repeated
+                    skip(f, 1 if block_type == 1 else block_size)
+
+                    if header & 0x01:
+                        break
+
+                if checksum:
+                    skip(f, 4)
+
+                if f.tell() == file_size:
+                    return True
+        except EOFError:
+            return False
+
+
+class ZstdReader(DecompressedStream):
+    """
+    Reads every frame of a zstd file with the zstandard module.  The module
+    ends the stream quietly at a truncated frame, so the frame headers are
+    checked once the data runs out.
+    """
+
+    def __init__(self, filePath=None, chunkSize=2**20):
+        super(ZstdReader, self).__init__()
+
+        self._filePath = filePath
+        self._file = io.open(filePath, 'rb')
+        self._chunkSize = chunkSize
+
+        try:
+            self._reader = zstandard.ZstdDecompressor().stream_reader(self._file, read_across_frames=True)
+        except TypeError:
+            # older zstandard releases do not take read_across_frames
+            self._reader = zstandard.ZstdDecompressor().stream_reader(self._file)
+
+    def _next_chunk(self):
+        try:
+            data = self._reader.read(self._chunkSize)
+        except zstandard.ZstdError, e:
+            raise corrupt_input(self._filePath, "zstd", e)
+
+        if not data and not zstd_frames_complete(self._filePath):
+            raise corrupt_input(self._filePath, "zstd", "the file ends inside a frame")
+
+        return data
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+
+        super(ZstdReader, self).close()
+
+
+class ProcessReader(DecompressedStream):
+    """
+    Reads the stdout of an external decompression tool, raising an exception
+    at the end of the stream if the tool exited with an error.
+    """
+
+    def __init__(self, command_list=None, chunkSize=2**20):
+        super(ProcessReader, self).__init__()
+
+        self._command_list = command_list
+        self._chunkSize = chunkSize
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=self._stderr)
+
+    def _next_chunk(self):
+        data = self._process.stdout.read(self._chunkSize)
+
+        if not data:
+            self._check_exit()
+
+        return data
+
+    def _check_exit(self):
+        if self._process.wait() != 0:
+            self._stderr.seek(0)
+            stderr = self._stderr.read()
+
+            raise Exception("{0} exited with code {1:d} : {2}".format(self._command_list[0],
+                                                                     self._process.returncode,
+                                                                     stderr))
+
+    def close(self):
+        if not self.closed:
+            if self._process.poll() is None:
+                if self._eof:
+                    self._check_exit()
+                else:
+                    self._process.kill()
+                    self._process.wait()
+
+            self._process.stdout.close()
+            self._stderr.close()
+
+        super(ProcessReader, self).close()
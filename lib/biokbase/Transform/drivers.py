@@ -14,6 +14,12 @@ import json
 import pprint
 import subprocess
 import base64
+import socket
+import signal
+import threading
+import collections
+import multiprocessing
+import tempfile
 
 # patch for handling unverified certificates
 import ssl
@@ -32,6 +38,10 @@ try:
     import biokbase.Transform.Client
     import biokbase.Transform.script_utils as script_utils
     import biokbase.Transform.handler_utils as handler_utils
+    import biokbase.Transform.shock_upload as shock_upload
+    import biokbase.Transform.transport as transport
+    import biokbase.Transform.worker_pool as worker_pool
+    import biokbase.Transform.executor as executor
     import biokbase.userandjobstate.client
     import biokbase.workspace.client
 
@@ -43,6 +53,20 @@ except ImportError, e:
     raise ImportError("Your environment is not setup correctly : {0}".format(e.message))
 
 
+# UJS job stages that end a job
+COMPLETED_STAGES = ["complete", "success"]
+ERROR_STAGES = ["error", "fail"]
+
+# seconds between UJS polls, growing by the backoff factor while no job
+# changes status and starting over from the minimum when one does
+MONITOR_MIN_INTERVAL = 1
+MONITOR_MAX_INTERVAL = 30
+MONITOR_BACKOFF = 1.5
+
+# failed status requests in a row for one job before monitoring gives up
+MONITOR_MAX_ERRORS = 5
+
+
 class TransformDriver(object):
     def __init__(self, service_urls=dict(), logger=None):
         if logger is not None:
@@ -126,6 +150,74 @@ class TransformDriver(object):
                 "client": self.handle_client
             }
         }
+
+
+    def monitor_jobs(self, ujs_job_ids=None, callback=None,
+                     min_interval=MONITOR_MIN_INTERVAL,
+                     max_interval=MONITOR_MAX_INTERVAL,
+                     backoff=MONITOR_BACKOFF,
+                     stop=None):
+        """
+        Poll UJS until every job in ujs_job_ids has completed or failed, with
+        one pass over the unfinished jobs per interval.  The interval grows
+        while no job changes status and is reset when one does.  If given,
+        callback(ujs_job_id, status) is called for every change of stage or
+        status message.  If given, monitoring ends early once the threading
+        Event stop is set.
+
+        Returns a dictionary of ujs_job_id to (success, status) for the jobs
+        that finished.
+        """
+
+        last_status = dict()
+        errors = dict([(x, 0) for x in ujs_job_ids])
+        results = dict()
+
+        interval = min_interval
+        while 1:
+            changed = False
+
+            for ujs_job_id in ujs_job_ids:
+                if ujs_job_id in results:
+                    continue
+
+                try:
+                    status = self.ujs_client.get_job_status(ujs_job_id)
+                    errors[ujs_job_id] = 0
+                except Exception, e:
+                    errors[ujs_job_id] += 1
+
+                    if errors[ujs_job_id] >= MONITOR_MAX_ERRORS:
+                        self.logger.error("Issue connecting to UJS!")
+                        raise
+
+                    self.logger.warning("Unable to get the status of job {0} : {1}".format(ujs_job_id, e))
+                    continue
+
+                if last_status.get(ujs_job_id) != status[1:3]:
+                    last_status[ujs_job_id] = status[1:3]
+                    changed = True
+
+                    if callback is not None:
+                        callback(ujs_job_id, status)
+
+                if status[1] in COMPLETED_STAGES:
+                    results[ujs_job_id] = (True, status)
+                elif status[1] in ERROR_STAGES:
+                    results[ujs_job_id] = (False, status)
+
+            if len(results) == len(ujs_job_ids):
+                return results
+
+            if changed:
+                interval = min_interval
+            else:
+                interval = min(interval * backoff, max_interval)
+
+            if stop is None:
+                time.sleep(interval)
+            elif stop.wait(interval) or stop.is_set():
+                return results
         
         
 
@@ -156,19 +248,23 @@ class TransformClientDriver(TransformDriver):
         header["Authorization"] = "Oauth {0}".format(self.token)
 
         debug_details["awe"] = dict()
+
+        if not awe_job_id:
+            self.logger.warning("No AWE job id for UJS job {0}".format(ujs_job_id))
+            return debug_details
                     
         try:
             # check awe job output
-            awe_details = requests.get("{0}/job/{1}".format(self.awe_service_url,awe_job_id), headers=header, verify=True)
+            awe_details = transport.get("{0}/job/{1}".format(self.awe_service_url,awe_job_id), headers=header, verify=True)
 
             awe_response = awe_details.json()
                     
             debug_details["awe"]["details"] = awe_response["data"]
                 
-            awe_stdout = requests.get("{0}/work/{1}?report=stdout".format(self.awe_service_url,
+            awe_stdout = transport.get("{0}/work/{1}?report=stdout".format(self.awe_service_url,
                                   debug_details["awe"]["details"]["tasks"][0]["taskid"]+"_0"), 
                                   headers=header, verify=True).json()["data"]
-            awe_stderr = requests.get("{0}/work/{1}?report=stderr".format(self.awe_service_url,
+            awe_stderr = transport.get("{0}/work/{1}?report=stderr".format(self.awe_service_url,
                                   debug_details["awe"]["details"]["tasks"][0]["taskid"]+"_0"), 
                                   headers=header, verify=True).json()["data"]
         
@@ -187,37 +283,116 @@ class TransformClientDriver(TransformDriver):
     def monitor_job(self, awe_job_id=None, ujs_job_id=None, 
                     success_message="Job completed!",
                     error_message="Job failed!"):
-        completed = ["complete", "success"]
-        error = ["error", "fail"]
+        def report(job_id, status):
+            self.logger.info("{0} status update: {1}".format(status[0], status[2]))
 
-        header = dict()
-        header["Authorization"] = "Oauth {0}".format(self.token)
-        
-        # wait for UJS to complete    
-        last_status = ""
-        start = datetime.datetime.utcnow()
-        while 1:        
-            try:
-                status = self.ujs_client.get_job_status(ujs_job_id)
-            except Exception, e:
-                self.logger.error("Issue connecting to UJS!")
-                raise
-        
-            if last_status != status[2]:
-                self.logger.info("{0} status update: {1}".format(status[0], status[2]))
-                last_status = status[2]
-            
-            if status[1] in completed:
-                self.logger.info("{0}".format(success_message))
-                return (True, status)
-            elif status[1] in error:
-                self.logger.info("{0}".format(error_message))
-                return (False, status)
+        # wait for UJS to complete, see monitor_jobs
+        success, status = self.monitor_jobs([ujs_job_id], report)[ujs_job_id]
+
+        if success:
+            self.logger.info("{0}".format(success_message))
+        else:
+            self.logger.info("{0}".format(error_message))
+
+        return (success, status)
+
+
+class TransformConcurrentDriver(TransformClientDriver):
+    """
+    Client driver for submitting and tracking many jobs at once.  Every
+    method returns an executor.Future, with at most concurrency calls in
+    flight, and Transform and UJS calls share a pool of keep-alive
+    connections per service.  Futures that have not started can be
+    cancelled, which also stops a running monitor.
+    """
+
+    def __init__(self, service_urls=dict(), logger=None, concurrency=executor.DEFAULT_CONCURRENCY):
+        super(TransformClientDriver, self).__init__(service_urls, logger)
+
+        if concurrency > transport.DEFAULT_POOL_SIZE:
+            transport.configure(pool_size=concurrency)
+
+        self.transform_client = executor.ServiceClient(self.service_urls["transform_service_url"],
+                                                       self.token, "Transform")
+        self.ujs_client = executor.ServiceClient(self.service_urls["ujs_service_url"],
+                                                 self.token, "UserAndJobState",
+                                                 executor.UJS_MULTIPLE_RETURNS)
+
+        self.executor = executor.Executor(concurrency)
+
+
+    def submit_job(self, method=None, arguments=None):
+        """
+        Start an upload, download or convert job, the result is the
+        [awe_job_id, ujs_job_id] pair from the Transform service.
+        """
+
+        if method not in ["upload", "download", "convert"]:
+            raise Exception("Unrecognized method {0}.  Unable to begin.".format(method))
+
+        return self.executor.submit(getattr(self.transform_client, method), (arguments,))
+
+
+    def submit_jobs(self, method=None, arguments_list=None):
+        return [self.submit_job(method, x) for x in arguments_list]
+
+
+    def monitor(self, ujs_job_ids=None, callback=None):
+        """
+        Watch jobs until they finish, see monitor_jobs.  The callback is
+        called from the executor thread.
+        """
+
+        return self.executor.submit(self.monitor_jobs, (ujs_job_ids, callback), stoppable=True)
+
+
+    def fetch_results(self, ujs_job_ids=None):
+        return self.executor.map(self.get_job_results, ujs_job_ids)
+
+
+    def fetch_debug(self, job_ids=None):
+        """
+        Fetch the debug details of a list of (awe_job_id, ujs_job_id) pairs.
+        """
+
+        return self.executor.map(lambda x: self.get_job_debug(*x), job_ids)
+
+
+    def close(self, cancel=False):
+        """
+        Wait for the calls in flight, or cancel them, and stop the executor.
+        """
+
+        self.executor.shutdown(cancel)
+
+
+def _read_tail(filePath=None, max_lines=handler_utils.TASK_OUTPUT_TAIL_LINES):
+    """
+    Read the last max_lines lines of a log file.
+    """
+
+    with open(filePath, 'rb') as f:
+        return "".join(collections.deque(f, maxlen=max_lines))
 
 
 class TransformTaskRunnerDriver(TransformDriver):
+    """
+    Runs taskrunners on this host.  Jobs are queued on an executor that runs
+    up to concurrency taskrunners at a time, and the stdout and stderr of each
+    job are written to log files as it runs, with only the last lines kept in
+    the job results.
+    """
+
+    def __init__(self, service_urls, plugin_directory, logger=None, worker_socket=None,
+                 concurrency=None, log_directory=None):
+        """
+        If worker_socket is given, jobs are sent to the warm worker pool
+        listening on it instead of starting a new taskrunner process.
+
+        concurrency defaults to the number of cores, and job logs are written
+        to a new temporary directory if no log_directory is given.
+        """
 
-    def __init__(self, service_urls, plugin_directory, logger=None):
         if not service_urls:
             raise ValueError("Must provide a dictionary of service urls")
         
@@ -226,7 +401,18 @@ class TransformTaskRunnerDriver(TransformDriver):
         if not plugin_directory or not os.path.exists(plugin_directory):
             raise ValueError("No plugins directory found!")
         
+        if concurrency is None:
+            try:
+                concurrency = multiprocessing.cpu_count()
+            except NotImplementedError:
+                concurrency = 1
+
         self._plugin_dir = plugin_directory
+        self._worker_socket = worker_socket
+        self._concurrency = concurrency
+        self._log_directory = log_directory
+        self._executor = None
+        self._executor_lock = threading.Lock()
         self.load_plugins()
 
 
@@ -245,7 +431,80 @@ class TransformTaskRunnerDriver(TransformDriver):
             directory=plugins, logger=self.logger)
 
 
-    def run_job(self, method, arguments, description=None):
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                if self._log_directory is None:
+                    self._log_directory = tempfile.mkdtemp(prefix="transform_jobs_")
+                elif not os.path.isdir(self._log_directory):
+                    os.makedirs(self._log_directory)
+
+                self._executor = executor.Executor(self._concurrency)
+
+            return self._executor
+
+
+    def _run_taskrunner(self, method, command_list, job, stop=None):
+        """
+        Run a taskrunner with its output written to the log files of the job,
+        terminating it if stop is set.
+        """
+
+        task_output = None
+
+        if self._worker_socket is not None:
+            try:
+                task_output = worker_pool.run_job(self._worker_socket, method, command_list[1:], stop=stop)
+            except socket.error, e:
+                # only raised if the job was never sent, so it is safe to start it here
+                self.logger.warning("Worker pool at {0} is unavailable, starting {1} : {2}".format(
+                    self._worker_socket, command_list[0], e))
+            else:
+                if task_output is None:
+                    self.logger.info("Stopped {0} job {1}".format(method, job["ujs_id"]))
+                    task_output = {"stdout": "", "stderr": "", "exit_code": -signal.SIGTERM}
+
+                with open(job["stdout_file"], 'wb') as f:
+                    f.write(task_output["stdout"])
+
+                with open(job["stderr_file"], 'wb') as f:
+                    f.write(task_output["stderr"])
+
+        if task_output is None:
+            with open(job["stdout_file"], 'wb') as stdout, open(job["stderr_file"], 'wb') as stderr:
+                taskrunner = subprocess.Popen(command_list, stdout=stdout, stderr=stderr)
+
+                while taskrunner.poll() is None:
+                    if stop is not None and stop.wait(0.1):
+                        self.logger.info("Stopping {0} job {1}".format(method, job["ujs_id"]))
+                        taskrunner.terminate()
+                        taskrunner.wait()
+                        break
+
+            task_output = dict()
+            task_output["stdout"] = _read_tail(job["stdout_file"])
+            task_output["stderr"] = _read_tail(job["stderr_file"])
+            task_output["exit_code"] = taskrunner.returncode
+
+        task_output["ujs_id"] = job["ujs_id"]
+        task_output["stdout_file"] = job["stdout_file"]
+        task_output["stderr_file"] = job["stderr_file"]
+
+        if task_output["exit_code"] != 0:
+            return (False, task_output)
+        else:
+            return (True, task_output)
+
+
+    def submit_job(self, method, arguments, description=None):
+        """
+        Queue a job and return its executor.Future, whose result is the
+        (success, task_output) pair that run_job returns.  The job attribute
+        of the future holds the method, the UJS job id and the paths of the
+        log files of the job, which are written as the job runs.  Cancelling
+        the future terminates the taskrunner if it has started.
+        """
+
         if method == "upload":
             command_list = ["trns_upload_taskrunner"]
         elif method == "download":
@@ -267,26 +526,63 @@ class TransformTaskRunnerDriver(TransformDriver):
             command_list.append("--{0}".format(k))
             command_list.append("{0}".format(arguments[k]))
 
+        pool = self._get_executor()
+
         estimated_running_time = (datetime.datetime.utcnow() +
                                   datetime.timedelta(minutes=int(3000)))
         ujs_job_id = self.ujs_client.create_and_start_job(self.token, 
             "Starting", description, {"ptype": "task", "max": 100},
             estimated_running_time.strftime("%Y-%m-%dT%H:%M:%S+0000"))
 
-        taskrunner = subprocess.Popen(command_list, stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE)
-        stdout, stderr = taskrunner.communicate()
+        log_name = os.path.join(self._log_directory, "{0}_{1}".format(method, ujs_job_id))
 
-        task_output = dict()
-        task_output["stdout"] = stdout
-        task_output["stderr"] = stderr
-        task_output["ujs_id"] = ujs_job_id
-        task_output["exit_code"] = taskrunner.returncode
+        job = {"method": method,
+               "ujs_id": ujs_job_id,
+               "stdout_file": log_name + ".stdout",
+               "stderr_file": log_name + ".stderr"}
 
-        if taskrunner.returncode != 0:
-            return (False, task_output)
-        else:
-            return (True, task_output)
+        future = pool.submit(self._run_taskrunner, (method, command_list, job), stoppable=True)
+        future.job = job
+
+        return future
+
+
+    def submit_jobs(self, method, arguments_list, description=None):
+        return [self.submit_job(method, x, description) for x in arguments_list]
+
+
+    def run_job(self, method, arguments, description=None, wait=True):
+        """
+        Run a job and return its (success, task_output) pair, or queue it and
+        return its future if wait is False, see submit_job.
+        """
+
+        future = self.submit_job(method, arguments, description)
+
+        if not wait:
+            return future
+
+        return future.result()
+
+
+    def wait_jobs(self, futures=None, first=False, timeout=None):
+        """
+        Wait for all of the jobs, or the first of them to finish, see
+        executor.wait.
+        """
+
+        return executor.wait(futures, first, timeout)
+
+
+    def close(self, cancel=False):
+        """
+        Wait for the queued jobs, or cancel them, and stop the executor.
+        """
+
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel)
+                self._executor = None
 
 
 class TransformClientTerminalDriver(TransformClientDriver):
@@ -357,47 +653,37 @@ class TransformClientTerminalDriver(TransformClientDriver):
     def monitor_job(self, awe_job_id=None, ujs_job_id=None, 
                     success_message="Job completed!",
                     error_message="Job failed!"):
-        completed = ["complete", "success"]
-        error = ["error", "fail"]
+        print self.terminal.blue("\tUJS Job Status:")
 
-        header = dict()
-        header["Authorization"] = "Oauth {0}".format(self.token)
+        def report(job_id, status):
+            print "\t\t{0} status update: {1}".format(status[0], status[2])
 
-        print self.terminal.blue("\tUJS Job Status:")
-        
-        # wait for UJS to complete    
-        last_status = ""
-        start = datetime.datetime.utcnow()
-        while 1:        
-            try:
-                status = self.ujs_client.get_job_status(ujs_job_id)
-            except Exception, e:
-                print self.terminal.red("\t\tIssue connecting to UJS!")
-                raise
-        
-            if last_status != status[2]:
-                print "\t\t{0} status update: {1}".format(status[0], status[2])
-                last_status = status[2]
-            
-            if status[1] in completed:
-                print self.terminal.green("\t\t{0}\n".format(success_message))
-                return (True, status)
-            elif status[1] in error:
-                print self.terminal.red("\t\t{0}\n".format(error_message))
-                return (False, status)
+        # wait for UJS to complete, see monitor_jobs
+        try:
+            success, status = self.monitor_jobs([ujs_job_id], report)[ujs_job_id]
+        except Exception, e:
+            print self.terminal.red("\t\tIssue connecting to UJS!")
+            raise
+
+        if success:
+            print self.terminal.green("\t\t{0}\n".format(success_message))
+        else:
+            print self.terminal.red("\t\t{0}\n".format(error_message))
+
+        return (success, status)
 
 
     def download_from_shock(self, shock_service_url=None, shock_id=None, directory=None):
         header = dict()
         header["Authorization"] = "Oauth {0}".format(self.token)
 
-        metadata_response = requests.get("{0}/node/{1}?verbosity=metadata".format(shock_service_url, shock_id), headers=header, stream=True, verify=True)
+        metadata_response = transport.get("{0}/node/{1}?verbosity=metadata".format(shock_service_url, shock_id), headers=header, stream=True, verify=True)
         shock_metadata = metadata_response.json()["data"]
         shockFileName = shock_metadata["file"]["name"]
         shockFileSize = shock_metadata["file"]["size"]
         metadata_response.close()
     
-        data = requests.get(shock_service_url + "/node/" + shock_id + "?download_raw", headers=header, stream=True)
+        data = transport.get(shock_service_url + "/node/" + shock_id + "?download_raw", headers=header, stream=True)
         size = int(data.headers["content-length"])
 
         if directory is not None:
@@ -445,12 +731,20 @@ class TransformClientTerminalDriver(TransformClientDriver):
         term = blessings.Terminal()
     
         print self.terminal.blue("\tShock upload status:\n")
-        def progress_indicator(monitor):
-            if monitor.bytes_read > size:
+        def show_progress(bytes_read):
+            if bytes_read > size:
                 print self.terminal.move_up + self.terminal.move_left + "\t\tPercentage of bytes uploaded to shock 100.00%"                    
             else:
-                progress = int(monitor.bytes_read)/float(size) * 100.0
+                progress = int(bytes_read)/float(size) * 100.0
                 print self.terminal.move_up + self.terminal.move_left + "\t\tPercentage of bytes uploaded to shock {0:.2f}%".format(progress)                    
+
+        def progress_indicator(monitor):
+            show_progress(monitor.bytes_read)
+
+        # large files go up as a multi-part node that can resume after a failure
+        if size > shock_upload.DEFAULT_PART_SIZE:
+            return shock_upload.upload(self.logger, shock_service_url, filePath, True, self.token,
+                                       progress=show_progress)
             
         #build the header
         header = dict()
@@ -462,8 +756,8 @@ class TransformClientTerminalDriver(TransformClientDriver):
     
         m = MultipartEncoderMonitor(encoder, progress_indicator)
 
-        response = requests.post(shock_service_url + "/node", headers=header, 
-                                 data=m, allow_redirects=True, verify=True)
+        response = transport.post(shock_service_url + "/node", headers=header, 
+                                 data=m, allow_redirects=True, verify=True, timeout=transport.LONG_TIMEOUT)
     
         if not response.ok:
             print response.raise_for_status()
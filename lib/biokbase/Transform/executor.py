@@ -0,0 +1,296 @@
+"""
+Provides bounded concurrent execution for driver calls.
+
+Python 2 has no asyncio, so calls run on a fixed pool of threads and are
+handed back as futures that can be waited on or cancelled.  Service clients
+send their JSON-RPC calls over the pooled session that transport keeps per
+service, so concurrent calls to a service share keep-alive connections
+instead of opening a new one for every call.
+"""
+
+import random
+import threading
+import multiprocessing.pool
+
+import simplejson
+
+from biokbase.Transform.Client import ServerError
+from biokbase.Transform import transport
+
+
+DEFAULT_CONCURRENCY = 16
+
+# UJS methods that return more than one value, the others return one
+UJS_MULTIPLE_RETURNS = ["get_job_status", "get_job_description"]
+
+
+class Cancelled(Exception):
+    """
+    Raised by the result of a future that was cancelled before it ran.
+    """
+
+    pass
+
+
+class Future(object):
+    """
+    Result of a call submitted to an Executor.  A call that has not started
+    can be cancelled, and calls that accept a stop event see it set when they
+    are cancelled while running.
+    """
+
+    def __init__(self):
+        self.stop = threading.Event()
+
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._started = False
+        self._result = None
+        self._error = None
+        self._callbacks = list()
+
+
+    def _start(self):
+        with self._lock:
+            if self.stop.is_set():
+                return False
+
+            self._started = True
+            return True
+
+
+    def _finish(self, result=None, error=None):
+        with self._lock:
+            if self._done.is_set():
+                return
+
+            self._result = result
+            self._error = error
+            self._done.set()
+
+            callbacks = self._callbacks
+            self._callbacks = list()
+
+        for x in callbacks:
+            x(self)
+
+
+    def add_done_callback(self, callback=None):
+        """
+        Call callback(future) once the call has finished, at once if it has.
+        """
+
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+
+    def cancel(self):
+        """
+        Cancel the call, returning True if it had not started yet.
+        """
+
+        with self._lock:
+            self.stop.set()
+
+            if self._started:
+                return False
+
+        self._finish(error=Cancelled("Cancelled before it started"))
+        return True
+
+
+    def cancelled(self):
+        return self.stop.is_set()
+
+
+    def done(self):
+        return self._done.is_set()
+
+
+    def result(self, timeout=None):
+        """
+        Wait for the call and return its result, raising its exception if it
+        failed.
+        """
+
+        # waiting without a timeout would not be interrupted by Ctrl-C
+        if timeout is None:
+            while not self._done.wait(3600):
+                pass
+        elif not self._done.wait(timeout):
+            raise Exception("Timed out waiting for a result")
+
+        if self._error is not None:
+            raise self._error
+
+        return self._result
+
+
+def wait(futures=None, first=False, timeout=None):
+    """
+    Wait for all of the futures to finish, or only the first if first is
+    set, and return the (done, not_done) lists of futures.  Returns early
+    if timeout seconds pass first.
+    """
+
+    futures = list(futures)
+    finished = threading.Event()
+    remaining = [1 if first else len(futures)]
+    lock = threading.Lock()
+
+    def count(future):
+        with lock:
+            remaining[0] -= 1
+
+            if remaining[0] <= 0:
+                finished.set()
+
+    if len(futures) == 0:
+        finished.set()
+
+    for x in futures:
+        x.add_done_callback(count)
+
+    # waiting without a timeout would not be interrupted by Ctrl-C
+    if timeout is None:
+        while not finished.wait(3600):
+            pass
+    else:
+        finished.wait(timeout)
+
+    return [x for x in futures if x.done()], [x for x in futures if not x.done()]
+
+
+def _run(future, function, args, kwargs):
+    if not future._start():
+        return
+
+    try:
+        future._finish(result=function(*args, **kwargs))
+    except Exception, e:
+        future._finish(error=e)
+
+
+class Executor(object):
+    """
+    Runs calls on a fixed number of threads, so no more than that many are
+    in flight at a time.
+    """
+
+    def __init__(self, workers=DEFAULT_CONCURRENCY):
+        self.workers = workers
+
+        self._pool = multiprocessing.pool.ThreadPool(workers)
+        self._futures = list()
+        self._lock = threading.Lock()
+
+
+    def submit(self, function=None, args=(), kwargs=None, stoppable=False):
+        """
+        Queue function(*args, **kwargs) and return its Future.  If stoppable
+        is set the function is also passed the stop event of the future as
+        the keyword argument stop.
+        """
+
+        if kwargs is None:
+            kwargs = dict()
+
+        future = Future()
+
+        if stoppable:
+            kwargs["stop"] = future.stop
+
+        with self._lock:
+            self._futures = [x for x in self._futures if not x.done()]
+            self._futures.append(future)
+
+        self._pool.apply_async(_run, (future, function, args, kwargs))
+        return future
+
+
+    def map(self, function=None, items=None):
+        """
+        Submit function(x) for every item, returning the futures in order.
+        """
+
+        return [self.submit(function, (x,)) for x in items]
+
+
+    def shutdown(self, cancel=False):
+        """
+        Wait for the submitted calls to finish, or cancel them first.
+        """
+
+        if cancel:
+            with self._lock:
+                for x in self._futures:
+                    x.cancel()
+
+        self._pool.close()
+        self._pool.join()
+
+
+class ServiceClient(object):
+    """
+    JSON-RPC client for a KBase service that calls any method of the service
+    by name over the pooled session for its url.  Methods named in multiple
+    return the list of their return values, the others return the single
+    value, the same as the generated clients.
+    """
+
+    def __init__(self, url=None, token=None, service=None, multiple=None, timeout=30 * 60):
+        if url is None:
+            raise ValueError("A url is required")
+
+        self.url = url
+        self.service = service
+        self.multiple = multiple or list()
+        self.timeout = timeout
+
+        self._headers = {"Content-Type": "application/json"}
+
+        if token is not None:
+            self._headers["AUTHORIZATION"] = token
+
+
+    def _call(self, method, params):
+        body = simplejson.dumps({"method": "{0}.{1}".format(self.service, method),
+                                 "params": params,
+                                 "version": "1.1",
+                                 "id": str(random.random())[2:]})
+
+        response = transport.post(self.url, headers=self._headers, data=body,
+                                  timeout=(30, self.timeout))
+
+        if response.status_code == 500:
+            if response.headers.get("content-type") == "application/json":
+                error = response.json()
+
+                if "error" in error:
+                    raise ServerError(**error["error"])
+
+            raise ServerError("Unknown", 0, response.text)
+
+        if not response.ok:
+            response.raise_for_status()
+
+        result = response.json()
+
+        if "result" not in result:
+            raise ServerError("Unknown", 0, "An unknown server error occurred")
+
+        if method in self.multiple:
+            return result["result"]
+
+        return result["result"][0]
+
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        return lambda *params: self._call(method, list(params))
@@ -0,0 +1,237 @@
+"""
+Provides concurrent ingest of ftp:// urls.
+
+A bounded pool of FTP connections is shared by a breadth first crawl, which
+lists every directory of a level in parallel and stops as soon as the file
+count passes the threshold, and by the downloads.  Files are handed to
+extraction as soon as they finish downloading, so decompression of one file
+overlaps the transfer of the next ones.
+"""
+
+import os
+import Queue
+import threading
+import contextlib
+import multiprocessing.pool
+
+import ftputil
+
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_EXTRACTORS = 2
+DEFAULT_THRESHOLD = 1024
+
+
+def parse_ftp_url(url=None):
+    """
+    Split an ftp:// url into the host and the path on the host.
+    """
+
+    if url is None or not url.startswith("ftp://"):
+        raise Exception("Not an FTP url : {0}".format(url))
+
+    location = url.split("ftp://")[1]
+
+    if "/" not in location:
+        return location, "/"
+
+    host, path = location.split("/", 1)
+    return host, path
+
+
+class FTPConnectionPool(object):
+    """
+    Bounded pool of FTP connections to one host, opened as they are needed.
+    A connection that fails is closed instead of being returned to the pool.
+    """
+
+    def __init__(self, host=None, user='anonymous', password='anonymous@', size=DEFAULT_CONNECTIONS):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.size = size
+
+        self._idle = Queue.Queue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._all = list()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        self._slots.acquire()
+
+        try:
+            try:
+                ftp_connection = self._idle.get_nowait()
+            except Queue.Empty:
+                ftp_connection = ftputil.FTPHost(self.host, self.user, self.password)
+
+                with self._lock:
+                    self._all.append(ftp_connection)
+
+            try:
+                yield ftp_connection
+            except:
+                self._discard(ftp_connection)
+                raise
+            else:
+                self._idle.put(ftp_connection)
+        finally:
+            self._slots.release()
+
+    def _discard(self, ftp_connection):
+        with self._lock:
+            if ftp_connection in self._all:
+                self._all.remove(ftp_connection)
+
+        try:
+            ftp_connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            connections = self._all[:]
+            del self._all[:]
+
+        for x in connections:
+            try:
+                x.close()
+            except Exception:
+                pass
+
+
+def _list_directory(pool, path):
+    """
+    List one directory, returning the paths of the files and subdirectories.
+    """
+
+    files = list()
+    directories = list()
+
+    with pool.connection() as ftp_connection:
+        for name in ftp_connection.listdir(path):
+            child = ftp_connection.path.join(path, name)
+
+            if ftp_connection.path.isfile(child):
+                files.append(child)
+            elif ftp_connection.path.isdir(child):
+                directories.append(child)
+
+    return files, directories
+
+
+def crawl(logger = None,
+          pool = None,
+          path = None,
+          threshold = DEFAULT_THRESHOLD,
+          connections = DEFAULT_CONNECTIONS):
+    """
+    Find every file below an FTP directory, listing each level of the tree
+    in parallel.  Raises an exception as soon as more than threshold files
+    have been found.
+    """
+
+    all_files = list()
+    frontier = [path]
+
+    workers = multiprocessing.pool.ThreadPool(connections)
+    try:
+        while len(frontier) > 0:
+            if logger is not None:
+                logger.info("Listing {0:d} directories on {1}".format(len(frontier), pool.host))
+
+            next_frontier = list()
+
+            for files, directories in workers.imap_unordered(lambda x: _list_directory(pool, x), frontier):
+                all_files.extend(files)
+                next_frontier.extend(directories)
+
+                if len(all_files) > threshold:
+                    raise Exception("Too many files to process, found so far {0:d}".format(len(all_files)))
+
+            frontier = next_frontier
+
+        workers.close()
+    finally:
+        workers.terminate()
+        workers.join()
+
+    return sorted(all_files)
+
+
+def ingest(logger = None,
+           url = None,
+           download_directory = None,
+           extract = None,
+           threshold = DEFAULT_THRESHOLD,
+           connections = DEFAULT_CONNECTIONS,
+           extractors = DEFAULT_EXTRACTORS):
+    """
+    Download an FTP file or directory tree into download_directory.
+
+    A single file is written to download_directory, while the files of a
+    directory tree are written to a subdirectory named after it.  Each file
+    is passed to extract(logger, filePath) once it has been downloaded.
+    Returns the list of downloaded file paths.
+    """
+
+    host, path = parse_ftp_url(url)
+
+    pool = FTPConnectionPool(host, size=connections)
+    try:
+        with pool.connection() as ftp_connection:
+            if ftp_connection.path.isdir(path):
+                is_directory = True
+            elif ftp_connection.path.isfile(path):
+                is_directory = False
+            else:
+                raise Exception('File not found for FTP URL "{0}"'.format(url))
+
+        if is_directory:
+            file_list = crawl(logger, pool, path, threshold, connections)
+
+            dirname = os.path.join(download_directory, [x for x in path.split("/") if len(x) > 0][-1])
+            os.mkdir(dirname)
+        else:
+            file_list = [path]
+            dirname = download_directory
+
+        def download(source):
+            filePath = os.path.join(os.path.abspath(dirname), os.path.basename(source))
+
+            if logger is not None:
+                logger.info("Downloading {0}".format(host + "/" + source.lstrip("/")))
+
+            with pool.connection() as ftp_connection:
+                ftp_connection.download(source, filePath)
+
+            return filePath
+
+        # downloads produce files for a smaller pool of extraction workers
+        downloaders = multiprocessing.pool.ThreadPool(connections)
+        extraction = multiprocessing.pool.ThreadPool(extractors)
+        try:
+            pending = list()
+            downloaded = list()
+
+            for filePath in downloaders.imap_unordered(download, file_list):
+                downloaded.append(filePath)
+
+                if extract is not None:
+                    pending.append(extraction.apply_async(extract, (logger, filePath)))
+
+            for x in pending:
+                x.get()
+
+            downloaders.close()
+            extraction.close()
+        finally:
+            downloaders.terminate()
+            extraction.terminate()
+            downloaders.join()
+            extraction.join()
+    finally:
+        pool.close()
+
+    return downloaded
@@ -7,7 +7,6 @@ import sys
 import os
 import time
 import datetime
-import shutil
 import subprocess
 import base64
 import simplejson
@@ -16,12 +15,75 @@ import select
 import functools
 import threading
 import signal
-import Queue
+import errno
+import termios
+import tempfile
+import collections
+import imp
+import re
+import traceback
+import weakref
+import distutils.spawn
+import resource
+import fcntl
+import hashlib
+import heapq
+import uuid
 
 from biokbase.Transform import script_utils
+from biokbase.Transform import scratch
 
 UJS_STATUS_MAX = 200
 
+# shortest time in seconds between progress updates sent to UJS
+UJS_PROGRESS_INTERVAL = 5
+
+# lines of task output kept in memory, the full output goes to spill files
+TASK_OUTPUT_TAIL_LINES = 1000
+
+# longest line passed on before a partial line is broken up
+TASK_OUTPUT_MAX_LINE = 2**16
+
+# JSON lines file that a record of the resources used by each job is appended to,
+# which plans are made from, so it should be on storage shared with the service
+JOB_METRICS_FILE = os.environ.get("KB_TRANSFORM_METRICS_FILE",
+                                  os.path.join(tempfile.gettempdir(), "transform_job_metrics.jsonl"))
+
+# where the compiled index of the plugin configs is kept
+# the index names scripts that are run, so it is only trusted in a directory and
+# file of this user that no one else can write to
+PLUGIN_INDEX_DIRECTORY = os.environ.get("KB_TRANSFORM_PLUGIN_INDEX_DIR",
+                                        os.path.join(tempfile.gettempdir(),
+                                                     "transform_plugins_{0:d}".format(os.getuid())))
+PLUGIN_INDEX_VERSION = 1
+
+# longest time in seconds before a watched plugin directory is checked for changes
+PLUGIN_RELOAD_INTERVAL = 30
+
+# seconds a plugin is expected to take when it has no recorded metrics, and
+# the added cost of saving and reading back each intermediate object of a
+# conversion chain
+PLUGIN_DEFAULT_COST = 60
+PLUGIN_HOP_COST = 30
+
+# most plugins chained together to convert between two types
+PLAN_MAX_HOPS = 4
+
+# plugin functions that parse the command line of the script and run it
+PLUGIN_ENTRY_POINTS = ["main"]
+
+# plugin modules already loaded by this process, by script path
+_plugin_modules = dict()
+
+# objects whose background threads are stopped while forking, see ForkedTask
+_fork_paused = weakref.WeakSet()
+
+# plugin configs already compiled by this process, by plugin directory
+_plugin_registries = dict()
+
+# plugin costs read from a metrics file, with the size and mtime of the file
+_plugin_costs = dict()
+
 def report_exception(logger=None, report_details=None, cleanup_details=None):
     """
     Report a fatal error from a taskrunner script back to UJS if possible.
@@ -34,8 +96,18 @@ def report_exception(logger=None, report_details=None, cleanup_details=None):
     logger.debug(report_details)
     logger.error(report_details["error_message"])
 
+    if report_details.get("metrics") is not None:
+        report_details["metrics"].finish("failed")
+
     if report_details["ujs_job_id"] is not None:
         ujs = report_details["ujs_client"]
+
+        # pending progress must not arrive after the job is completed
+        if report_details.get("progress") is not None:
+            try:
+                report_details["progress"].close()
+            except Exception, e:
+                logger.exception(e)
         
         job_status = ujs.get_job_status(report_details["ujs_job_id"])
 
@@ -60,13 +132,14 @@ def report_exception(logger=None, report_details=None, cleanup_details=None):
 
 def cleanup(logger=None, directory=None):
     """
-    Clean up after the job.  At the moment this just means removing the working
-    directory, but later could mean other things.
+    Clean up after the job.  At the moment this just means releasing the working
+    directory, which is moved to the scratch trash and removed in the background,
+    see scratch.ScratchManager.
     """
     
     try:
-        shutil.rmtree(directory)
-    except IOError, e:
+        scratch.ScratchManager(logger=logger).release(directory)
+    except (IOError, OSError), e:
         logger.error("Unable to remove working directory {0}".format(directory))
         raise
 
@@ -81,28 +154,760 @@ def gen_recursive_filelist(d):
             yield os.path.join(root, file)
 
 
-def run_task(logger, arguments, debug=False, callback=None):
+def read_process_io(pid="self"):
+    """
+    Return the I/O counters of a process from /proc/<pid>/io, which include
+    those of the children it has waited for, or an empty dictionary if they
+    are not available.
+    """
+
+    counters = dict()
+
+    try:
+        with open("/proc/{0}/io".format(pid), 'r') as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                counters[name] = int(value)
+    except (IOError, ValueError):
+        pass
+
+    return counters
+
+
+class ResourceMeter(object):
+    """
+    Measures the resources used from the time it is created: wall time, user
+    and system CPU time, page faults and I/O.  Usage of this process can be
+    left out to measure only the child processes it waits for.  The maximum
+    RSS is the peak of any single process so far, not a difference.
+    """
+
+    def __init__(self, include_self=True):
+        self.include_self = include_self
+
+        self._time = time.time()
+        self._usage = self._rusage()
+        self._io = self._read_io()
+
+    def _rusage(self):
+        usage = [resource.getrusage(resource.RUSAGE_CHILDREN)]
+
+        if self.include_self:
+            usage.append(resource.getrusage(resource.RUSAGE_SELF))
+
+        return usage
+
+    def _read_io(self):
+        if self.include_self:
+            return read_process_io()
+
+        return dict()
+
+    def stop(self, io=None):
+        """
+        Return the resources used since the meter was created.  The I/O of a
+        child that has not been waited for yet can be passed in as io.
+        """
+
+        usage = self._rusage()
+
+        def delta(field):
+            return sum([getattr(after, field) - getattr(before, field) for before, after in zip(self._usage, usage)])
+
+        if io is None:
+            end_io = self._read_io()
+            io = dict([(k, end_io[k] - self._io[k]) for k in end_io if k in self._io])
+
+        return {"wall_time": round(time.time() - self._time, 3),
+                "user_time": round(delta("ru_utime"), 3),
+                "system_time": round(delta("ru_stime"), 3),
+                "max_rss_kb": max([x.ru_maxrss for x in usage]),
+                "minor_faults": delta("ru_minflt"),
+                "major_faults": delta("ru_majflt"),
+                "read_bytes": io.get("rchar", 0),
+                "write_bytes": io.get("wchar", 0),
+                "disk_read_bytes": io.get("read_bytes", 0),
+                "disk_write_bytes": io.get("write_bytes", 0)}
+
+
+def add_resource_usage(total=None, usage=None):
+    """
+    Add resource usage measured by ResourceMeter into a running total.
+    """
+
+    for k in usage:
+        if k == "max_rss_kb":
+            total[k] = max(total.get(k, 0), usage[k])
+        elif isinstance(usage[k], float):
+            total[k] = round(total.get(k, 0) + usage[k], 3)
+        else:
+            total[k] = total.get(k, 0) + usage[k]
+
+    return total
+
+
+def directory_size(directory=None):
+    """
+    Return the total size in bytes of the files below a directory.
+    """
+
+    if directory is None or not os.path.isdir(directory):
+        return 0
+
+    return sum([os.path.getsize(x) for x in gen_recursive_filelist(directory) if os.path.isfile(x)])
+
+
+class JobMetrics(object):
+    """
+    Accounts for the resources a taskrunner job uses in each of its phases,
+    such as download, validate, transform and save.  Calling start_phase()
+    ends the phase in progress, and finish() returns a compact record of the
+    job for the UJS results, which is also appended to a JSON lines file for
+    capacity planning.  Details such as the plugin and input size can be
+    added to the details dictionary.
+    """
+
+    def __init__(self, method=None, details=None, metrics_file=JOB_METRICS_FILE, logger=None):
+        if logger is None:
+            logger = script_utils.stderrlogger(__file__)
+
+        self.method = method
+        self.details = details or dict()
+        self.metrics_file = metrics_file
+        self.logger = logger
+
+        self.phases = collections.OrderedDict()
+        self._phase = None
+        self._meter = None
+        self._started = datetime.datetime.utcnow()
+        self._record = None
+
+    def start_phase(self, name=None):
+        self.end_phase()
+
+        self._phase = name
+        self._meter = ResourceMeter()
+
+    def end_phase(self):
+        if self._phase is None:
+            return
+
+        add_resource_usage(self.phases.setdefault(self._phase, dict()), self._meter.stop())
+
+        self._phase = None
+        self._meter = None
+
+    def finish(self, status="completed"):
+        """
+        End the job and return its record, writing it only the first time.
+        """
+
+        if self._record is not None:
+            return self._record
+
+        self.end_phase()
+
+        total = dict()
+        for name in self.phases:
+            add_resource_usage(total, self.phases[name])
+
+        self._record = {"method": self.method,
+                        "status": status,
+                        "started": self._started.strftime('%Y-%m-%dT%H:%M:%S+0000'),
+                        "details": self.details,
+                        "phases": self.phases,
+                        "total": total}
+
+        self.write(self._record)
+        return self._record
+
+    def write(self, record=None):
+        if self.metrics_file is None:
+            return
+
+        try:
+            line = simplejson.dumps(record) + "\n"
+
+            with open(self.metrics_file, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.write(line)
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except Exception, e:
+            self.logger.warning("Unable to write job metrics to {0} : {1}".format(self.metrics_file, e))
+
+
+class ProgressReporter(object):
+    """
+    Reports the progress of a task to UJS from a background thread.  Only the
+    latest message is kept and at most one update is sent per interval, so
+    update() never waits on UJS and can be passed as the run_task callback.
+    phase() sends a message right away and waits for it, raising any error
+    from UJS.  close() sends what is pending and must be called before the
+    job is completed.  Without a UJS job id messages are dropped.
+
+    The thread is stopped while the process forks, see ForkedTask, and
+    messages given meanwhile are sent once it is resumed.
+    """
+
+    def __init__(self, ujs=None, ujs_job_id=None, token=None, estimated_completion=None,
+                 interval=UJS_PROGRESS_INTERVAL, logger=None):
+        if estimated_completion is None:
+            estimated_completion = datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+
+        if logger is None:
+            logger = script_utils.stderrlogger(__file__)
+
+        self.ujs = ujs
+        self.ujs_job_id = ujs_job_id
+        self.token = token
+        self.estimated_completion = estimated_completion.strftime('%Y-%m-%dT%H:%M:%S+0000')
+        self.interval = interval
+        self.logger = logger
+
+        self._condition = threading.Condition()
+        self._message = None
+        # sequence numbers of the latest message given and the latest one sent
+        self._queued = 0
+        self._sent = 0
+        self._error = None
+        self._urgent = False
+        self._closed = False
+        self._paused = False
+        self._thread = None
+
+        _fork_paused.add(self)
+
+    def update(self, message=None):
+        if self.ujs_job_id is None:
+            return
+
+        with self._condition:
+            if self._closed:
+                return
+
+            self._message = message[:UJS_STATUS_MAX]
+            self._queued += 1
+
+            self._start()
+            self._condition.notify_all()
+
+    __call__ = update
+
+    def _start(self):
+        # called holding the condition
+        if self._thread is None and not self._paused:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def pause(self):
+        """
+        Stop the thread once any message being sent has been sent.
+        """
+
+        with self._condition:
+            self._paused = True
+            self._condition.notify_all()
+            thread = self._thread
+
+        if thread is not None:
+            thread.join()
+
+        with self._condition:
+            self._thread = None
+
+    def resume(self):
+        with self._condition:
+            self._paused = False
+
+            if self._sent < self._queued and not self._closed:
+                self._start()
+
+    def phase(self, message=None):
+        self.update(message)
+        self.flush()
+
+    def flush(self):
+        """
+        Send the latest message now if it has not been sent, and wait for it.
+        """
+
+        with self._condition:
+            target = self._queued
+            self._urgent = True
+            self._condition.notify_all()
+
+            while self._sent < target:
+                self._condition.wait(1)
+
+            if self._error is not None and self._error[0] >= target:
+                error = self._error[1]
+                self._error = None
+                raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+
+            if self._thread is not None:
+                self._thread.join()
+
+    def _next_message(self, last_sent):
+        with self._condition:
+            while 1:
+                if self._paused:
+                    return None, None
+                elif self._sent < self._queued:
+                    wait = last_sent + self.interval - time.time()
+
+                    if self._urgent or self._closed or wait <= 0:
+                        self._urgent = False
+                        return self._queued, self._message
+
+                    self._condition.wait(wait)
+                elif self._closed:
+                    return None, None
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        last_sent = 0
+
+        while 1:
+            sequence, message = self._next_message(last_sent)
+
+            if sequence is None:
+                return
+
+            error = None
+            try:
+                self.ujs.update_job_progress(self.ujs_job_id, self.token, message, 1,
+                                             self.estimated_completion)
+            except Exception, e:
+                self.logger.warning("Unable to report progress to UJS : {0}".format(e))
+                error = e
+
+            last_sent = time.time()
+
+            with self._condition:
+                self._sent = sequence
+
+                if error is not None:
+                    self._error = (sequence, error)
+
+                self._condition.notify_all()
+
+
+def intermediate_object_name(object_name=None, step=0):
+    """
+    Return a unique name for an intermediate object of a conversion chain.
+    """
+
+    return "{0}.transform_{1}_{2:d}".format(object_name, uuid.uuid4().hex[:8], step)
+
+
+def delete_workspace_objects(logger=None, workspace_service_url=None, token=None,
+                             workspace_name=None, object_names=None):
+    """
+    Delete workspace objects, logging rather than raising any error.
+    """
+
+    if not object_names:
+        return
+
+    from biokbase.workspace.client import Workspace
+
+    try:
+        workspace = Workspace(url=workspace_service_url, token=token)
+        workspace.delete_objects([{"workspace": workspace_name, "name": x} for x in object_names])
+    except Exception, e:
+        logger.warning("Unable to delete intermediate objects {0} from {1} : {2}".format(
+            ", ".join(object_names), workspace_name, e))
+
+
+def get_object_size(logger=None, workspace_service_url=None, token=None,
+                    workspace_name=None, object_name=None, object_id=None):
+    """
+    Size in bytes of a workspace object, or 0 if it cannot be found out.
+    """
+
+    from biokbase.workspace.client import Workspace
+
+    object_info = {"workspace": workspace_name}
+
+    if object_id is not None:
+        object_info["objid"] = object_id
+    else:
+        object_info["name"] = object_name
+
+    try:
+        workspace = Workspace(url=workspace_service_url, token=token)
+        return workspace.get_object_info_new({"objects": [object_info]})[0][9]
+    except Exception, e:
+        logger.warning("Unable to get the size of {0} in {1} : {2}".format(
+            object_name or object_id, workspace_name, e))
+        return 0
+
+
+def run_convert_chain(logger = None,
+                      chain = None,
+                      workspace_service_url = None,
+                      source_workspace_name = None,
+                      source_object_name = None,
+                      destination_workspace_name = None,
+                      destination_object_name = None,
+                      working_directory = None,
+                      optional_arguments = None,
+                      token = None,
+                      callback = None,
+                      debug = False,
+                      delete_source = False):
+    """
+    Run convert plugins one after the other, each reading the object saved by
+    the previous one.  Convert plugins read from and save to the workspace,
+    so each intermediate object is saved to the destination workspace under
+    a temporary name and deleted once the chain has finished, along with the
+    source object if delete_source is True.  Returns the task outputs.
+    """
+
+    task_outputs = list()
+    intermediates = list()
+
+    if delete_source:
+        intermediates.append(source_object_name)
+
+    workspace_name = source_workspace_name
+    object_name = source_object_name
+
+    try:
+        for i, step in enumerate(chain):
+            if i == len(chain) - 1:
+                next_object_name = destination_object_name
+            else:
+                next_object_name = intermediate_object_name(destination_object_name, i + 1)
+
+            step_directory = os.path.join(working_directory, "convert_{0:d}".format(i + 1))
+
+            if not os.path.exists(step_directory):
+                os.makedirs(step_directory)
+
+            convert_args = dict(step)
+            convert_args["optional_arguments"] = optional_arguments
+            convert_args["working_directory"] = step_directory
+            convert_args["workspace_service_url"] = workspace_service_url
+            convert_args["source_workspace_name"] = workspace_name
+            convert_args["source_object_name"] = object_name
+            convert_args["destination_workspace_name"] = destination_workspace_name
+            convert_args["destination_object_name"] = next_object_name
+
+            logger.info("Converting {0} from {1} to {2}".format(object_name, step["source_kbase_type"],
+                                                                  step["destination_kbase_type"]))
+
+            task_outputs.append(run_task(logger, convert_args, debug=debug, callback=callback,
+                                         **get_execution_options(step)))
+
+            if next_object_name != destination_object_name:
+                intermediates.append(next_object_name)
+
+            workspace_name = destination_workspace_name
+            object_name = next_object_name
+    finally:
+        delete_workspace_objects(logger, workspace_service_url, token, destination_workspace_name, intermediates)
+
+    return task_outputs
+
+
+def run_task(logger, arguments, debug=False, callback=None, in_process=False, entry_point=None):
     """
     A factory function to abstract the implementation details of how tasks are run.
+
+    If in_process is True, the plugin entry point is called in a forked child
+    instead of starting a new interpreter for the script, see TaskRunner.run().
     """
 
     if logger is None:
         logger = script_utils.stderrlogger(__file__)
 
     h = TaskRunner(logger, callback=callback)
-    out = h.run(arguments, debug)
+    out = h.run(arguments, debug, in_process, entry_point)
     return out
 
 
+def get_execution_options(plugin_config=None):
+    """
+    Return the run_task keyword arguments that a plugin config asks for, which
+    opts in to in process execution with handler_options in_process and can
+    name the function that runs the script from sys.argv, main by default,
+    with handler_options entry_point.
+    """
+
+    handler_options = plugin_config.get("handler_options", dict())
+
+    return {"in_process": bool(handler_options.get("in_process", False)),
+            "entry_point": handler_options.get("entry_point")}
+
+
+def find_plugin_script(script_name=None):
+    """
+    Find the Python source of a plugin script, either given as a path, in the
+    deployed pybin directory or on the PATH.  Returns None if it is not found.
+    """
+
+    if script_name is None or not script_name.endswith(".py"):
+        return None
+
+    if os.path.isfile(script_name):
+        return os.path.abspath(script_name)
+
+    if "KB_TOP" in os.environ:
+        path = os.path.join(os.environ["KB_TOP"], "pybin", script_name)
+
+        if os.path.isfile(path):
+            return path
+
+    return distutils.spawn.find_executable(script_name)
+
+
+def load_plugin_module(script_name=None, logger=None):
+    """
+    Load a plugin script as a module, without running its main block, and
+    return it or None if it can not be found or loaded.  Modules are loaded
+    once per process, so forked workers share what the plugin imports.
+    """
+
+    path = find_plugin_script(script_name)
+
+    if path is None:
+        return None
+
+    if path not in _plugin_modules:
+        try:
+            module_name = "_trns_plugin_" + re.sub(r"\W", "_", os.path.splitext(os.path.basename(path))[0])
+            _plugin_modules[path] = imp.load_source(module_name, path)
+        except Exception, e:
+            if logger is not None:
+                logger.warning("Unable to load plugin {0} : {1}".format(path, e))
+            return None
+
+    return _plugin_modules[path]
+
+
+def load_plugin_entry_point(script_name=None, entry_point=None, logger=None):
+    """
+    Load a plugin script as a module and return its entry point function, or
+    None if the script or entry point can not be found.  The entry point takes
+    no arguments and reads the command line from sys.argv, like the main()
+    that the script calls when it is run as a command.
+    """
+
+    module = load_plugin_module(script_name, logger)
+
+    if module is None:
+        return None
+
+    if entry_point is not None:
+        names = [entry_point]
+    else:
+        names = PLUGIN_ENTRY_POINTS
+
+    for name in names:
+        if callable(getattr(module, name, None)):
+            return getattr(module, name)
+
+    return None
+
+
+def call_plugin_entry_point(function=None, script_path=None, command_list=None):
+    """
+    Call a plugin entry point with sys.argv set to the command that would run
+    the script, so the plugin parses its arguments and applies its defaults
+    with its own parser.
+    """
+
+    sys.argv = [script_path] + command_list[1:]
+
+    return function()
+
+
+class ForkedTask(object):
+    """
+    Runs a function in a forked child with its stdout and stderr redirected,
+    and provides the parts of the subprocess.Popen interface used by TaskRunner.
+    The child exits with 0 if the function returns, the code given to
+    sys.exit(), or 1 if it raises an exception.
+
+    A thread holding a lock when the process forks leaves it held forever in
+    the child, so the background threads of this process are stopped while
+    it forks, and an exception is raised without forking if other threads
+    are still running.
+    """
+
+    def __init__(self, target=None, stdout_fd=None, stderr_fd=None, close_fds=None):
+        self.returncode = None
+
+        paused = list(_fork_paused)
+        for x in paused:
+            x.pause()
+
+        try:
+            if threading.active_count() > 1:
+                raise Exception("Unable to fork while {0:d} other threads are running".format(
+                    threading.active_count() - 1))
+
+            self.pid = os.fork()
+        finally:
+            # the child never resumes them, it has only the thread that forked
+            if getattr(self, "pid", None) != 0:
+                for x in paused:
+                    x.resume()
+
+        if self.pid == 0:
+            code = 1
+
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+                for fd in close_fds or list():
+                    os.close(fd)
+
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.dup2(stdout_fd, 1)
+                os.dup2(stderr_fd, 2)
+                os.close(stdout_fd)
+                os.close(stderr_fd)
+
+                # line buffered like a script writing to the pty
+                sys.stdout = os.fdopen(1, 'w', 1)
+                sys.stderr = os.fdopen(2, 'w', 0)
+
+                target()
+                code = 0
+            except SystemExit, e:
+                if e.code is None:
+                    code = 0
+                elif isinstance(e.code, int):
+                    code = e.code
+                else:
+                    sys.stderr.write("{0}\n".format(e.code))
+            except:
+                traceback.print_exc()
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(code)
+
+    def _set_status(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+
+            if pid != 0:
+                self._set_status(status)
+
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            self._set_status(status)
+
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+
+class OutputTail(object):
+    """
+    Collects the output of one stream of a task.  Data is split into lines as
+    it arrives, each line is passed to an optional callback, the full output
+    is written to a spill file, and only the last max_lines lines are kept in
+    memory.
+    """
+
+    def __init__(self, spill_file=None, max_lines=TASK_OUTPUT_TAIL_LINES, callback=None):
+        self.spill_file = spill_file
+        self.callback = callback
+        self._lines = collections.deque(maxlen=max_lines)
+        self._partial = list()
+        self._partial_size = 0
+
+    def _emit(self, line):
+        self._lines.append(line)
+
+        if self.callback is not None:
+            text = line.rstrip("\r\n")
+
+            if text:
+                self.callback(text)
+
+    def feed(self, data=None):
+        self.spill_file.write(data)
+
+        lines = data.split("\n")
+
+        for x in lines[:-1]:
+            self._partial.append(x)
+            self._emit("".join(self._partial) + "\n")
+            self._partial = list()
+            self._partial_size = 0
+
+        if lines[-1]:
+            self._partial.append(lines[-1])
+            self._partial_size += len(lines[-1])
+
+            if self._partial_size > TASK_OUTPUT_MAX_LINE:
+                self._emit("".join(self._partial))
+                self._partial = list()
+                self._partial_size = 0
+
+    def finish(self):
+        if self._partial:
+            self._emit("".join(self._partial))
+            self._partial = list()
+            self._partial_size = 0
+
+        self.spill_file.flush()
+
+    def getvalue(self):
+        return "".join(self._lines)
+
+
 class TaskRunner(object):
     """
     A simple task runner that builds a command line call from a given config, runs
     the command and reports back the stdout and stderr of the task if it succeeds,
     or raises an exception if the task fails, which is detected at the moment by the
     return code of the task.
+
+    Only the last tail_lines lines of stdout and stderr are reported.  If a log
+    directory is given, the full output of each task is kept there.
     """
     
-    def __init__(self, logger=None, callback=None):
+    def __init__(self, logger=None, callback=None, tail_lines=TASK_OUTPUT_TAIL_LINES, log_directory=None):
         #logger_stdout = script_utils.getStdoutLogger()
         if logger is None:
             self.logger = script_utils.stderrlogger(__file__)
@@ -114,6 +919,9 @@ class TaskRunner(object):
         else:
             self.callback = callback
 
+        self.tail_lines = tail_lines
+        self.log_directory = log_directory
+
 
     def _build_command_list(self, arguments=None, debug=False):
         """
@@ -146,7 +954,14 @@ class TaskRunner(object):
         return command_list
 
 
-    def run(self, arguments=None, debug=False):
+    def _open_spill_file(self, name):
+        if self.log_directory is None:
+            return tempfile.TemporaryFile()
+
+        return open(os.path.join(self.log_directory, name), 'w+b')
+
+
+    def run(self, arguments=None, debug=False, in_process=False, entry_point=None):
         """
         Executes the task while monitoring stdout and stderr for messages.
 
@@ -154,6 +969,16 @@ class TaskRunner(object):
         The default behavior for the callback would be to log the message, but other behavior can be swapped in,
         for instance to communicate back to a UJS process what the job status is.
 
+        Both streams are read in a single loop that sleeps in poll() until the task
+        writes something, so watching a task does not use any CPU time.
+
+        If in_process is True and the script is a Python plugin with an entry point,
+        the entry point is called in a forked child of this process, skipping the
+        interpreter startup and imports of a new process.  The output is captured
+        the same way, and the script is run as a command if it can not be loaded.
+
+        The resources used by the task are returned as metrics, see ResourceMeter.
+
         If the child process exits with an error, collect the stdout and stderr output and report in an exception.
         """
 
@@ -166,140 +991,122 @@ class TaskRunner(object):
             finally:
                 sys.exit()
 
-        # poll the pty for available data to read, then push to a queue and signal ready
-        def produce_queue(queue, master_fd, slave_fd, evt, proc):
-            with os.fdopen(master_fd, 'rb', 0) as task_stream:
-                while 1:
-                    ready = select.select([master_fd], [], [], 0)[0]
+        command_list = self._build_command_list(arguments,debug)
 
-                    # exit if our process has terminated and no more input
-                    if not ready and proc.poll() is not None:
-                        os.close(slave_fd)
-                        evt.set()
-                        break
+        function = None
+        if in_process:
+            function = load_plugin_entry_point(arguments["script_name"], entry_point, self.logger)
 
-                    if master_fd in ready:
-                        # POSIX.1 requires PIPE_BUF to be at least 512 bytes, but Linux uses 4096 bytes
-                        data = os.read(master_fd, 4096)
-
-                        if not data:
-                            # reached EOF, signal data ready in case the queue is not empty, then exit
-                            evt.set()
-                            break
-                        else:
-                            # put data in the queue and signal the consumer thread
-                            queue.put(data)
-                            evt.set()
-
-        # wait for ready signal, then read data from queue and save to a buffer
-        # once the buffer contains an end of line, send that to a callback if defined,
-        # then send the line to a file for later processing
-        def consume_queue(queue, filename, evt, proc, callback=None):
-            streambuffer = []
-            with open(filename, 'w+') as fileobj:
-                while 1:
-                    # wait for a signal at most one second at a time so we can check the child process status
-                    evt.wait(1)
-                    if queue.empty() and proc.poll() is not None:
-                        # make sure the last part of the buffer is written out
-                        if streambuffer:
-                            if callback:
-                                callback(streambuffer[0])
-
-                            fileobj.write(streambuffer[0])
-                            fileobj.flush()
-                        break
-                    elif queue.empty():
-                        # the queue is empty, but our child process has not exited yet, so data may show up still
-                        continue
+            if function is None:
+                self.logger.warning("No entry point found in {0}, running it as a command".format(arguments["script_name"]))
+
+        stdout_name = 'task_stdout_{}'.format(datetime.datetime.utcnow().isoformat())
+        stderr_name = 'task_stderr_{}'.format(datetime.datetime.utcnow().isoformat())
 
-                    data = queue.get_nowait()
-                    streambuffer.append(data)
-                    queue.task_done()
+        stdout_tail = OutputTail(self._open_spill_file(stdout_name), self.tail_lines, self.callback)
+        stderr_tail = OutputTail(self._open_spill_file(stderr_name), self.tail_lines)
 
-                    # As soon as we see an end of line from the stream, we should write.
-                    # Since we could receive many lines per queue chunk, we want to pass
-                    # a line at a time to our callback.
-                    if '\n' in data:
-                        merged = "".join(streambuffer)
-                        lines = merged.split('\n')
+        # Use pty to provide a workaround for buffer overflow in stdio when monitoring stdout,
+        # without translating newlines so the output matches what the task wrote
+        master_stdout_fd, slave_stdout_fd = pty.openpty()
 
-                        if len(lines) > 1 and '\n' not in lines[-1]:
-                            streambuffer = [lines[-1]]
-                            lines.pop()
-                        else:
-                            streambuffer = []
+        attributes = termios.tcgetattr(slave_stdout_fd)
+        attributes[1] &= ~termios.ONLCR
+        termios.tcsetattr(slave_stdout_fd, termios.TCSANOW, attributes)
 
-                        if callback:
-                            for x in lines:
-                                if not x:
-                                    continue
-                                callback(x)
+        stderr_read_fd, stderr_write_fd = os.pipe()
 
-                        fileobj.write("".join(lines))
-                        fileobj.flush()
+        meter = ResourceMeter(include_self=False)
 
-        command_list = self._build_command_list(arguments,debug)
+        try:
+            task = None
 
-        self.logger.info("Executing {0}".format(" ".join(command_list)))
+            if function is not None:
+                try:
+                    script_path = find_plugin_script(arguments["script_name"])
 
-        stdout_name = 'task_stdout_{}'.format(datetime.datetime.utcnow().isoformat())
-        stderr_name = 'task_stderr_{}'.format(datetime.datetime.utcnow().isoformat())
+                    task = ForkedTask(lambda: call_plugin_entry_point(function, script_path, command_list),
+                                      slave_stdout_fd, stderr_write_fd, [master_stdout_fd, stderr_read_fd])
 
-        stderr = open(stderr_name, 'w+')
+                    self.logger.info("Executing {0} in process".format(" ".join(command_list)))
+                except Exception, e:
+                    self.logger.warning("Unable to run {0} in process, running it as a command : {1}".format(
+                        arguments["script_name"], e))
 
-        # Use pty to provide a workaround for buffer overflow in stdio when monitoring stdout
-        master_stdout_fd, slave_stdout_fd = pty.openpty()
-        #master_stderr_fd, slave_stderr_fd = pty.openpty()
-        #task = subprocess.Popen(command_list, stdout=slave_stdout_fd, stderr=slave_stderr_fd, close_fds=True)
-        task = subprocess.Popen(command_list, stdout=slave_stdout_fd, stderr=stderr.fileno(), close_fds=True)
+            if task is None:
+                self.logger.info("Executing {0}".format(" ".join(command_list)))
+
+                task = subprocess.Popen(command_list, stdout=slave_stdout_fd, stderr=stderr_write_fd, close_fds=True)
+        finally:
+            # the child holds its own copies, so reads see the end of output when it exits
+            os.close(slave_stdout_fd)
+            os.close(stderr_write_fd)
 
         # force termination signal handling of the child process
-        signal_handler = functools.partial(cleanup, task)
+        signal_handler = functools.partial(terminate_child_process, task)
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
 
-        stdout_queue = Queue.Queue()
-        stdout_data_ready = threading.Event()
+        streams = {master_stdout_fd: stdout_tail, stderr_read_fd: stderr_tail}
 
-        t1 = threading.Thread(target=produce_queue, args=(stdout_queue, master_stdout_fd, slave_stdout_fd, stdout_data_ready, task))
-        t1.daemon = True
-        t1.start()
+        poller = select.poll()
+        for fd in streams:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
 
-        t2 = threading.Thread(target=consume_queue, args=(stdout_queue, stdout_name, stdout_data_ready, task, self.callback))
-        t2.daemon = True
-        t2.start()
-
-        #stderr_queue = Queue.Queue()
-        #stderr_data_ready = threading.Event()
-
-        #t3 = threading.Thread(target=produce_queue, args=(stderr_queue, master_stderr_fd, slave_stderr_fd, stderr_data_ready, task))
-        #t3.daemon = True
-        #t3.start()
+        try:
+            while len(streams) > 0:
+                try:
+                    events = poller.poll(1000)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
 
-        #t4 = threading.Thread(target=consume_queue, args=(stderr_queue, stderr_name, stderr_data_ready, task))
-        #t4.daemon = True
-        #t4.start()
+                if not events:
+                    # stop once the task has exited, even if a process it started holds the streams open
+                    if task.poll() is not None:
+                        break
+                    continue
+
+                for fd, event in events:
+                    try:
+                        data = os.read(fd, 65536)
+                    except OSError, e:
+                        # reading the pty after the task closed it raises EIO instead of returning EOF
+                        if e.errno != errno.EIO:
+                            raise
+                        data = None
+
+                    if data:
+                        streams[fd].feed(data)
+                    else:
+                        poller.unregister(fd)
+                        del streams[fd]
+        finally:
+            os.close(master_stdout_fd)
+            os.close(stderr_read_fd)
+
+        # the counters of the task are gone once it has been waited for
+        task_io = read_process_io(task.pid)
 
         task.wait()
 
-        t1.join()
-        t2.join()
-        #t3.join()
-        #t4.join()
-
-        stdout = open(stdout_name, 'rb')
-        #stderr = open(stderr_name, 'rb')
-        stderr.seek(0)
+        stdout_tail.finish()
+        stderr_tail.finish()
 
         task_output = {}
-        task_output["stdout"] = "".join(stdout.readlines())
-        task_output["stderr"] = "".join(stderr.readlines())
+        task_output["stdout"] = stdout_tail.getvalue()
+        task_output["stderr"] = stderr_tail.getvalue()
+
+        stdout_tail.spill_file.close()
+        stderr_tail.spill_file.close()
+
+        if self.log_directory is not None:
+            task_output["stdout_file"] = os.path.join(self.log_directory, stdout_name)
+            task_output["stderr_file"] = os.path.join(self.log_directory, stderr_name)
 
-        stdout.close()
-        stderr.close()
-        os.remove(stdout_name)
-        os.remove(stderr_name)
+        task_output["metrics"] = meter.stop(task_io)
+        self.logger.debug("Task {0} used {1}".format(arguments["script_name"], task_output["metrics"]))
 
         if task.returncode != 0:
             self.logger.error(task.returncode)
@@ -308,107 +1115,516 @@ class TaskRunner(object):
             return task_output
 
 
-def PluginManager(directory=None, logger=script_utils.stderrlogger(__file__)):
+def plugin_costs(metrics_file=JOB_METRICS_FILE):
+    """
+    Return the measured cost of each plugin from a job metrics file, as a
+    dictionary of script name to the mean seconds its transform phase took
+    and, where input sizes were recorded, its throughput in bytes per second.
+    """
+
+    try:
+        stat = os.stat(metrics_file)
+    except OSError:
+        return dict()
+
+    cached = _plugin_costs.get(metrics_file)
+
+    if cached is not None and cached[0] == (stat.st_size, stat.st_mtime):
+        return cached[1]
+
+    totals = dict()
+
+    with open(metrics_file, 'r') as f:
+        for line in f:
+            try:
+                record = simplejson.loads(line)
+                plugin = record["details"]["plugin"]
+                seconds = record["phases"]["transform"]["wall_time"]
+            except Exception:
+                continue
+
+            if record.get("status") != "completed" or plugin is None:
+                continue
+
+            total = totals.setdefault(plugin, {"jobs": 0, "seconds": 0.0, "sized_seconds": 0.0, "bytes": 0})
+            total["jobs"] += 1
+            total["seconds"] += seconds
+
+            if record["details"].get("input_bytes"):
+                total["sized_seconds"] += seconds
+                total["bytes"] += record["details"]["input_bytes"]
+
+    costs = dict()
+
+    for plugin, total in totals.items():
+        costs[plugin] = {"seconds": total["seconds"] / total["jobs"], "bytes_per_second": None}
+
+        if total["bytes"] > 0 and total["sized_seconds"] > 0:
+            costs[plugin]["bytes_per_second"] = total["bytes"] / total["sized_seconds"]
+
+    _plugin_costs[metrics_file] = ((stat.st_size, stat.st_mtime), costs)
+    return costs
+
+
+def plugin_cost(pconfig=None, costs=None, input_bytes=None):
+    """
+    Return the expected seconds for a plugin to run, from its throughput if
+    the input size is known, otherwise from its mean time.
+    """
+
+    measured = costs.get(pconfig.get("script_name"))
+
+    if measured is None:
+        return PLUGIN_DEFAULT_COST
+
+    if input_bytes and measured["bytes_per_second"]:
+        return input_bytes / measured["bytes_per_second"]
+
+    return measured["seconds"]
+
+
+def PluginManager(directory=None, logger=script_utils.stderrlogger(__file__), watch=False, metrics_file=None):
     if directory is None:
         raise Exception("Must provide a directory to read plugin configs from!")
 
-    manager = PlugIns(directory, logger)
+    manager = PlugIns(directory, logger, watch=watch, metrics_file=metrics_file)
     return manager
 
 
+def _plugin_key(pconfig=None):
+    """
+    Return the registry key of a plugin config, a tuple of the script type and
+    the types it converts from and to.
+    """
+
+    if pconfig["script_type"] == "validate":
+        return ("validate", pconfig["external_type"], None)
+    elif pconfig["script_type"] == "upload":
+        return ("upload", pconfig["external_type"], pconfig["kbase_type"])
+    elif pconfig["script_type"] == "download":
+        return ("download", pconfig["kbase_type"], pconfig["external_type"])
+    elif pconfig["script_type"] == "convert":
+        return ("convert", pconfig["source_kbase_type"], pconfig["destination_kbase_type"])
+
+    raise Exception("Unknown script_type {0}".format(pconfig["script_type"]))
+
+
 class PlugIns(object):
+    """
+    Registry of the plugin configs in a directory.
 
-    # read in all configs
-    def __init__(self, plugins_directory=None, logger=script_utils.stderrlogger(__file__)):
-        self.scripts_config = {"external_types": list(),
-                               "kbase_types": list(),
-                               "validate": dict(),
-                               "upload": dict(),
-                               "download": dict(),
-                               "convert": dict()}
+    The parsed configs are kept in an index file, which is used as long as the
+    names, sizes and modification times of the configs and the directory are
+    unchanged, or their contents hash the same, so most processes start
+    without parsing any config.  Lookups are by (script type, source type,
+    destination type).
+
+    If watch is True, the configs are reloaded when the directory changes,
+    using inotify if pyinotify is installed and otherwise by checking the
+    modification times at most every PLUGIN_RELOAD_INTERVAL seconds on lookup.
+    """
 
+    # read in all configs
+    def __init__(self, plugins_directory=None, logger=script_utils.stderrlogger(__file__),
+                 watch=False, index_directory=None, metrics_file=None):
+        self.plugins_directory = os.path.abspath(plugins_directory)
         self.logger = logger
 
-        plugins = sorted(os.listdir(plugins_directory))
-        
-        for p in plugins:
+        # job metrics that plans are costed from
+        if metrics_file is None:
+            metrics_file = JOB_METRICS_FILE
+
+        self.metrics_file = metrics_file
+
+        if index_directory is None:
+            index_directory = PLUGIN_INDEX_DIRECTORY
+
+        try:
+            os.mkdir(index_directory, 0700)
+        except OSError:
+            pass
+
+        self.index_path = os.path.join(index_directory, "transform_plugins_{0:d}_{1}.json".format(
+            os.getuid(), hashlib.sha1(self.plugins_directory).hexdigest()))
+
+        self.scripts_config = None
+        self._registry = dict()
+        self._graph = dict()
+        self._fingerprint = None
+        self._lock = threading.Lock()
+        self._poll = False
+        self._last_check = time.time()
+        self._notifier = None
+
+        self.load()
+
+        if watch:
+            self.watch()
+
+
+    def _directory_fingerprint(self):
+        files = list()
+
+        for p in sorted(os.listdir(self.plugins_directory)):
+            stat = os.stat(os.path.join(self.plugins_directory, p))
+            files.append([p, stat.st_size, stat.st_mtime])
+
+        return {"mtime": os.stat(self.plugins_directory).st_mtime, "files": files}
+
+
+    def _trusted(self, info):
+        return info.st_uid == os.getuid() and not info.st_mode & 0022
+
+
+    def _read_index(self):
+        try:
+            if not self._trusted(os.lstat(os.path.dirname(self.index_path))):
+                self.logger.warning("Ignoring plugin index in {0}, other users can write there".format(
+                    os.path.dirname(self.index_path)))
+                return None
+
+            fd = os.open(self.index_path, os.O_RDONLY | os.O_NOFOLLOW)
+
+            with os.fdopen(fd, 'r') as f:
+                if not self._trusted(os.fstat(fd)):
+                    self.logger.warning("Ignoring plugin index {0}, it is not a private file of this user".format(
+                        self.index_path))
+                    return None
+
+                index = simplejson.loads(f.read())
+
+            if index.get("version") == PLUGIN_INDEX_VERSION and index.get("directory") == self.plugins_directory:
+                return index
+        except Exception:
+            pass
+
+        return None
+
+
+    def _write_index(self, index):
+        temp_path = "{0}.{1:d}.tmp".format(self.index_path, os.getpid())
+
+        try:
+            if not self._trusted(os.lstat(os.path.dirname(self.index_path))):
+                return
+
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0600)
+
+            with os.fdopen(fd, 'w') as f:
+                f.write(simplejson.dumps(index))
+
+            os.rename(temp_path, self.index_path)
+        except Exception, e:
+            self.logger.debug("Unable to write plugin index {0} : {1}".format(self.index_path, e))
+
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+    def _parse_configs(self, contents):
+        configs = list()
+
+        for p, text in contents:
+            if isinstance(text, Exception):
+                configs.append({"name": p, "error": str(text)})
+                continue
+
             try:
-                f = open(os.path.join(plugins_directory, p), 'r')
-                pconfig = simplejson.loads(f.read())
-                f.close()
-
-                id = None
-                
-                if pconfig["script_type"] == "validate":
-                    if pconfig["external_type"] not in self.scripts_config["external_types"]:
-                        self.scripts_config["external_types"].append(pconfig["external_type"])
-                    
-                    id = pconfig["external_type"]
-                elif pconfig["script_type"] == "upload":
-                    if pconfig["external_type"] not in self.scripts_config["external_types"]:
-                        self.scripts_config["external_types"].append(pconfig["external_type"])
-                    
-                    if pconfig["kbase_type"] not in self.scripts_config["kbase_types"]:
-                        self.scripts_config["kbase_types"].append(pconfig["kbase_type"])
-                    
-                    id = "{0}=>{1}".format(pconfig["external_type"],pconfig["kbase_type"])
-                elif pconfig["script_type"] == "download":
-                    if pconfig["external_type"] not in self.scripts_config["external_types"]:
-                        self.scripts_config["external_types"].append(pconfig["external_type"])
-                    
-                    if pconfig["kbase_type"] not in self.scripts_config["kbase_types"]:
-                        self.scripts_config["kbase_types"].append(pconfig["kbase_type"])
-                    
-                    id = "{0}=>{1}".format(pconfig["kbase_type"],pconfig["external_type"])
-                elif pconfig["script_type"] == "convert":
-                    if pconfig["source_kbase_type"] not in self.scripts_config["kbase_types"]:
-                        self.scripts_config["kbase_types"].append(pconfig["source_kbase_type"])
-                    
-                    if pconfig["destination_kbase_type"] not in self.scripts_config["kbase_types"]:
-                        self.scripts_config["kbase_types"].append(pconfig["destination_kbase_type"])
-                    
-                    id = "{0}=>{1}".format(pconfig["source_kbase_type"],pconfig["destination_kbase_type"])
-
-                self.scripts_config[pconfig["script_type"]][id] = pconfig
-
-                self.logger.info("Successfully added plugin {0}".format(p))
+                pconfig = simplejson.loads(text)
+                _plugin_key(pconfig)
+
+                configs.append({"name": p, "config": pconfig})
             except Exception, e:
-                self.logger.warning("Unable to read plugin {0}: {1}".format(p,e.message))
+                configs.append({"name": p, "error": str(e)})
+
+        return configs
+
+
+    def _compile(self, configs):
+        graph = dict()
+        scripts_config = {"external_types": list(),
+                          "kbase_types": list(),
+                          "validate": dict(),
+                          "upload": dict(),
+                          "download": dict(),
+                          "convert": dict()}
+        registry = dict()
+
+        for x in configs:
+            if "error" in x:
+                self.logger.warning("Unable to read plugin {0}: {1}".format(x["name"], x["error"]))
+                continue
+
+            pconfig = x["config"]
+            key = _plugin_key(pconfig)
+
+            if key[0] == "convert":
+                types = {"kbase_types": [key[1], key[2]]}
+            elif key[0] == "validate":
+                types = {"external_types": [key[1]]}
+            else:
+                types = {"external_types": [pconfig["external_type"]], "kbase_types": [pconfig["kbase_type"]]}
+
+            for k in types:
+                for t in types[k]:
+                    if t not in scripts_config[k]:
+                        scripts_config[k].append(t)
+
+            if key[2] is None:
+                id = key[1]
+            else:
+                id = "{0}=>{1}".format(key[1], key[2])
+
+            scripts_config[key[0]][id] = pconfig
+            registry[key] = pconfig
+
+            if key[0] != "validate":
+                graph.setdefault(key[1], list()).append((key[2], pconfig))
+
+            self.logger.debug("Successfully added plugin {0}".format(x["name"]))
+
+        return scripts_config, registry, graph
+
+
+    def load(self):
+        """
+        Load the plugin configs, from the index if it is still valid.
+        """
+
+        fingerprint = self._directory_fingerprint()
+
+        # another registry in this process already has these configs
+        cached = _plugin_registries.get(self.plugins_directory)
+
+        if cached is not None and cached[0] == fingerprint:
+            with self._lock:
+                self.scripts_config, self._registry, self._graph = cached[1:]
+                self._fingerprint = fingerprint
+            return
+
+        index = self._read_index()
+
+        if index is not None and index["fingerprint"] == fingerprint:
+            configs = index["configs"]
+        else:
+            contents = list()
+            for p in [x[0] for x in fingerprint["files"]]:
+                try:
+                    with open(os.path.join(self.plugins_directory, p), 'r') as f:
+                        contents.append((p, f.read()))
+                except IOError, e:
+                    contents.append((p, e))
+
+            content_hash = hashlib.sha1(simplejson.dumps([(p, str(x)) for p, x in contents])).hexdigest()
+
+            if index is not None and index["content_hash"] == content_hash:
+                configs = index["configs"]
+            else:
+                configs = self._parse_configs(contents)
+                self.logger.info("Read {0:d} plugin configs from {1}".format(len(configs), self.plugins_directory))
+
+            self._write_index({"version": PLUGIN_INDEX_VERSION,
+                               "directory": self.plugins_directory,
+                               "fingerprint": fingerprint,
+                               "content_hash": content_hash,
+                               "configs": configs})
+
+        scripts_config, registry, graph = self._compile(configs)
+
+        _plugin_registries[self.plugins_directory] = (fingerprint, scripts_config, registry, graph)
+
+        with self._lock:
+            self.scripts_config = scripts_config
+            self._registry = registry
+            self._graph = graph
+            self._fingerprint = fingerprint
+
+
+    def reload_if_changed(self):
+        """
+        Reload the plugin configs if the directory has changed since they were loaded.
+        """
+
+        try:
+            if self._directory_fingerprint() != self._fingerprint:
+                self.logger.info("Plugin configs in {0} changed, reloading".format(self.plugins_directory))
+                self.load()
+        except Exception, e:
+            self.logger.exception(e)
+
+
+    def watch(self):
+        """
+        Reload the plugin configs when they change, see the class description.
+        """
+
+        try:
+            import pyinotify
+        except ImportError:
+            self._poll = True
+            return
+
+        registry = self
+
+        class _ReloadHandler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                registry.reload_if_changed()
+
+        watch_manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(watch_manager, _ReloadHandler())
+        self._notifier.daemon = True
+        self._notifier.start()
 
+        watch_manager.add_watch(self.plugins_directory,
+                                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM |
+                                pyinotify.IN_CREATE | pyinotify.IN_DELETE)
+
+
+    def _check_reload(self):
+        if self._poll and time.time() - self._last_check > PLUGIN_RELOAD_INTERVAL:
+            self._last_check = time.time()
+            self.reload_if_changed()
+
+
+    def get_plugin(self, script_type=None, source_type=None, destination_type=None):
+        """
+        Return the config of the plugin for a script type and the types it
+        converts from and to, or None if there is no such plugin.
+        """
+
+        self._check_reload()
+
+        with self._lock:
+            return self._registry.get((script_type, source_type, destination_type))
+
+
+    def plan(self, method=None, source_type=None, destination_type=None, input_bytes=None, costs=None):
+        """
+        Find the cheapest chain of plugins for a method between two types, or
+        None if there is none.  An upload is an upload plugin followed by any
+        convert plugins, a download is any convert plugins followed by a
+        download plugin, and a convert is convert plugins only.
+
+        A single plugin between the types is always used when there is one.
+        Otherwise each plugin costs its expected time for input_bytes from
+        the job metrics, see plugin_cost(), and each intermediate object adds
+        PLUGIN_HOP_COST.  input_bytes can be a function, which is only called
+        if there is a choice of chains.
+        """
+
+        self._check_reload()
+
+        with self._lock:
+            graph = self._graph
+
+        def allowed(script_type, hops):
+            if method == "upload":
+                return script_type == ("upload" if hops == 0 else "convert")
+            elif method == "download":
+                return script_type in ["convert", "download"]
+
+            return script_type == "convert"
+
+        def complete(path):
+            if method == "download":
+                return path[-1]["script_type"] == "download"
+
+            return True
+
+        # measured or not, one plugin beats a chain that saves intermediate objects
+        for next_node, pconfig in graph.get(source_type, list()):
+            if next_node == destination_type and allowed(pconfig["script_type"], 0) and complete([pconfig]):
+                return [pconfig]
+
+        if costs is None:
+            costs = plugin_costs(self.metrics_file)
+
+        if callable(input_bytes):
+            input_bytes = input_bytes()
+
+        counter = 0
+        queue = [(0, counter, source_type, list())]
+        done = set()
+
+        while len(queue) > 0:
+            cost, ignored, node, path = heapq.heappop(queue)
+
+            if node == destination_type and len(path) > 0 and complete(path):
+                if len(path) > 1:
+                    self.logger.info("Planned {0} from {1} to {2} through {3}".format(
+                        method, source_type, destination_type, " => ".join([x["script_name"] for x in path])))
+
+                return path
+
+            if (node, len(path) > 0) in done or len(path) >= PLAN_MAX_HOPS:
+                continue
+
+            done.add((node, len(path) > 0))
+
+            # a download ends at an external type
+            if len(path) > 0 and path[-1]["script_type"] == "download":
+                continue
+
+            for next_node, pconfig in graph.get(node, list()):
+                if not allowed(pconfig["script_type"], len(path)):
+                    continue
+
+                step_cost = plugin_cost(pconfig, costs, input_bytes)
+
+                if len(path) > 0:
+                    step_cost += PLUGIN_HOP_COST
+
+                counter += 1
+                heapq.heappush(queue, (cost + step_cost, counter, next_node, path + [pconfig]))
+
+        return None
+
+
+    def get_job_details(self, method, args, input_bytes=None):
+        """
+        Return the plugin configs for a job.  If the cheapest way between the
+        types is a chain of plugins, transform is the upload or download plugin
+        of the chain, or the first convert plugin, and convert_chain lists the
+        convert plugins that run before a download or after the others.
+
+        input_bytes is the size of the input, or a function returning it, that
+        chains are costed for, see plan().
+        """
 
-    def get_job_details(self, method, args):
         job_details = dict()        
 
         if method == "upload":
-            if self.scripts_config["validate"].has_key(args["external_type"]):
-                plugin_key = args["external_type"]
-                
-                job_details["validate"] = self.scripts_config["validate"][plugin_key]
+            validate = self.get_plugin("validate", args["external_type"])
+            
+            if validate is not None:
+                job_details["validate"] = validate
             else:
                 self.logger.warning("No validation available for {0}".format(args["external_type"]))
 
-            if self.scripts_config["upload"].has_key("{0}=>{1}".format(args["external_type"],args["kbase_type"])):
-                plugin_key = "{0}=>{1}".format(args["external_type"],args["kbase_type"])
-            
-                job_details["transform"] = self.scripts_config["upload"][plugin_key]
-            else:
-                raise Exception("No conversion available for {0} => {1}".format(args["external_type"],args["kbase_type"]))
+            source_type, destination_type = args["external_type"], args["kbase_type"]
         elif method == "download":
-            if self.scripts_config["download"].has_key("{0}=>{1}".format(args["kbase_type"],args["external_type"])):
-                plugin_key = "{0}=>{1}".format(args["kbase_type"],args["external_type"])
-            
-                job_details["transform"] = self.scripts_config["download"][plugin_key]
-            else:
-                raise Exception("No conversion available for {0} => {1}".format(args["kbase_type"],args["external_type"]))
+            source_type, destination_type = args["kbase_type"], args["external_type"]
         elif method == "convert":
-            if self.scripts_config["convert"].has_key("{0}=>{1}".format(args["source_kbase_type"],args["destination_kbase_type"])):
-                plugin_key = "{0}=>{1}".format(args["source_kbase_type"],args["destination_kbase_type"])
-            
-                job_details["transform"] = self.scripts_config["convert"][plugin_key]
-            else:
-                raise Exception("No conversion available for {0} => {1}".format(args["source_kbase_type"],args["destination_kbase_type"]))
+            source_type, destination_type = args["source_kbase_type"], args["destination_kbase_type"]
         else:
             raise Exception("Unknown method {0}".format(method))
-        
-        return job_details
 
+        path = self.plan(method, source_type, destination_type, input_bytes)
+
+        if path is None:
+            raise Exception("No conversion available for {0} => {1}".format(source_type, destination_type))
+
+        if method == "download":
+            job_details["transform"] = path[-1]
+            chain = path[:-1]
+        else:
+            job_details["transform"] = path[0]
+            chain = path[1:]
+
+        if len(chain) > 0:
+            job_details["convert_chain"] = chain
+
+        return job_details
@@ -0,0 +1,369 @@
+"""
+Provides a content addressed cache of input files shared by all taskrunner jobs
+on a worker, so that a SHOCK node fetched by one job is not downloaded again
+by the next one that needs it.
+
+Entries are keyed by SHOCK node id and the MD5 from the node metadata, the
+cache is bounded in size with least recently used eviction, and files are
+hardlinked (or reflinked) into the job working directory instead of copied.
+All cache state is guarded by file locks so separate jobs can use the cache
+at the same time.  A missing entry is downloaded to a partial file of its own
+that only jobs waiting for the same entry block on, and the entry locks are
+held just to look entries up and to publish them.
+"""
+
+import os
+import io
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import subprocess
+import contextlib
+
+import simplejson
+
+from biokbase.Transform import segmented_download
+
+
+# environment variables used to configure the cache on a worker
+CACHE_DIRECTORY_ENV = "KB_TRANSFORM_INPUT_CACHE"
+CACHE_SIZE_ENV = "KB_TRANSFORM_INPUT_CACHE_SIZE"
+
+DEFAULT_MAX_SIZE = 100 * 2**30
+
+# number of lock files that entries are spread over
+LOCK_STRIPES = 256
+
+
+def get_default_cache(logger=None):
+    """
+    Return the InputCache configured for this worker in the environment, or
+    None if no cache directory has been configured.
+    """
+
+    cache_directory = os.environ.get(CACHE_DIRECTORY_ENV)
+
+    if not cache_directory:
+        return None
+
+    max_size = int(os.environ.get(CACHE_SIZE_ENV, DEFAULT_MAX_SIZE))
+
+    return InputCache(cache_directory, max_size, logger)
+
+
+def make_key(shock_id=None, md5=None):
+    """
+    Build the cache key for a SHOCK node.
+    """
+
+    if shock_id is None or md5 is None:
+        raise Exception("A SHOCK node id and MD5 are required for a cache key!")
+
+    return "{0}_{1}".format(shock_id, md5)
+
+
+def file_md5(filePath=None, chunkSize=2**22):
+    """
+    Compute the MD5 hex digest of a file in chunks.
+    """
+
+    digest = hashlib.md5()
+
+    with io.open(filePath, 'rb') as f:
+        while 1:
+            chunk = f.read(chunkSize)
+
+            if not chunk:
+                break
+
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def locked(lock_path=None, blocking=True):
+    """
+    Hold an exclusive flock on lock_path for the duration of a with block.
+    If blocking is False and the lock is held elsewhere, IOError is raised
+    with errno EWOULDBLOCK.
+    """
+
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0664)
+
+    try:
+        flags = fcntl.LOCK_EX
+
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+
+        fcntl.flock(fd, flags)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _claim(path=None):
+    """
+    Create path if needed and hold an exclusive flock on it, returning the
+    open descriptor.  The lock is taken again if path was replaced while
+    waiting, so the holder always has the lock of the file at path.
+    """
+
+    while 1:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                return fd
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                os.close(fd)
+                raise
+
+        os.close(fd)
+
+
+class InputCache(object):
+    """
+    Size bounded LRU cache of downloaded input files.
+    """
+
+    def __init__(self, cache_directory=None, max_size=DEFAULT_MAX_SIZE, logger=None):
+        if cache_directory is None:
+            raise Exception("A cache directory is required!")
+
+        self.cache_directory = cache_directory
+        self.max_size = max_size
+        self.logger = logger
+
+        self._data_directory = os.path.join(cache_directory, "data")
+        self._lock_directory = os.path.join(cache_directory, "locks")
+        self._index_path = os.path.join(cache_directory, "index.json")
+        self._index_lock = os.path.join(cache_directory, "index.lock")
+
+        for d in [cache_directory, self._data_directory, self._lock_directory]:
+            try:
+                os.makedirs(d)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # counts for this process only, the index keeps totals across jobs
+        self.hits = 0
+        self.misses = 0
+
+
+    def _entry_path(self, key):
+        return os.path.join(self._data_directory, key)
+
+
+    def _entry_lock(self, key):
+        stripe = int(hashlib.sha1(key).hexdigest(), 16) % LOCK_STRIPES
+        return os.path.join(self._lock_directory, "{0:03d}.lock".format(stripe))
+
+
+    def _read_index(self):
+        if not os.path.exists(self._index_path):
+            return {"entries": dict(), "stats": {"hits": 0, "misses": 0, "evictions": 0}}
+
+        with open(self._index_path, 'r') as f:
+            return simplejson.loads(f.read())
+
+
+    def _write_index(self, index):
+        temp_path = self._index_path + ".{0:d}".format(os.getpid())
+
+        with open(temp_path, 'w') as f:
+            f.write(simplejson.dumps(index))
+
+        os.rename(temp_path, self._index_path)
+
+
+    def _record(self, key, size, hit):
+        with locked(self._index_lock):
+            index = self._read_index()
+
+            if hit:
+                index["stats"]["hits"] += 1
+            else:
+                index["stats"]["misses"] += 1
+
+            index["entries"][key] = {"size": size, "last_access": time.time()}
+
+            self._write_index(index)
+
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+
+    def _materialize(self, entry_path, destination):
+        """
+        Place a cached file at destination, preferring a hardlink, then a
+        reflink copy, then a regular copy.
+        """
+
+        try:
+            os.link(entry_path, destination)
+            return
+        except OSError:
+            pass
+
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(["cp", "--reflink=always", entry_path, destination],
+                               stdout=devnull, stderr=devnull) == 0:
+                return
+
+        shutil.copyfile(entry_path, destination)
+
+
+    def _hit(self, key, destination):
+        # called holding the entry lock
+        entry_path = self._entry_path(key)
+
+        if not os.path.exists(entry_path):
+            return False
+
+        self._materialize(entry_path, destination)
+        self._record(key, os.path.getsize(entry_path), True)
+
+        if self.logger is not None:
+            self.logger.info("Input cache hit for {0}".format(key))
+
+        return True
+
+
+    def fetch(self, key=None, destination=None, populate=None, md5=None):
+        """
+        Place the file cached under key at destination.  On a miss, populate is
+        called with a path inside the cache to download the file to, and may
+        return the MD5 it computed while writing; the file is verified against
+        md5 before it is added to the cache.  Jobs that miss the same key at
+        the same time wait for the first one and then use its download.
+
+        Returns True for a cache hit and False for a miss.
+        """
+
+        entry_path = self._entry_path(key)
+        partial_path = entry_path + ".partial"
+
+        with locked(self._entry_lock(key)):
+            if self._hit(key, destination):
+                return True
+
+        # only jobs fetching this key wait on the partial file
+        fd = _claim(partial_path)
+
+        try:
+            with locked(self._entry_lock(key)):
+                if self._hit(key, destination):
+                    if not os.path.exists(partial_path + segmented_download.CHECKPOINT_SUFFIX):
+                        os.remove(partial_path)
+
+                    return True
+
+            if self.logger is not None:
+                self.logger.info("Input cache miss for {0}".format(key))
+
+            try:
+                computed_md5 = populate(partial_path)
+
+                if md5 is not None:
+                    if computed_md5 is None:
+                        computed_md5 = file_md5(partial_path)
+
+                    if computed_md5 != md5:
+                        raise Exception("MD5 mismatch for {0}, expected {1} and found {2}".format(key, md5, computed_md5))
+
+                # cached files are shared by hardlinks, so guard against in place writes
+                os.chmod(partial_path, 0444)
+
+                with locked(self._entry_lock(key)):
+                    os.rename(partial_path, entry_path)
+
+                    self._materialize(entry_path, destination)
+                    self._record(key, os.path.getsize(entry_path), False)
+            except:
+                # keep a partial download that the next attempt can resume
+                if os.path.exists(partial_path) and \
+                   not os.path.exists(partial_path + segmented_download.CHECKPOINT_SUFFIX):
+                    os.remove(partial_path)
+                raise
+        finally:
+            os.close(fd)
+
+        self.evict()
+
+        return False
+
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_size.
+        Entries that another job is currently fetching are skipped.
+        """
+
+        with locked(self._index_lock):
+            index = self._read_index()
+
+            total = sum([x["size"] for x in index["entries"].values()])
+
+            if total <= self.max_size:
+                return
+
+            for key, entry in sorted(index["entries"].items(), key=lambda x: x[1]["last_access"]):
+                if total <= self.max_size:
+                    break
+
+                try:
+                    with locked(self._entry_lock(key), blocking=False):
+                        entry_path = self._entry_path(key)
+
+                        if os.path.exists(entry_path):
+                            os.remove(entry_path)
+                except IOError, e:
+                    if e.errno in [errno.EWOULDBLOCK, errno.EAGAIN]:
+                        continue
+                    raise
+
+                total -= entry["size"]
+                del index["entries"][key]
+                index["stats"]["evictions"] += 1
+
+                if self.logger is not None:
+                    self.logger.info("Evicted {0} from the input cache".format(key))
+
+            self._write_index(index)
+
+
+    def stats(self):
+        """
+        Return hit and miss counts for this process along with the totals and
+        current size of the shared cache.
+        """
+
+        with locked(self._index_lock):
+            index = self._read_index()
+
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "total_hits": index["stats"]["hits"],
+                "total_misses": index["stats"]["misses"],
+                "total_evictions": index["stats"]["evictions"],
+                "entries": len(index["entries"]),
+                "size": sum([x["size"] for x in index["entries"].values()]),
+                "max_size": self.max_size}
+
+
+    def log_stats(self, logger=None):
+        if logger is None:
+            logger = self.logger
+
+        if logger is not None:
+            logger.info("Input cache stats : {0}".format(simplejson.dumps(self.stats(), sort_keys=True)))
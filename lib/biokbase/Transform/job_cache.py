@@ -0,0 +1,378 @@
+"""
+Provides a cache of Transform job results, so that a job that was already
+run for the same input is answered from its result instead of being run again.
+
+A job is keyed by its method, the plugins that would run it, its optional
+arguments and the identity of its input: the MD5 of a SHOCK node, the ETag of
+a URL, or the reference with version of a workspace object.  Plugin configs
+and scripts are part of the key, so changing a plugin invalidates the results
+it produced.  Entries are kept in a SQLite database on the service host.
+"""
+
+import re
+import time
+import sqlite3
+import hashlib
+import datetime
+import threading
+
+import simplejson
+
+from biokbase.Transform import handler_utils
+from biokbase.Transform import transport
+
+
+# results older than this are not reused, in seconds
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+
+SHOCK_URL = re.compile('^(https?://.*)/node/([a-fA-F0-9\-]+)')
+
+VERSIONED_REF = re.compile('^\d+/\d+/\d+$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    method TEXT NOT NULL,
+    types TEXT NOT NULL,
+    plugin_hash TEXT NOT NULL,
+    user_id TEXT,
+    awe_id TEXT,
+    ujs_id TEXT,
+    destination TEXT,
+    result TEXT,
+    created REAL NOT NULL
+)
+"""
+
+
+def plugin_hash(job_details=None):
+    """
+    Hash the plugin configs of a job and the scripts they name, where the
+    scripts can be found on this host.
+    """
+
+    digest = hashlib.sha1(simplejson.dumps(job_details, sort_keys=True))
+
+    plugins = [job_details.get("validate"), job_details.get("transform")] + job_details.get("convert_chain", list())
+
+    for plugin in plugins:
+        if plugin is None:
+            continue
+
+        path = handler_utils.find_plugin_script(plugin.get("script_name"))
+
+        if path is not None:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def cacheable(method=None, job_details=None):
+    """
+    Whether the results of a job can be reused.  A result is copied as the
+    version of the one object the taskrunner saved, taken from its save reply,
+    so jobs with a plugin that saves its own objects are never reused, since
+    which versions they made is not known.  Convert plugins always save their
+    own objects.  The handler_options job_cache can turn reuse off for any
+    plugin.
+    """
+
+    plugins = [job_details.get("validate"), job_details.get("transform")] + job_details.get("convert_chain", list())
+
+    for plugin in plugins:
+        if plugin is None:
+            continue
+
+        handler_options = plugin.get("handler_options", dict())
+
+        if not handler_options.get("job_cache", True):
+            return False
+        elif method == "download" or plugin is job_details.get("validate"):
+            # downloads only make a SHOCK node and validation saves nothing
+            continue
+        elif method == "convert" or plugin is not job_details.get("transform") or \
+             handler_options.get("must_own_saving_to_workspace", False):
+            return False
+
+    return True
+
+
+def url_identity(url=None, token=None):
+    """
+    Identify the contents of a url without downloading it, from the MD5 of a
+    SHOCK node or the ETag or modification time of an HTTP resource.
+    Returns None if the contents can not be identified.
+    """
+
+    header = dict()
+
+    if token is not None:
+        header["Authorization"] = "Oauth {0}".format(token)
+
+    shock = SHOCK_URL.match(url)
+
+    if shock is not None:
+        response = transport.get("{0}/node/{1}?verbosity=metadata".format(shock.group(1), shock.group(2)),
+                                 headers=header, verify=True)
+
+        if not response.ok:
+            return None
+
+        md5 = response.json()["data"]["file"].get("checksum", dict()).get("md5")
+
+        if md5 is None:
+            return None
+
+        return "md5:" + md5
+
+    if not url.startswith("http://") and not url.startswith("https://"):
+        return None
+
+    response = transport.request("HEAD", url, allow_redirects=True, verify=True)
+
+    if not response.ok:
+        return None
+
+    if response.headers.get("etag"):
+        return "{0} etag:{1}".format(response.url, response.headers["etag"])
+
+    if response.headers.get("last-modified") and response.headers.get("content-length"):
+        return "{0} modified:{1} size:{2}".format(response.url, response.headers["last-modified"],
+                                                  response.headers["content-length"])
+
+    return None
+
+
+def object_identity(workspace_service_url=None, token=None, workspace_name=None, object_name=None, object_id=None):
+    """
+    Identify a workspace object by its reference with version.
+    """
+
+    from biokbase.workspace.client import Workspace
+
+    object_info = {"workspace": workspace_name}
+
+    if object_id:
+        object_info["objid"] = object_id
+    else:
+        object_info["name"] = object_name
+
+    info = Workspace(url=workspace_service_url, token=token).get_object_info_new({"objects": [object_info]})[0]
+
+    return "ws:{0}/{1}/{2}".format(info[6], info[0], info[4])
+
+
+def input_identity(method=None, args=None, config=None, token=None):
+    """
+    Identify the input of a job, or return None if it can not be identified.
+    """
+
+    if method == "upload":
+        url_mapping = args.get("url_mapping")
+
+        if not url_mapping:
+            return None
+
+        identities = list()
+
+        for name in sorted(url_mapping):
+            identity = url_identity(url_mapping[name], token)
+
+            if identity is None:
+                return None
+
+            identities.append([name, identity])
+
+        return identities
+    elif method == "download":
+        return object_identity(config["workspace_service_url"], token, args.get("workspace_name"),
+                               args.get("object_name"), args.get("object_id"))
+    elif method == "convert":
+        return object_identity(config["workspace_service_url"], token, args.get("source_workspace_name"),
+                               args.get("source_object_name"), args.get("source_object_id"))
+
+    return None
+
+
+def destination(method=None, args=None):
+    """
+    The workspace object a job writes, or None for a download.
+    """
+
+    if method == "upload":
+        return [args.get("workspace_name"), args.get("object_name")]
+    elif method == "convert":
+        return [args.get("destination_workspace_name"), args.get("destination_object_name")]
+
+    return None
+
+
+def clone_results(method=None, args=None, results=None, owner=False, config=None, token=None):
+    """
+    Make the results of an earlier job the results of a new job with args,
+    copying the version of the workspace object it made, given by the ref of
+    its result, to the new destination, or copying the SHOCK node it made if
+    the new job is for another user.  Raises an exception if the result can
+    not be reused.
+    """
+
+    results = simplejson.loads(simplejson.dumps(results))
+    result = results["results"][0]
+
+    if method == "download":
+        if owner:
+            return results
+
+        shock_service_url = config["shock_service_url"].rstrip("/")
+
+        response = transport.post("{0}/node".format(shock_service_url),
+                                  headers={"Authorization": "Oauth {0}".format(token)},
+                                  files={"copy_data": (None, result["id"])}, verify=True,
+                                  timeout=transport.LONG_TIMEOUT)
+        response.raise_for_status()
+
+        shock_id = response.json()["data"]["id"]
+        shock_url = "{0}/node/{1}?download_raw".format(shock_service_url, shock_id)
+
+        results["shocknodes"] = [shock_url]
+        result["id"] = shock_id
+        result["url"] = shock_url
+
+        return results
+
+    # results of jobs whose objects a plugin saved do not say which version was made
+    if not VERSIONED_REF.match(result.get("ref", "")):
+        raise Exception("Result {0} has no versioned reference".format(result["id"]))
+
+    from biokbase.workspace.client import Workspace
+
+    workspace = Workspace(url=config["workspace_service_url"], token=token)
+    workspace_name, object_name = destination(method, args)
+
+    result["id"] = "{0}/{1}".format(workspace_name, object_name)
+
+    # nothing to do if the destination still holds the version that was made
+    info = workspace.get_object_info_new({"objects": [{"workspace": workspace_name, "name": object_name}],
+                                          "ignoreErrors": 1})[0]
+
+    if info is not None and "{0}/{1}/{2}".format(info[6], info[0], info[4]) == result["ref"]:
+        return results
+
+    info = workspace.copy_object({"from": {"ref": result["ref"]},
+                                  "to": {"workspace": workspace_name, "name": object_name}})
+
+    result["ref"] = "{0}/{1}/{2}".format(info[6], info[0], info[4])
+
+    return results
+
+
+def complete_job(ujs_service_url=None, token=None, description=None, results=None):
+    """
+    Create a UJS job that is already complete with results, for a job that
+    was answered from the cache, and return its id.
+    """
+
+    from biokbase.userandjobstate.client import UserAndJobState
+
+    ujs = UserAndJobState(url=ujs_service_url, token=token)
+
+    estimated_running_time = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+    ujs_job_id = ujs.create_and_start_job(token, "Starting", description,
+                                          {"ptype": "none"},
+                                          estimated_running_time.strftime("%Y-%m-%dT%H:%M:%S+0000"))
+    ujs.complete_job(ujs_job_id, token, "{0} completed from an earlier job".format(description), None, results)
+
+    return ujs_job_id
+
+
+def make_key(method=None, types=None, plugins=None, optional_arguments=None, identity=None):
+    """
+    Build the cache key of a job.  Optional arguments that are empty are left
+    out so that they match a job that did not give them.
+    """
+
+    if optional_arguments is None:
+        optional_arguments = dict()
+
+    options = dict([(k, v) for k, v in optional_arguments.items() if v not in [None, dict(), list(), ""]])
+
+    return hashlib.sha1(simplejson.dumps([method, list(types), plugins, options, identity],
+                                         sort_keys=True)).hexdigest()
+
+
+class JobCache(object):
+    """
+    SQLite backed store of job keys, the jobs started for them and their
+    results once they are known.  Safe to share between threads.
+    """
+
+    def __init__(self, path=None, max_age=DEFAULT_MAX_AGE, logger=None):
+        if path is None:
+            raise Exception("Must provide a path for the job cache!")
+
+        self.path = path
+        self.max_age = max_age
+        self.logger = logger
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+
+        with self._lock:
+            self._connection.execute(SCHEMA)
+            self._connection.commit()
+
+
+    def lookup(self, key=None):
+        """
+        Return the entry for a key as a dictionary, or None if there is no
+        entry recent enough to use.
+        """
+
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM jobs WHERE key = ? AND created > ?",
+                                           (key, time.time() - self.max_age)).fetchone()
+
+        if row is None:
+            return None
+
+        entry = dict(zip(row.keys(), row))
+
+        for x in ["destination", "result"]:
+            if entry[x] is not None:
+                entry[x] = simplejson.loads(entry[x])
+
+        return entry
+
+
+    def record(self, key=None, method=None, types=None, plugins=None, user_id=None,
+               job_ids=None, destination=None):
+        """
+        Store the job started for a key, replacing any earlier entry, and drop
+        the entries for the same method and types made by other plugins.
+        """
+
+        with self._lock:
+            self._connection.execute("DELETE FROM jobs WHERE (method = ? AND types = ? AND plugin_hash != ?) OR created < ?",
+                                     (method, simplejson.dumps(list(types)), plugins, time.time() - self.max_age))
+            self._connection.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, ?)",
+                                     (key, method, simplejson.dumps(list(types)), plugins, user_id,
+                                      job_ids[0], job_ids[1], simplejson.dumps(destination), time.time()))
+            self._connection.commit()
+
+
+    def resolve(self, key=None, result=None):
+        """
+        Store the result of the job for a key.
+        """
+
+        with self._lock:
+            self._connection.execute("UPDATE jobs SET result = ? WHERE key = ?", (simplejson.dumps(result), key))
+            self._connection.commit()
+
+
+    def forget(self, key=None):
+        with self._lock:
+            self._connection.execute("DELETE FROM jobs WHERE key = ?", (key,))
+            self._connection.commit()
@@ -0,0 +1,454 @@
+"""
+Provides scratch space management for taskrunner working directories.
+
+Each job reserves the space it expects to use, the size of its input times the
+expansion factor its plugin declares, in a ledger shared by every job on the
+host, so a job that would fill the disk fails before it starts writing.  Small
+jobs are given a working directory on tmpfs when one is available.  When a job
+ends its working directory is renamed into a trash directory next to it, which
+takes the same time for any size of directory, and the trash is removed by a
+background thread of this or a later job.
+"""
+
+import os
+import time
+import stat
+import errno
+import fcntl
+import shutil
+import threading
+import contextlib
+import tempfile
+import uuid
+
+import simplejson
+
+
+# JSON file holding the reservations of all jobs of this user on the host, kept
+# in a directory only this user can read since trash listed in it is removed
+SCRATCH_LEDGER = os.environ.get("KB_TRANSFORM_SCRATCH_LEDGER",
+                                os.path.join(tempfile.gettempdir(),
+                                             "transform_scratch_{0:d}".format(os.getuid()),
+                                             "ledger.json"))
+
+# tmpfs mount that small jobs are run in, none if it is not a tmpfs mount
+TMPFS_DIRECTORY = os.environ.get("KB_TRANSFORM_TMPFS_DIR", "/dev/shm")
+
+# largest reservation that is placed on tmpfs
+TMPFS_MAX_JOB_SIZE = 2**28
+
+# scratch bytes per input byte for plugins that do not declare scratch_expansion
+DEFAULT_EXPANSION = 4
+
+TRASH_DIRECTORY = ".transform_trash"
+
+# seconds between purges of the trash by a long running process
+PURGE_INTERVAL = 60
+
+# seconds the measured disk usage of a reservation is reused before its
+# directory is walked again
+USAGE_MAX_AGE = 60
+
+# the purge thread of this process, if one was started
+_purge_thread = None
+_purge_lock = threading.Lock()
+
+
+def estimate_size(plugin_config=None, input_bytes=0):
+    """
+    Scratch space a job is expected to need, from the size of its input and
+    the handler_options scratch_expansion of its plugin.
+    """
+
+    if plugin_config is None:
+        plugin_config = dict()
+
+    expansion = plugin_config.get("handler_options", dict()).get("scratch_expansion", DEFAULT_EXPANSION)
+
+    return int(input_bytes * expansion)
+
+
+def use_tmpfs(plugin_config=None):
+    """
+    Whether a plugin may run on tmpfs, which plugins that fetch data from
+    outside the workspace, such as reads from SHOCK, turn off with the
+    handler_options scratch_tmpfs since their input size is not known.
+    """
+
+    if plugin_config is None:
+        return True
+
+    return bool(plugin_config.get("handler_options", dict()).get("scratch_tmpfs", True))
+
+
+def is_tmpfs(directory=None):
+    """
+    Check whether a directory is on a tmpfs mount.
+    """
+
+    if directory is None or not os.path.isdir(directory):
+        return False
+
+    directory = os.path.realpath(directory)
+
+    mount_point = ""
+    fs_type = None
+
+    try:
+        with open("/proc/mounts", 'r') as f:
+            for line in f:
+                fields = line.split()
+
+                if len(fields) < 3:
+                    continue
+
+                # mount points are the longest matching prefix of the directory
+                if (directory == fields[1] or directory.startswith(fields[1].rstrip("/") + "/")) and len(fields[1]) >= len(mount_point):
+                    mount_point = fields[1]
+                    fs_type = fields[2]
+    except IOError:
+        return False
+
+    return fs_type == "tmpfs"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+
+    return True
+
+
+def _owned(path=None, private=False):
+    """
+    Check that path is not a symlink and is owned by this user, and if
+    private is set that no other user can write to it.
+    """
+
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+
+    if stat.S_ISLNK(info.st_mode) or info.st_uid != os.getuid():
+        return False
+
+    return not private or info.st_mode & 0022 == 0
+
+
+def _private_directory(path=None):
+    """
+    Create a directory only this user can use, or check that an existing one
+    is, raising an exception otherwise.
+    """
+
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    if not _owned(path, True):
+        raise Exception("{0} is not a private directory of this user".format(path))
+
+
+def disk_usage(path=None):
+    """
+    Bytes of disk allocated to the files under path, like du.
+    """
+
+    total = 0
+
+    for root, directories, files in os.walk(path):
+        for name in directories + files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+
+    return total
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ScratchManager(object):
+    """
+    Reserves, places and releases job working directories, see the module
+    documentation.  Reservations of jobs whose process has exited are
+    dropped the next time the ledger is read.
+    """
+
+    def __init__(self, ledger_path = SCRATCH_LEDGER,
+                 tmpfs_directory = TMPFS_DIRECTORY,
+                 tmpfs_max_job_size = TMPFS_MAX_JOB_SIZE,
+                 logger = None):
+        self.ledger_path = ledger_path
+        self.tmpfs_directory = tmpfs_directory
+        self.tmpfs_max_job_size = tmpfs_max_job_size
+        self.logger = logger
+
+
+    @contextlib.contextmanager
+    def _ledger(self):
+        """
+        Hold the ledger locked for reading and updating.
+        """
+
+        if self.ledger_path == SCRATCH_LEDGER:
+            _private_directory(os.path.dirname(self.ledger_path))
+
+        fd = os.open(self.ledger_path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0600)
+        info = os.fstat(fd)
+
+        if info.st_uid != os.getuid() or info.st_mode & 0022:
+            os.close(fd)
+            raise Exception("Scratch ledger {0} can be changed by other users".format(self.ledger_path))
+
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                try:
+                    ledger = simplejson.loads(f.read())
+                except ValueError:
+                    ledger = dict()
+
+                ledger.setdefault("reservations", dict())
+                ledger.setdefault("trash", list())
+
+                for k in ledger["reservations"].keys():
+                    if not _pid_alive(ledger["reservations"][k]["pid"]):
+                        del ledger["reservations"][k]
+
+                yield ledger
+
+                f.seek(0)
+                f.truncate()
+                f.write(simplejson.dumps(ledger))
+                f.flush()
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+    def _measure(self):
+        """
+        Record the disk usage of reservations last measured more than
+        USAGE_MAX_AGE seconds ago, walking their directories without holding
+        the ledger lock so other jobs are not held up by large directories.
+        """
+
+        now = time.time()
+
+        with self._ledger() as ledger:
+            stale = [k for k, x in ledger["reservations"].items() if now - x.get("measured", 0) > USAGE_MAX_AGE]
+
+        if len(stale) == 0:
+            return
+
+        usage = dict([(k, disk_usage(k)) for k in stale])
+
+        with self._ledger() as ledger:
+            for k in stale:
+                if k in ledger["reservations"]:
+                    ledger["reservations"][k]["written"] = usage[k]
+                    ledger["reservations"][k]["measured"] = now
+
+
+    def _available(self, ledger, directory, key):
+        """
+        Free bytes on the filesystem of directory less the part of what other
+        jobs have reserved there that they have not written yet, since what
+        they have written is already gone from the free bytes.  What a job
+        has written is taken from its last measurement, see _measure().
+        """
+
+        fs = os.statvfs(directory)
+        device = os.stat(directory).st_dev
+
+        unwritten = 0
+
+        for k, x in ledger["reservations"].items():
+            if x["device"] == device and k != key:
+                unwritten += max(0, x["bytes"] - x.get("written", 0))
+
+        return fs.f_bavail * fs.f_frsize - unwritten
+
+
+    def _place_on_tmpfs(self, ledger, working_directory, size):
+        if size <= 0 or size > self.tmpfs_max_job_size:
+            return None
+
+        if os.path.lexists(working_directory) or not is_tmpfs(self.tmpfs_directory):
+            return None
+
+        root = os.path.join(self.tmpfs_directory, "transform_scratch_{0:d}".format(os.getuid()))
+
+        try:
+            _private_directory(root)
+        except Exception, e:
+            if self.logger is not None:
+                self.logger.warning("Not using tmpfs : {0}".format(e))
+            return None
+
+        if self._available(ledger, root, None) < size:
+            return None
+
+        directory = os.path.join(root, "{0}_{1}".format(os.path.basename(os.path.abspath(working_directory)),
+                                                        uuid.uuid4().hex[:8]))
+        os.mkdir(directory)
+        os.symlink(directory, working_directory)
+
+        return directory
+
+
+    def reserve(self, working_directory=None, size=0, allow_tmpfs=True):
+        """
+        Create the working directory if needed and reserve size bytes for it,
+        raising an exception if there is not enough free space.  Calling it
+        again for the same directory changes the reservation, so a job can
+        reserve again once the size of its input is known.
+
+        A new working directory for a job that fits on tmpfs is created there
+        with a symlink at the given path.
+        """
+
+        size = int(size)
+
+        self._measure()
+
+        with self._ledger() as ledger:
+            directory = None
+
+            if allow_tmpfs:
+                directory = self._place_on_tmpfs(ledger, working_directory, size)
+
+            # a directory made here is empty, any other is measured by the next reservation
+            made = directory is not None
+
+            if directory is None:
+                directory = os.path.realpath(working_directory)
+
+                if os.path.exists(directory):
+                    available = self._available(ledger, directory, directory)
+                else:
+                    available = self._available(ledger, os.path.dirname(directory), directory)
+
+                # a job that reserves nothing is never refused
+                if size > 0 and size > available:
+                    raise Exception("Not enough scratch space for {0}, {1:d} bytes needed and {2:d} available".format(
+                        working_directory, size, available))
+
+                if not os.path.exists(directory):
+                    os.mkdir(directory)
+                    made = True
+            elif self.logger is not None:
+                self.logger.info("Using tmpfs directory {0} for {1}".format(directory, working_directory))
+
+            reservation = ledger["reservations"].get(directory, {"written": 0, "measured": time.time() if made else 0})
+            reservation.update({"pid": os.getpid(), "device": os.stat(directory).st_dev, "bytes": size})
+
+            ledger["reservations"][directory] = reservation
+
+        self.start_purge()
+
+        return working_directory
+
+
+    def release(self, working_directory=None, keep=False):
+        """
+        Drop the reservation of a working directory and, unless keep is set,
+        move it to the trash to be removed in the background.
+        """
+
+        directory = os.path.realpath(working_directory)
+        trash = os.path.join(os.path.dirname(directory), TRASH_DIRECTORY)
+
+        with self._ledger() as ledger:
+            ledger["reservations"].pop(directory, None)
+
+            if not keep and os.path.isdir(directory):
+                try:
+                    _private_directory(trash)
+                except Exception, e:
+                    if self.logger is not None:
+                        self.logger.warning("Unable to use the trash {0} : {1}".format(trash, e))
+                    trash = None
+
+                if trash is not None and trash not in ledger["trash"]:
+                    ledger["trash"].append(trash)
+
+        if keep:
+            return
+
+        if trash is None:
+            shutil.rmtree(directory)
+        elif os.path.isdir(directory):
+            try:
+                os.rename(directory, os.path.join(trash, "{0}_{1}".format(os.path.basename(directory),
+                                                                          uuid.uuid4().hex[:8])))
+            except OSError, e:
+                if self.logger is not None:
+                    self.logger.warning("Unable to move {0} to the trash, removing it now : {1}".format(directory, e))
+
+                shutil.rmtree(directory)
+
+        if os.path.islink(working_directory):
+            os.remove(working_directory)
+
+        self.start_purge()
+
+
+    def purge(self):
+        """
+        Remove everything in the trash directories of this user, skipping
+        any listed path that is not a trash directory this user owns.
+        """
+
+        with self._ledger() as ledger:
+            ledger["trash"] = [x for x in ledger["trash"]
+                               if os.path.basename(x) == TRASH_DIRECTORY and _owned(x) and os.path.isdir(x)]
+            trash_directories = ledger["trash"][:]
+
+        for trash in trash_directories:
+            for name in os.listdir(trash):
+                _remove(os.path.join(trash, name))
+
+
+    def _purge_loop(self, interval):
+        while 1:
+            try:
+                self.purge()
+            except Exception, e:
+                if self.logger is not None:
+                    self.logger.warning("Unable to purge the scratch trash : {0}".format(e))
+
+            if interval is None:
+                break
+
+            time.sleep(interval)
+
+
+    def start_purge(self, interval=None):
+        """
+        Purge the trash in a background thread, once or every interval
+        seconds, unless this process is already purging.
+        """
+
+        global _purge_thread
+
+        with _purge_lock:
+            if _purge_thread is not None and _purge_thread.is_alive():
+                return
+
+            _purge_thread = threading.Thread(target=self._purge_loop, args=(interval,))
+            _purge_thread.daemon = True
+            _purge_thread.start()
@@ -11,16 +11,13 @@ import pydoc
 import time
 import re
 import io
-import gzip
-import bz2
 import tarfile
 import zipfile
+import shutil
 import argparse
+import multiprocessing.pool
 
 import simplejson
-import magic
-import ftputil
-import requests
 from requests_toolbelt import MultipartEncoder
 import subprocess
 
@@ -30,6 +27,13 @@ except:
     from biokbase.AbstractHandle.Client import AbstractHandle as HandleService
 
 import biokbase.workspace.client
+from biokbase.Transform import compression_utils
+from biokbase.Transform import ftp_ingest
+from biokbase.Transform import input_cache
+from biokbase.Transform import segmented_download
+from biokbase.Transform import shock_upload
+from biokbase.Transform import transport
+from biokbase.Transform import workspace_save
 
 
 # override default ArgumentParser behavior
@@ -145,116 +149,153 @@ def parse_docs(docstring=None):
     return script_details
 
 
-def extract_data(logger = stderrlogger(__file__), filePath = None, chunkSize = 2**30):
+class _PrefixedStream(object):
     """
-    Unpack a data file that may be compressed or an archive.
+    Wraps a readable stream so that bytes already consumed from it, e.g. for
+    format sniffing, are returned again ahead of the remaining stream data.
     """
 
-    def extract_tar(tarPath):
-        if not tarfile.is_tarfile(tarPath):
-            raise Exception("Inavalid tar file " + tarPath)
-    
-        with tarfile.open(tarPath, 'r') as tarDataFile:
-            memberlist = tarDataFile.getmembers()
-        
-            for member in memberlist:
-                memberPath = os.path.join(os.path.dirname(os.path.abspath(tarPath)),os.path.basename(os.path.abspath(member.name)))
-        
-                if member.isfile():
-                    with io.open(memberPath, 'wb') as f:
-                        inputFile = tarDataFile.extractfile(member.name)
-                        f.write(inputFile.read(chunkSize))
-    
-        os.remove(tarPath)
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
 
-    mimeType = None    
-    with magic.Magic(flags=magic.MAGIC_MIME_TYPE) as m:
-        mimeType = m.id_filename(filePath)
+    def read(self, size=-1):
+        if not self._prefix:
+            return self._stream.read(size)
 
-    logger.info("Extracting {0} as {1}".format(filePath, mimeType))
+        if size is None or size < 0:
+            data = self._prefix + self._stream.read()
+            self._prefix = str()
+        elif size <= len(self._prefix):
+            data = self._prefix[:size]
+            self._prefix = self._prefix[size:]
+        else:
+            data = self._prefix + self._stream.read(size - len(self._prefix))
+            self._prefix = str()
 
-    if mimeType == "application/x-gzip" or mimeType == "application/gzip":
-        outFile = os.path.splitext(filePath)[0]
-        with gzip.GzipFile(filePath, 'rb') as gzipDataFile, io.open(outFile, 'wb') as f:
-            for chunk in gzipDataFile:
-                f.write(chunk)
-        
-        os.remove(filePath)
-        outPath = os.path.dirname(filePath)
+        return data
 
-        # check for tar        
-        with magic.Magic(flags=magic.MAGIC_MIME_TYPE) as m:
-            mimeType = m.id_filename(outFile)
-
-        if mimeType == "application/x-tar":
-            logger.info("Extracting {0} as tar".format(outFile))
-            extract_tar(outFile)
-    elif mimeType == "application/x-bzip2":
-        outFile = os.path.splitext(filePath)[0]
-        with bz2.BZ2File(filePath, 'r') as bz2DataFile, io.open(outFile, 'wb') as f:
-            for chunk in bz2DataFile:
-                f.write(chunk)
-        
-        os.remove(filePath)
-        outPath = os.path.dirname(filePath)
 
-        # check for tar        
-        with magic.Magic(flags=magic.MAGIC_MIME_TYPE) as m:
-            mimeType = m.id_filename(outFile)
+def _read_block(stream, size):
+    """
+    Read up to size bytes from a stream, only returning less at end of stream.
+    """
+
+    data = list()
+    remaining = size
+
+    while remaining > 0:
+        chunk = stream.read(remaining)
+
+        if not chunk:
+            break
+
+        data.append(chunk)
+        remaining -= len(chunk)
+
+    return "".join(data)
+
+
+def _extract_tar_stream(logger = None, stream = None, outPath = None, 
+                        chunkSize = 2**22, allow_overwrite = True):
+    """
+    Extract the regular files of a tar stream into outPath in a single pass,
+    keeping only the base name of each member.
+    """
+
+    with tarfile.open(fileobj=stream, mode='r|') as tarDataFile:
+        for member in tarDataFile:
+            if not member.isfile():
+                continue
+
+            # perform sanity check on file names, extract each file individually
+            memberPath = os.path.join(outPath, os.path.basename(os.path.abspath(member.name)))
+
+            if not allow_overwrite and os.path.exists(memberPath):
+                raise Exception("Extracting tar contents will overwrite an existing file!")
+
+            logger.debug("Extracting tar member {0}".format(member.name))
+
+            inputFile = tarDataFile.extractfile(member)
+            with io.open(memberPath, 'wb') as f:
+                shutil.copyfileobj(inputFile, f, chunkSize)
+
+
+def _extract_compressed_stream(logger = None, stream = None, filePath = None, chunkSize = 2**22):
+    """
+    Decompress a stream straight to its final location, either the unpacked
+    members of a tarball or a single file named after filePath without the
+    compression extension.
+    """
+
+    outPath = os.path.dirname(filePath)
+    outFile = os.path.splitext(filePath)[0]
+
+    header = _read_block(stream, tarfile.BLOCKSIZE)
+
+    if compression_utils.is_tar_header(header):
+        logger.info("Extracting {0} as tar".format(filePath))
+        _extract_tar_stream(logger, _PrefixedStream(header, stream), outPath, chunkSize)
+    else:
+        with io.open(outFile, 'wb') as f:
+            f.write(header)
+            shutil.copyfileobj(stream, f, chunkSize)
+
 
-        if mimeType == "application/x-tar":
-            logger.info("Extracting {0} as tar".format(outFile))
-            extract_tar(outFile)
-    elif mimeType == "application/zip":
+def extract_data(logger = stderrlogger(__file__), filePath = None, chunkSize = 2**22):
+    """
+    Unpack a data file that may be compressed or an archive.
+
+    Compressed files are decompressed as a stream directly into their final
+    files, including any tar archive they contain, and all copies are done
+    in chunks of chunkSize bytes so memory use does not depend on file size.
+    Decompression uses multiple cores where the format allows it, see
+    compression_utils.open_decompressed().
+
+    The format is recognized from the leading bytes of the file, and gzip,
+    bzip2, xz, zstd and lz4 compression are supported along with zip and tar.
+    Zip based documents such as spreadsheets are left as they are.
+    """
+
+    dataFormat = compression_utils.detect_format(filePath)
+
+    logger.info("Extracting {0} as {1}".format(filePath, dataFormat))
+
+    if dataFormat in compression_utils.COMPRESSED_FORMATS:
+        with compression_utils.open_decompressed(filePath, dataFormat, logger=logger) as dataFile:
+            _extract_compressed_stream(logger, dataFile, filePath, chunkSize)
+        
+        os.remove(filePath)
+    elif dataFormat == "zip":
         if not zipfile.is_zipfile(filePath):
             raise Exception("Invalid zip file!")                
         
         outPath = os.path.dirname(filePath)
         
+        # member CRCs are verified as each member is read, so no separate testzip() pass
         with zipfile.ZipFile(filePath, 'r') as zipDataFile:
-            bad = zipDataFile.testzip()
-        
-            if bad is not None:
-                raise Exception("Encountered a bad file in the zip : " + str(bad))
-        
             infolist = zipDataFile.infolist()
         
             # perform sanity check on file names, extract each file individually
             for x in infolist:
+                if x.filename.endswith("/"):
+                    continue
+
                 infoPath = os.path.join(outPath, os.path.basename(os.path.abspath(x.filename)))
                 
-                if not os.path.exists(os.path.dirname(infoPath)):
-                    os.makedirs(infoPath)                    
-                
-                if os.path.exists(os.path.join(infoPath,os.path.split(x.filename)[-1])):
+                if os.path.exists(infoPath):
                     raise Exception("Extracting zip contents will overwrite an existing file!")
                 
-                with io.open(infoPath, 'wb') as f:
-                    f.write(zipDataFile.read(x.filename))
+                with zipDataFile.open(x) as inputFile, io.open(infoPath, 'wb') as f:
+                    shutil.copyfileobj(inputFile, f, chunkSize)
         
         os.remove(filePath)
-    elif mimeType == "application/x-gtar":
+    elif dataFormat == "tar":
         if not tarfile.is_tarfile(filePath):
             raise Exception("Inavalid tar file " + filePath)
 
-        outPath = os.path.dirname(filePath)
-
-        with tarfile.open(filePath, 'r|*') as tarDataFile:
-            memberlist = tarDataFile.getmembers()
-
-            # perform sanity check on file names, extract each file individually
-            for member in memberlist:
-                memberPath = os.path.join(outPath, os.path.basename(os.path.abspath(member.name)))
-
-                if os.path.exists(os.path.dirname(infoPath)):
-                    os.makedirs(infoPath)                    
-
-                if os.path.exists(os.path.join(infoPath,os.path.split(member.name)[-1])):
-                    raise Exception("Extracting tar contents will overwrite an existing file!")
-
-                if member.isfile():
-                    with io.open(memberPath, 'wb') as f, tarDataFile.extractfile(member.name) as inputFile:
-                        f.write(inputFile.read(chunkSize))
+        with io.open(filePath, 'rb') as tarStream:
+            _extract_tar_stream(logger, tarStream, os.path.dirname(filePath), chunkSize, allow_overwrite=False)
 
         os.remove(filePath)
 
@@ -265,10 +306,16 @@ def download_file_from_shock(logger = stderrlogger(__file__),
                              shock_id = None,
                              filename = None,
                              directory = None,
-                             token = None):
+                             token = None,
+                             cache = None):
     """
     Given a SHOCK instance URL and a SHOCK node id, download the contents of that node
     to a file on disk.
+
+    The node is downloaded over several connections with resume, and verified
+    against its SHOCK MD5.  If an input cache is given, or one is configured for
+    this worker, the node is served from the cache when it has already been
+    downloaded.
     """
 
     header = dict()
@@ -276,15 +323,14 @@ def download_file_from_shock(logger = stderrlogger(__file__),
 
     logger.info("Downloading shock node {0}/node/{1}".format(shock_service_url,shock_id))
 
-    metadata_response = requests.get("{0}/node/{1}?verbosity=metadata".format(shock_service_url, shock_id), headers=header, stream=True, verify=True)
+    metadata_response = transport.get("{0}/node/{1}?verbosity=metadata".format(shock_service_url, shock_id), headers=header, stream=True, verify=True)
     shock_metadata = metadata_response.json()['data']
     shockFileName = shock_metadata['file']['name']
     shockFileSize = shock_metadata['file']['size']
+    shockFileMD5 = shock_metadata['file'].get('checksum', dict()).get('md5')
     metadata_response.close()
         
     download_url = "{0}/node/{1}?download_raw".format(shock_service_url, shock_id)
-        
-    data = requests.get(download_url, headers=header, stream=True, verify=True)
 
     if filename is not None:
         shockFileName = filename
@@ -294,22 +340,17 @@ def download_file_from_shock(logger = stderrlogger(__file__),
     else:
         filePath = shockFileName
 
-    chunkSize = shockFileSize/4
-    
-    maxChunkSize = 2**30
-    
-    if chunkSize > maxChunkSize:
-        chunkSize = maxChunkSize
-    
-    f = io.open(filePath, 'wb')
-    try:
-        for chunk in data.iter_content(chunkSize):
-            if chunk:                
-                f.write(chunk)
-                f.flush()            
-    finally:
-        data.close()
-        f.close()      
+    if cache is None:
+        cache = input_cache.get_default_cache(logger)
+
+    if cache is not None and shockFileMD5:
+        cache.fetch(input_cache.make_key(shock_id, shockFileMD5), filePath,
+                    lambda path: segmented_download.download(logger, download_url, path, header, True,
+                                                             shockFileSize, shockFileMD5),
+                    shockFileMD5)
+        cache.log_stats(logger)
+    else:
+        segmented_download.download(logger, download_url, filePath, header, True, shockFileSize, shockFileMD5)
     
     extract_data(logger, filePath)
                              
@@ -319,9 +360,15 @@ def upload_file_to_shock(logger = stderrlogger(__file__),
                          shock_service_url = None,
                          filePath = None,
                          ssl_verify = True,
-                         token = None):
+                         token = None,
+                         part_size = shock_upload.DEFAULT_PART_SIZE,
+                         connections = shock_upload.DEFAULT_CONNECTIONS):
     """
     Use HTTP multi-part POST to save a file to a SHOCK instance.
+
+    Files larger than part_size are sent as a multi-part node, with the parts
+    uploaded concurrently and retried on their own, and an interrupted upload
+    resumes with the parts that were already sent.
     """
 
     if token is None:
@@ -334,13 +381,18 @@ def upload_file_to_shock(logger = stderrlogger(__file__),
     if filePath is None:
         raise Exception("No file given for upload to SHOCK!")
 
+    if os.path.getsize(filePath) > part_size:
+        return shock_upload.upload(logger, shock_service_url, filePath, ssl_verify, token,
+                                   part_size, connections)
+
     dataFile = open(os.path.abspath(filePath), 'rb')
     m = MultipartEncoder(fields={'upload': (os.path.split(filePath)[-1], dataFile)})
     header['Content-Type'] = m.content_type
 
     logger.info("Sending {0} to {1}".format(filePath,shock_service_url))
     try:
-        response = requests.post(shock_service_url + "/node", headers=header, data=m, allow_redirects=True, verify=ssl_verify)
+        response = transport.post(shock_service_url + "/node", headers=header, data=m, allow_redirects=True,
+                                  verify=ssl_verify, timeout=transport.LONG_TIMEOUT)
         dataFile.close()
     except:
         dataFile.close()
@@ -362,9 +414,15 @@ def getHandles(logger = None,
                handle_service_url = None,
                shock_ids = None,
                handle_ids = None,
-               token = None):
+               token = None,
+               connections = 8):
     """
     Retrieve KBase handles for a list of shock ids or a list of handle ids.
+
+    For shock ids the node metadata is fetched concurrently, existing handles
+    are looked up with one ids_to_handles call, and only the nodes without a
+    handle are persisted.  Existing handles are returned as handle structures
+    and new ones as the handle id from persist_handle, in the order given.
     """
     
     if token is None:
@@ -376,96 +434,154 @@ def getHandles(logger = None,
     if shock_ids is not None:
         header = dict()
         header["Authorization"] = "Oauth {0}".format(token)
-        
-        for sid in shock_ids:
-            info = None
-            
+
+        def get_node_info(sid):
             try:
                 logger.info("Found shock id {0}, retrieving information about the data.".format(sid))
 
-                response = requests.get("{0}/node/{1}".format(shock_service_url, sid), headers=header, verify=True)
-                info = response.json()["data"]
+                response = transport.get("{0}/node/{1}".format(shock_service_url, sid), headers=header, verify=True)
+                return response.json()["data"]
             except:
                 logger.error("There was an error retrieving information about the shock node id {0} from url {1}".format(sid, shock_service_url))
-            
+                return None
+
+        if len(shock_ids) > 1:
+            pool = multiprocessing.pool.ThreadPool(min(connections, len(shock_ids)))
             try:
-                logger.info("Retrieving a handle id for the data.")
-                handle = hs.persist_handle({"id" : sid, 
-                                           "type" : "shock",
-                                           "url" : shock_service_url,
-                                           "file_name": info["file"]["name"],
-                                           "remote_md5": info["file"]["checksum"]["md5"]})
-                handles.append(handle)
+                node_info = dict(zip(shock_ids, pool.map(get_node_info, shock_ids)))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            node_info = dict([(sid, get_node_info(sid)) for sid in shock_ids])
+
+        def lookup_handles(ids):
+            found = dict()
+
+            for x in hs.ids_to_handles(list(set(ids))):
+                if x["id"] not in found:
+                    found[x["id"]] = x
+
+            return found
+
+        logger.info("Retrieving handle ids for the data.")
+        existing = lookup_handles(shock_ids)
+
+        persisted = dict()
+        failed = list()
+        for sid in shock_ids:
+            if sid in existing or sid in persisted:
+                continue
+
+            info = node_info[sid]
+
+            if info is None:
+                raise Exception("Unable to register shock node id {0} without its metadata".format(sid))
+
+            try:
+                persisted[sid] = hs.persist_handle({"id" : sid, 
+                                                    "type" : "shock",
+                                                    "url" : shock_service_url,
+                                                    "file_name": info["file"]["name"],
+                                                    "remote_md5": info["file"]["checksum"]["md5"]})
             except:
-                try:
-                    handle_id = hs.ids_to_handles([sid])[0]["hid"]
-                    single_handle = hs.hids_to_handles([handle_id])
-                
-                    assert len(single_handle) != 0
-                    
-                    if info is not None:
-                        single_handle[0]["file_name"] = info["file"]["name"]
-                        single_handle[0]["remote_md5"] = info["file"]["checksum"]["md5"]
-                        logger.debug(single_handle)
-                    
-                    handles.append(single_handle[0])
-                except:
-                    logger.error("The input shock node id {} is already registered or could not be registered".format(sid))
-
-                    hs = HandleService(url=handle_service_url, token=token)
-                    all_handles = hs.list_handles()
-
-                    for x in all_handles:
-                        if x[0] == sid:
-                            logger.info("FOUND shock id as existing handle")
-                            logger.info(x)
-                            break
-                    else:
-                        logger.info("Unable to find a handle containing shock id")
-
-                        logger.info("Trying again to get a handle id for the data.")
-                        handle_id = hs.persist_handle({"id" : sid, 
-                                           "type" : "shock",
-                                           "url" : shock_service_url,
-                                           "file_name": info["file"]["name"],
-                                           "remote_md5": info["file"]["checksum"]["md5"]})
-                        handles.append(handle_id)
-
-                    raise
+                failed.append(sid)
+
+        # the nodes may have been registered since the lookup
+        if len(failed) > 0:
+            existing.update(lookup_handles(failed))
+
+            for sid in failed:
+                if sid not in existing:
+                    logger.error("The input shock node id {0} is already registered or could not be registered".format(sid))
+                    raise Exception("Unable to find or register a handle for shock node id {0}".format(sid))
+
+        for sid in shock_ids:
+            if sid in persisted:
+                handles.append(persisted[sid])
+            else:
+                single_handle = dict(existing[sid])
+                info = node_info[sid]
+
+                if info is not None:
+                    single_handle["file_name"] = info["file"]["name"]
+                    single_handle["remote_md5"] = info["file"]["checksum"]["md5"]
+                    logger.debug(single_handle)
+
+                handles.append(single_handle)
     elif handle_ids is not None:
-        for hid in handle_ids:
-            try:
-                single_handle = hs.hids_to_handles([hid])
+        found = dict([(str(x["hid"]), x) for x in hs.hids_to_handles(list(handle_ids))])
 
-                assert len(single_handle) != 0
-                
-                handles.append(single_handle[0])
-            except:
+        for hid in handle_ids:
+            if str(hid) not in found:
                 logger.error("Invalid handle id {0}".format(hid))
-                raise
+                raise Exception("Invalid handle id {0}".format(hid))
+
+            handles.append(found[str(hid)])
     
     return handles
 
 
+def get_urls_size(logger = stderrlogger(__file__),
+                  urls = None,
+                  ssl_verify = True,
+                  token = None):
+    """
+    Total size of the content at a dictionary of urls, from the SHOCK node
+    metadata or the HTTP headers, without downloading anything.  Returns None
+    if the size of any url, such as an FTP url, is not known.
+    """
+
+    header = dict()
+    header["Authorization"] = "Oauth {0}".format(token)
+
+    total = 0
+
+    for name, url in urls.items():
+        if not url.startswith("http://") and not url.startswith("https://"):
+            return None
+
+        try:
+            shock = re.search('^(https?://.*)/node/([a-fA-F0-9\-]+).*', url)
+
+            if shock is not None:
+                metadata_response = transport.get("{0}/node/{1}?verbosity=metadata".format(shock.group(1), shock.group(2)),
+                                                  headers=header, verify=ssl_verify)
+                size = metadata_response.json()['data']['file']['size']
+            else:
+                size = segmented_download.probe(url, header, ssl_verify)["size"]
+        except Exception, e:
+            logger.warning("Unable to find the size of {0} : {1}".format(url, e))
+            return None
+
+        if size is None:
+            return None
+
+        total += size
+
+    return total
+
+
 def download_from_urls(logger = stderrlogger(__file__),
                        working_directory = os.getcwd(),
                        urls = None,
                        ssl_verify = True,
                        token = None, 
-                       chunkSize = 2**30):
+                       chunkSize = 2**20,
+                       cache = None):
     """
     Downloads urls defined by key names in a dictionary, with each key name getting
     its own subdirectory and the contents of the url for that key deposited in the
     subdirectory that matches the key name.  Key names are defined by developers in
     a config file per upload conversion.
+
+    FTP directories are crawled and downloaded over a pool of connections,
+    HTTP urls are downloaded over several connections with resume when the server
+    supports Range requests, and SHOCK urls are verified against the node MD5 and
+    served from the input cache if one is given or configured for this worker.
     """
-    
-    def _gen_ftp_file_list(root):
-        for root, directories, files in ftputil.walk(d):
-            for file in files:
-                yield os.path.join(root, file)
-            
-    
+
     if token is None:
         raise Exception("Unable to find token!")
     
@@ -482,6 +598,9 @@ def download_from_urls(logger = stderrlogger(__file__),
     
     assert len(urls.keys()) != 0
 
+    if cache is None:
+        cache = input_cache.get_default_cache(logger)
+
     for name, url in urls.items():
         data = None
         download_directory = os.path.join(working_directory, name)
@@ -489,70 +608,14 @@ def download_from_urls(logger = stderrlogger(__file__),
         
         # detect url type
         if url.startswith("ftp://"):
-            threshold=1024
-
-            # check if file or directory
-            host = url.split("ftp://")[1].split("/")[0]
-            path = url.split("ftp://")[1].split("/", 1)[1]
-        
-            ftp_connection = ftputil.FTPHost(host, 'anonymous', 'anonymous@')
-            
-            if ftp_connection.path.isdir(path):
-                file_list = ftp_connection.listdir(path)
-            elif ftp_connection.path.isfile(path):
-                file_list = [path]
-            else:
-                raise Exception('File not found for FTP URL "{0}"'.format(url))
-
-            if len(file_list) > 1:            
-                if len(file_list) > threshold:
-                    raise Exception("Too many files to process, found so far {0:d}".format(len(file_list)))
-                                                
-                if len(path.split("/")[-1]) == 0:
-                    dirname = os.path.join(download_directory, path.split("/")[-2])
-                else:
-                    dirname = os.path.join(download_directory, path.split("/")[-1])
-            
-                all_files = list()
-                check = file_list[:]
-                while len(check) > 0:
-                    x = check.pop()
-
-                    if ftp_connection.path.isdir(path):
-                        file_list = ftp_connection.listdir(path)
-                    elif ftp_connection.path.isfile(path):
-                        file_list = [path]
-            
-                    new_files = ftp_connection.listdir(x)
-                
-                    for n in new_files:
-                        if ftp_connection.path.isfile(n):
-                            all_files.append(n)
-                        elif ftp_connection.path.isdir(n):
-                            check.append(n)
-                        if len(all_files) > threshold:
-                            raise Exception("Too many files to process, found so far {0:d}".format(len(all_files)))
-                
-                os.mkdir(dirname)
-        
-                for x in all_files:
-                    filePath = os.path.join(os.path.abspath(dirname), os.path.basename(x))
-                    logger.info("Downloading {0}".format(host + x))
-                    ftp_connection.download(x, filePath)
-                    extract_data(logger, filePath)
-            else:
-                filePath = os.path.join(download_directory, os.path.split(path)[-1])
-                logger.info("Downloading {0}".format(url))
-                ftp_connection.download(path, filePath)
-                extract_data(logger, filePath)
-            
-            ftp_connection.close()            
+            ftp_ingest.ingest(logger, url, download_directory, extract_data)
         elif url.startswith("http://") or url.startswith("https://"):
             logger.info("Downloading {0}".format(url))
 
             download_url = None
             fileSize = 0
             fileName = None
+            fileMD5 = None
 
             header = dict()
             header["Authorization"] = "Oauth {0}".format(token)
@@ -568,43 +631,46 @@ def download_from_urls(logger = stderrlogger(__file__),
                 download_url = url
                 fileName = url.split('/')[-1]
             else:
-                metadata_response = requests.get("{0}/node/{1}?verbosity=metadata".format(shock_download_url, shock_id), headers=header, stream=True, verify=ssl_verify)
+                metadata_response = transport.get("{0}/node/{1}?verbosity=metadata".format(shock_download_url, shock_id), headers=header, stream=True, verify=ssl_verify)
                 shock_metadata = metadata_response.json()['data']
                 fileName = shock_metadata['file']['name']
                 fileSize = shock_metadata['file']['size']
+                fileMD5 = shock_metadata['file'].get('checksum', dict()).get('md5')
                 metadata_response.close()
                     
                 download_url = "{0}/node/{1}?download_raw".format(shock_download_url, shock_id)
 
-            data = None
-            size = 0
-            try:    
-                data = requests.get(download_url, headers=header, stream=True, verify=ssl_verify)
-                if 'content-length' in data.headers:
-                    size = int(data.headers['content-length'])
-                if 'content-disposition' in data.headers:
-                    fileName = data.headers['content-disposition'].split("filename=")[-1].replace("\\","").replace("\"","")
-            except Exception, e:
-                raise
+            if cache is not None and shock_id is not None and fileMD5:
+                filePath = os.path.join(download_directory, fileName)
 
-            if size > 0 and fileSize == 0:
-                fileSize = size
-            
-            filePath = os.path.join(download_directory, fileName)
+                logger.info("Writing out {0}".format(fileName))
+
+                cache.fetch(input_cache.make_key(shock_id, fileMD5), filePath,
+                            lambda path: segmented_download.download(logger, download_url, path, header, ssl_verify,
+                                                                     fileSize, fileMD5, chunkSize=chunkSize),
+                            fileMD5)
+            else:
+                info = segmented_download.probe(download_url, header, ssl_verify)
+
+                if info["file_name"] is not None:
+                    fileName = info["file_name"]
 
-            logger.info("Writing out {0}".format(fileName))
+                if info["size"] is not None and fileSize == 0:
+                    fileSize = info["size"]
             
-            f = io.open(filePath, 'wb')
-            try:
-                for chunk in data.iter_content(chunkSize):
-                    f.write(chunk)
-            finally:
-                data.close()
-                f.close()      
+                filePath = os.path.join(download_directory, fileName)
+
+                logger.info("Writing out {0}".format(fileName))
+
+                segmented_download.download(logger, download_url, filePath, header, ssl_verify,
+                                            fileSize or None, fileMD5, chunkSize=chunkSize)
             
             resultFile = extract_data(logger, filePath)
         else:
             raise Exception("Unrecognized protocol or url format : " + url)
+
+    if cache is not None:
+        cache.log_stats(logger)
     
 
             
@@ -614,28 +680,32 @@ def save_json_to_workspace(logger = None,
                            json_file = None,
                            kbase_info_file = None,
                            object_details = None,
-                           token = None):
+                           token = None,
+                           compress = False):
 
     """
     Saves an object to a workspace given a JSON data file.
+
+    The file is streamed into the save_objects request as it is, without
+    being loaded and serialized again, and the object info is returned.
+    Use workspace_save.save_objects to save several objects in batches.
     
     TODO
     Optionally if this data was originally from KBase, a KBase info file can
     be given that will be saved to the workspace with the object.
     """
 
-    f = open(json_file, 'r')
-    data = simplejson.loads(f.read())
-    f.close()
-    
-    workspaceClient = biokbase.workspace.client.Workspace(workspace_service_url, token=os.environ.get("KB_AUTH_TOKEN"))
-    
-    workspaceClient.save_objects({"workspace": object_details["workspace_name"],
-                                  "objects": [{
-                                      "type": object_details["kbase_type"],
-                                      "data": data,
-                                      "name": object_details["object_name"],
-                                      "meta": object_details["object_meta"],
-                                      "provenance": object_details["provenance"]}
-                                  ]})
+    if token is None:
+        token = os.environ.get("KB_AUTH_TOKEN")
+
+    return workspace_save.save_objects(logger = logger,
+                                       workspace_service_url = workspace_service_url,
+                                       workspace = object_details["workspace_name"],
+                                       objects = [{"type": object_details["kbase_type"],
+                                                   "json_file": json_file,
+                                                   "name": object_details["object_name"],
+                                                   "meta": object_details["object_meta"],
+                                                   "provenance": object_details["provenance"]}],
+                                       token = token,
+                                       compress = compress)[0]
     
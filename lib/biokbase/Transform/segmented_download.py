@@ -0,0 +1,396 @@
+"""
+Provides a segmented HTTP downloader for SHOCK ?download_raw and plain HTTP urls.
+
+Files are fetched over several concurrent Range requests, each segment is
+retried on its own, and finished segments are checkpointed next to the file
+so that an interrupted transfer resumes instead of starting over.  The MD5 of
+the file is computed in order while it downloads: data at the front of what
+has been hashed is hashed as it arrives, and data that arrived ahead of it is
+read back, usually from the page cache, once the front reaches it.  The result
+is verified against the SHOCK checksum without another pass over the file.
+"""
+
+import os
+import io
+import time
+import hashlib
+import threading
+import multiprocessing.pool
+
+import simplejson
+
+from biokbase.Transform import transport
+
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_SEGMENT_SIZE = 2**26
+DEFAULT_RETRIES = 5
+
+CHECKPOINT_SUFFIX = ".segments"
+
+
+def parse_content_disposition(value=None):
+    """
+    Pull the file name out of a Content-Disposition header value.
+    """
+
+    if value is None or "filename=" not in value:
+        return None
+
+    return value.split("filename=")[-1].replace("\\","").replace("\"","")
+
+
+def probe(url=None, header=None, ssl_verify=True):
+    """
+    Find out the size of the content at a url, whether the server honours Range
+    requests, and any file name given in a Content-Disposition header.
+    """
+
+    range_header = dict(header or dict())
+    range_header["Range"] = "bytes=0-0"
+
+    info = {"size": None, "ranges": False, "file_name": None}
+
+    response = transport.get(url, headers=range_header, stream=True, verify=ssl_verify)
+    try:
+        # an empty file cannot satisfy any range
+        if response.status_code == 416:
+            info["size"] = 0
+            return info
+
+        response.raise_for_status()
+
+        if response.status_code == 206 and "content-range" in response.headers:
+            info["ranges"] = True
+            info["size"] = int(response.headers["content-range"].split("/")[-1])
+        elif "content-length" in response.headers:
+            info["size"] = int(response.headers["content-length"])
+
+        info["file_name"] = parse_content_disposition(response.headers.get("content-disposition"))
+    finally:
+        response.close()
+
+    return info
+
+
+def download(logger = None,
+             url = None,
+             filePath = None,
+             header = None,
+             ssl_verify = True,
+             size = None,
+             md5 = None,
+             connections = DEFAULT_CONNECTIONS,
+             segment_size = DEFAULT_SEGMENT_SIZE,
+             chunkSize = 2**20):
+    """
+    Download a url to filePath, returning the MD5 hex digest of the file.
+    An exception is raised if md5 is given and does not match.
+    """
+
+    downloader = SegmentedDownload(logger = logger,
+                                   url = url,
+                                   filePath = filePath,
+                                   header = header,
+                                   ssl_verify = ssl_verify,
+                                   size = size,
+                                   md5 = md5,
+                                   connections = connections,
+                                   segment_size = segment_size,
+                                   chunkSize = chunkSize)
+    return downloader.run()
+
+
+class SegmentedDownload(object):
+
+    def __init__(self, logger = None,
+                 url = None,
+                 filePath = None,
+                 header = None,
+                 ssl_verify = True,
+                 size = None,
+                 md5 = None,
+                 connections = DEFAULT_CONNECTIONS,
+                 segment_size = DEFAULT_SEGMENT_SIZE,
+                 retries = DEFAULT_RETRIES,
+                 chunkSize = 2**20):
+        if url is None or filePath is None:
+            raise Exception("A url and a file path are required to download!")
+
+        self.logger = logger
+        self.url = url
+        self.filePath = filePath
+        self.header = header or dict()
+        self.ssl_verify = ssl_verify
+        self.size = size
+        self.md5 = md5
+        self.connections = connections
+        self.segment_size = segment_size
+        self.retries = retries
+        self.chunkSize = chunkSize
+
+        self.checkpoint_path = filePath + CHECKPOINT_SUFFIX
+
+        # bytes of each segment written so far, how much of the file is hashed,
+        # and whether a thread is hashing, the lock guards all but the digest
+        self._written = dict()
+        self._digest = None
+        self._hashed = 0
+        self._hashing = False
+        self._reader = None
+        self._hash_lock = threading.Lock()
+
+
+    def _log(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
+
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path) or not os.path.exists(self.filePath):
+            return set()
+
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = simplejson.loads(f.read())
+        except Exception:
+            return set()
+
+        if checkpoint["url"] != self.url or \
+           checkpoint["size"] != self.size or \
+           checkpoint["segment_size"] != self.segment_size:
+            return set()
+
+        return set(checkpoint["completed"])
+
+
+    def _save_checkpoint(self, completed):
+        temp_path = self.checkpoint_path + ".tmp"
+
+        with open(temp_path, 'w') as f:
+            f.write(simplejson.dumps({"url": self.url,
+                                      "size": self.size,
+                                      "segment_size": self.segment_size,
+                                      "completed": sorted(completed)}))
+
+        os.rename(temp_path, self.checkpoint_path)
+
+
+    def _remove_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+    def _retry(self, attempt, e):
+        if attempt >= self.retries:
+            raise
+
+        wait = transport.backoff_delay(attempt)
+
+        if self.logger is not None:
+            self.logger.warning("Retrying {0} in {1:.2f}s after error : {2}".format(self.url, wait, e))
+
+        time.sleep(wait)
+
+
+    def _catch_up(self, offset=None, chunk=None):
+        """
+        Hash everything written at the front of the hashed part of the file,
+        called by the one thread that set _hashing.  Data is read and hashed
+        without the hash lock, which is only held to find how much has been
+        written and to advance the hashed offset, so writers are not held up.
+        A chunk just written at offset is hashed from memory if it is at the
+        front.
+        """
+
+        try:
+            while 1:
+                with self._hash_lock:
+                    index = self._hashed // self.segment_size
+                    available = min(index * self.segment_size + self._written.get(index, 0), self.size)
+
+                    if available <= self._hashed:
+                        self._hashing = False
+                        return
+
+                    hashed = self._hashed
+
+                if chunk is not None and offset <= hashed < offset + len(chunk):
+                    data = chunk[hashed - offset:]
+                else:
+                    self._reader.seek(hashed)
+                    data = self._reader.read(min(self.chunkSize, available - hashed))
+
+                    if not data:
+                        raise Exception("Unexpected end of file while hashing {0}".format(self.filePath))
+
+                chunk = None
+                self._digest.update(data)
+
+                with self._hash_lock:
+                    self._hashed += len(data)
+        except Exception:
+            with self._hash_lock:
+                self._hashing = False
+            raise
+
+
+    def _record(self, index, offset, written, chunk):
+        """
+        Note that chunk has been written at offset as the first written bytes
+        of segment index, and hash what is at the front unless another thread
+        is already hashing, which will then find this chunk.
+        """
+
+        with self._hash_lock:
+            self._written[index] = max(self._written.get(index, 0), written)
+
+            if self._hashing:
+                return
+
+            self._hashing = True
+
+        self._catch_up(offset, chunk)
+
+
+    def _fetch_segment(self, segment):
+        index, start, end = segment
+
+        segment_header = dict(self.header)
+        segment_header["Range"] = "bytes={0:d}-{1:d}".format(start, end)
+
+        attempt = 0
+        while 1:
+            attempt += 1
+
+            try:
+                response = transport.get(self.url, retries=0, headers=segment_header, stream=True, verify=self.ssl_verify)
+                try:
+                    if response.status_code != 206:
+                        raise Exception("Expected a partial response for {0}, received {1:d}".format(segment_header["Range"],
+                                                                                                  response.status_code))
+
+                    written = 0
+                    with io.open(self.filePath, 'r+b') as f:
+                        f.seek(start)
+
+                        for chunk in response.iter_content(self.chunkSize):
+                            if chunk:
+                                f.write(chunk)
+                                # visible to the hashing reader before it is recorded
+                                f.flush()
+                                written += len(chunk)
+                                self._record(index, start + written - len(chunk), written, chunk)
+
+                    if written != end - start + 1:
+                        raise Exception("Received {0:d} of {1:d} bytes for {2}".format(written, end - start + 1,
+                                                                                      segment_header["Range"]))
+                finally:
+                    response.close()
+
+                return index
+            except Exception, e:
+                self._retry(attempt, e)
+
+
+    def _verify(self, digest):
+        if self.md5 is not None and digest != self.md5:
+            self._remove_checkpoint()
+            raise Exception("MD5 mismatch for {0}, expected {1} and found {2}".format(self.url, self.md5, digest))
+
+        return digest
+
+
+    def _run_single(self):
+        """
+        Fall back to one streamed GET when the server does not support ranges.
+        """
+
+        digest = hashlib.md5()
+
+        attempt = 0
+        while 1:
+            attempt += 1
+
+            try:
+                response = transport.get(self.url, retries=0, headers=self.header, stream=True, verify=self.ssl_verify)
+                try:
+                    response.raise_for_status()
+
+                    with io.open(self.filePath, 'wb') as f:
+                        for chunk in response.iter_content(self.chunkSize):
+                            if chunk:
+                                f.write(chunk)
+                                digest.update(chunk)
+                finally:
+                    response.close()
+
+                break
+            except Exception, e:
+                digest = hashlib.md5()
+                self._retry(attempt, e)
+
+        return self._verify(digest.hexdigest())
+
+
+    def run(self):
+        if self.size is None:
+            info = probe(self.url, self.header, self.ssl_verify)
+            self.size = info["size"]
+            ranges = info["ranges"]
+        else:
+            ranges = probe(self.url, self.header, self.ssl_verify)["ranges"]
+
+        if not ranges or self.size is None or self.size <= self.segment_size:
+            self._log("Downloading {0} over a single connection".format(self.url))
+            return self._run_single()
+
+        segments = [(i, start, min(start + self.segment_size, self.size) - 1)
+                    for i, start in enumerate(xrange(0, self.size, self.segment_size))]
+
+        completed = self._load_checkpoint()
+
+        if completed:
+            self._log("Resuming {0} with {1:d} of {2:d} segments already downloaded".format(self.url,
+                                                                                          len(completed),
+                                                                                          len(segments)))
+        else:
+            with io.open(self.filePath, 'wb') as f:
+                f.truncate(self.size)
+
+        self._log("Downloading {0} in {1:d} segments over {2:d} connections".format(self.url,
+                                                                                  len(segments),
+                                                                                  self.connections))
+
+        self._digest = hashlib.md5()
+        self._hashed = 0
+        self._hashing = True
+        self._written = dict([(x[0], x[2] - x[1] + 1) for x in segments if x[0] in completed])
+        self._reader = io.open(self.filePath, 'rb')
+
+        try:
+            # segments downloaded before a resume are read back once
+            self._catch_up()
+
+            pending = [x for x in segments if x[0] not in completed]
+
+            pool = multiprocessing.pool.ThreadPool(self.connections)
+            try:
+                for index in pool.imap_unordered(self._fetch_segment, pending):
+                    completed.add(index)
+                    self._save_checkpoint(completed)
+
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            self._reader.close()
+
+        if self._hashed != self.size:
+            raise Exception("Hashed {0:d} of {1:d} bytes of {2}".format(self._hashed, self.size, self.filePath))
+
+        digest = self._verify(self._digest.hexdigest())
+        self._remove_checkpoint()
+
+        return digest
@@ -0,0 +1,538 @@
+"""
+Provides chunked uploads to SHOCK using multi-part nodes.
+
+A node is created for an unknown number of parts, the parts are sent
+concurrently from a thread pool with each part retried on its own, and the
+node is closed once all parts are in place.  Uploaded parts are checkpointed
+in a state directory of the user, keyed by the path, size and modification
+time of the file, so that an interrupted upload resumes with the same node.
+
+Data that is produced as a stream, such as an archive being built, can be
+written to a StreamingUpload instead, which sends each part as soon as it
+fills up while only a bounded number of parts are held in memory.
+"""
+
+import os
+import io
+import time
+import errno
+import hashlib
+import threading
+import multiprocessing.pool
+
+import simplejson
+from requests_toolbelt import MultipartEncoder
+
+from biokbase.Transform import transport
+
+
+DEFAULT_PART_SIZE = 2**25
+DEFAULT_CONNECTIONS = 4
+DEFAULT_RETRIES = 5
+
+# checkpoints of unfinished uploads, never next to the file since that may be
+# a directory of another user or one that is read-only
+UPLOAD_STATE_DIRECTORY = os.environ.get("KB_TRANSFORM_UPLOAD_STATE_DIR",
+                                        os.path.join(os.path.expanduser("~"), ".kbase_transform_uploads"))
+
+CHECKPOINT_SUFFIX = ".upload"
+
+
+class FileSlice(object):
+    """
+    Read-only view of a byte range of a file, so that a part can be streamed
+    into a multipart request without reading it into memory.  The length is
+    the number of bytes left to read, which is what MultipartEncoder expects.
+    """
+
+    def __init__(self, filePath=None, offset=0, size=0):
+        self._file = io.open(filePath, 'rb')
+        self._file.seek(offset)
+        self._size = size
+        self._position = 0
+
+    def __len__(self):
+        return self._size - self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        remaining = self._size - self._position
+
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+
+        data = self._file.read(size)
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class StringSlice(object):
+    """
+    Read-only stream over a string, with the same interface as FileSlice for
+    parts that are held in memory.
+    """
+
+    def __init__(self, data=None):
+        self._data = data
+        self._position = 0
+
+    def __len__(self):
+        return len(self._data) - self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self)
+
+        data = self._data[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+def check_response(response=None):
+    """
+    Raise an exception for a failed SHOCK request, otherwise return the data
+    from the response.
+    """
+
+    if not response.ok:
+        response.raise_for_status()
+
+    result = response.json()
+
+    if result['error']:
+        raise Exception(result['error'][0])
+
+    return result["data"]
+
+
+def upload(logger = None,
+           shock_service_url = None,
+           filePath = None,
+           ssl_verify = True,
+           token = None,
+           part_size = DEFAULT_PART_SIZE,
+           connections = DEFAULT_CONNECTIONS,
+           progress = None):
+    """
+    Upload a file to SHOCK in parts and return the node data, the same as a
+    single multipart POST would.  If given, progress is called with the
+    number of bytes uploaded so far.
+    """
+
+    uploader = ChunkedUpload(logger = logger,
+                             shock_service_url = shock_service_url,
+                             filePath = filePath,
+                             ssl_verify = ssl_verify,
+                             token = token,
+                             part_size = part_size,
+                             connections = connections,
+                             progress = progress)
+    return uploader.run()
+
+
+class ChunkedUpload(object):
+
+    def __init__(self, logger = None,
+                 shock_service_url = None,
+                 filePath = None,
+                 ssl_verify = True,
+                 token = None,
+                 part_size = DEFAULT_PART_SIZE,
+                 connections = DEFAULT_CONNECTIONS,
+                 retries = DEFAULT_RETRIES,
+                 progress = None):
+        if token is None:
+            raise Exception("Authentication token required!")
+
+        if filePath is None:
+            raise Exception("No file given for upload to SHOCK!")
+
+        self.logger = logger
+        self.shock_service_url = shock_service_url
+        self.filePath = os.path.abspath(filePath)
+        self.ssl_verify = ssl_verify
+        self.token = token
+        self.part_size = part_size
+        self.connections = connections
+        self.retries = retries
+        self.progress = progress
+
+        self.file_name = os.path.split(self.filePath)[-1]
+        self.checkpoint_path = self._checkpoint_path()
+
+        self._uploaded = 0
+        self._lock = threading.Lock()
+
+
+    def _header(self):
+        header = dict()
+        header["Authorization"] = "Oauth {0}".format(self.token)
+        return header
+
+
+    def _retry(self, attempt, e):
+        if attempt >= self.retries:
+            raise
+
+        wait = transport.backoff_delay(attempt)
+
+        if self.logger is not None:
+            self.logger.warning("Retrying SHOCK upload of {0} in {1:.2f}s after error : {2}".format(self.file_name, wait, e))
+
+        time.sleep(wait)
+
+
+    def _send_form(self, method, url, fields, timeout=None):
+        encoder = MultipartEncoder(fields=fields)
+
+        header = self._header()
+        header['Content-Type'] = encoder.content_type
+
+        options = dict()
+
+        # otherwise the transport default
+        if timeout is not None:
+            options["timeout"] = timeout
+
+        response = transport.request(method, url, headers=header, data=encoder,
+                                     allow_redirects=True, verify=self.ssl_verify, **options)
+        return check_response(response)
+
+
+    def _fingerprint(self):
+        stat = os.stat(self.filePath)
+        return {"size": stat.st_size, "mtime": stat.st_mtime, "part_size": self.part_size}
+
+
+    def _checkpoint_path(self):
+        """
+        Path of the checkpoint for this file in UPLOAD_STATE_DIRECTORY, which
+        is created readable only by this user, or None if it can not be used.
+        """
+
+        key = hashlib.sha1(simplejson.dumps([self.filePath, self.shock_service_url, self._fingerprint()],
+                                            sort_keys=True)).hexdigest()
+
+        try:
+            os.makedirs(UPLOAD_STATE_DIRECTORY, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                if self.logger is not None:
+                    self.logger.warning("Not checkpointing the upload of {0} : {1}".format(self.file_name, e))
+                return None
+
+        return os.path.join(UPLOAD_STATE_DIRECTORY, key + CHECKPOINT_SUFFIX)
+
+
+    def _load_checkpoint(self):
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return None, set()
+
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = simplejson.loads(f.read())
+        except Exception:
+            return None, set()
+
+        if checkpoint["file"] != self._fingerprint() or checkpoint["shock_service_url"] != self.shock_service_url:
+            return None, set()
+
+        return checkpoint["node_id"], set(checkpoint["completed"])
+
+
+    def _save_checkpoint(self, node_id, completed):
+        if self.checkpoint_path is None:
+            return
+
+        temp_path = self.checkpoint_path + ".tmp"
+
+        with open(temp_path, 'w') as f:
+            f.write(simplejson.dumps({"file": self._fingerprint(),
+                                      "shock_service_url": self.shock_service_url,
+                                      "node_id": node_id,
+                                      "completed": sorted(completed)}))
+
+        os.rename(temp_path, self.checkpoint_path)
+
+
+    def _report(self, size):
+        with self._lock:
+            self._uploaded += size
+
+            if self.progress is not None:
+                self.progress(self._uploaded)
+
+
+    def create_node(self):
+        """
+        Create a multi-part node that is completed by closing it.
+        """
+
+        attempt = 0
+        while 1:
+            attempt += 1
+
+            try:
+                node = self._send_form("POST", self.shock_service_url + "/node",
+                                       {"parts": "unknown",
+                                        "file_name": self.file_name})
+                return node["id"]
+            except Exception, e:
+                self._retry(attempt, e)
+
+
+    def _open_part(self, part):
+        number, offset, size = part
+        return FileSlice(self.filePath, offset, size)
+
+
+    def upload_part(self, node_id, part):
+        """
+        Upload one part, numbered from 1, retrying it on failure.
+        """
+
+        number, offset, size = part
+
+        attempt = 0
+        while 1:
+            attempt += 1
+
+            data = self._open_part(part)
+            try:
+                # SHOCK answers once the part is written
+                self._send_form("PUT", "{0}/node/{1}".format(self.shock_service_url, node_id),
+                                {str(number): (self.file_name, data)}, transport.LONG_TIMEOUT)
+                break
+            except Exception, e:
+                self._retry(attempt, e)
+            finally:
+                data.close()
+
+        self._report(size)
+        return number
+
+
+    def close_node(self, node_id):
+        """
+        Close the node so SHOCK assembles the parts, returning the node data.
+        """
+
+        attempt = 0
+        while 1:
+            attempt += 1
+
+            try:
+                # SHOCK answers once the parts are joined and checksummed
+                return self._send_form("PUT", "{0}/node/{1}".format(self.shock_service_url, node_id),
+                                       {"parts": "close"}, transport.LONG_TIMEOUT)
+            except Exception, e:
+                self._retry(attempt, e)
+
+
+    def run(self):
+        fileSize = os.path.getsize(self.filePath)
+
+        parts = [(i + 1, offset, min(self.part_size, fileSize - offset))
+                 for i, offset in enumerate(xrange(0, fileSize, self.part_size))]
+
+        node_id, completed = self._load_checkpoint()
+
+        if node_id is None:
+            node_id = self.create_node()
+            completed = set()
+            self._save_checkpoint(node_id, completed)
+        elif self.logger is not None:
+            self.logger.info("Resuming upload of {0} to SHOCK node {1} with {2:d} of {3:d} parts done".format(
+                self.filePath, node_id, len(completed), len(parts)))
+
+        if self.logger is not None:
+            self.logger.info("Sending {0} to {1} in {2:d} parts".format(self.filePath, self.shock_service_url, len(parts)))
+
+        self._report(sum([x[2] for x in parts if x[0] in completed]))
+
+        pending = [x for x in parts if x[0] not in completed]
+
+        pool = multiprocessing.pool.ThreadPool(self.connections)
+        try:
+            for number in pool.imap_unordered(lambda x: self.upload_part(node_id, x), pending):
+                completed.add(number)
+                self._save_checkpoint(node_id, completed)
+
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        node = self.close_node(node_id)
+
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        return node
+
+
+class StreamingUpload(ChunkedUpload):
+    """
+    Writable file object that uploads the data written to it to a new SHOCK
+    node, sending each part from a thread pool as soon as it is full.  Writes
+    block while all connections are busy, so at most connections + 1 parts
+    are held in memory.  A stream cannot be read again, so unlike a file
+    upload it is not resumed after the process exits.
+    """
+
+    def __init__(self, logger = None,
+                 shock_service_url = None,
+                 file_name = None,
+                 ssl_verify = True,
+                 token = None,
+                 part_size = DEFAULT_PART_SIZE,
+                 connections = DEFAULT_CONNECTIONS,
+                 retries = DEFAULT_RETRIES,
+                 progress = None):
+        if token is None:
+            raise Exception("Authentication token required!")
+
+        if file_name is None:
+            raise Exception("No file name given for upload to SHOCK!")
+
+        self.logger = logger
+        self.shock_service_url = shock_service_url
+        self.filePath = None
+        self.file_name = file_name
+        self.ssl_verify = ssl_verify
+        self.token = token
+        self.part_size = part_size
+        self.connections = connections
+        self.retries = retries
+        self.progress = progress
+
+        self._uploaded = 0
+        self._lock = threading.Lock()
+
+        self._node_id = None
+        self._node = None
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(connections)
+        self._pending = list()
+        self._parts = dict()
+        self._buffer = list()
+        self._buffered = 0
+        self._size = 0
+
+
+    def _open_part(self, part):
+        return StringSlice(self._parts[part[0]])
+
+
+    def _upload_part(self, part):
+        try:
+            return self.upload_part(self._node_id, part)
+        finally:
+            del self._parts[part[0]]
+            self._slots.release()
+
+
+    def _check_pending(self):
+        # surface a failed part now rather than after the whole stream is written
+        for x in [x for x in self._pending if x.ready()]:
+            self._pending.remove(x)
+            x.get()
+
+
+    def _send_buffer(self):
+        data = "".join(self._buffer)
+        self._buffer = list()
+        self._buffered = 0
+
+        if self._node_id is None:
+            self._node_id = self.create_node()
+            self._pool = multiprocessing.pool.ThreadPool(self.connections)
+
+            if self.logger is not None:
+                self.logger.info("Streaming {0} to {1} node {2}".format(self.file_name, self.shock_service_url, self._node_id))
+
+        self._slots.acquire()
+
+        part = (self._size // self.part_size + 1, self._size, len(data))
+        self._parts[part[0]] = data
+        self._size += len(data)
+
+        self._pending.append(self._pool.apply_async(self._upload_part, (part,)))
+        self._check_pending()
+
+
+    def write(self, data):
+        if self._node is not None:
+            raise Exception("Upload of {0} is already finished".format(self.file_name))
+
+        while data:
+            wanted = self.part_size - self._buffered
+            self._buffer.append(data[:wanted])
+            self._buffered += len(data[:wanted])
+            data = data[wanted:]
+
+            if self._buffered == self.part_size:
+                self._send_buffer()
+
+
+    def finish(self):
+        """
+        Send the last part, wait for all parts and close the node, returning
+        the node data.
+        """
+
+        if self._node is not None:
+            return self._node
+
+        if self._buffered > 0 or self._node_id is None:
+            self._send_buffer()
+
+        for x in self._pending:
+            x.get()
+
+        self._pending = list()
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+        self._node = self.close_node(self._node_id)
+
+        if self.logger is not None:
+            self.logger.info("Sent {0:d} bytes of {1} to {2}".format(self._size, self.file_name, self.shock_service_url))
+
+        return self._node
+
+
+    def close(self):
+        """
+        Stop an unfinished upload and delete its node, which does nothing
+        after finish().
+        """
+
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+        if self._node is not None or self._node_id is None:
+            return
+
+        try:
+            transport.delete("{0}/node/{1}".format(self.shock_service_url, self._node_id),
+                             headers=self._header(), verify=self.ssl_verify)
+        except Exception, e:
+            if self.logger is not None:
+                self.logger.warning("Unable to delete unfinished SHOCK node {0} : {1}".format(self._node_id, e))
+
+        self._node_id = None
@@ -0,0 +1,200 @@
+"""
+Provides the shared HTTP transport for SHOCK, AWE and other REST services.
+
+A pooled requests.Session is kept per base url, so calls made during a job
+reuse keep-alive connections instead of paying a new TCP and TLS handshake
+each time.  Requests that do not give a timeout get a default one, and
+requests the server answers only after long work, such as assembling an
+upload, give LONG_TIMEOUT.  Idempotent requests are
+retried on connection errors and gateway errors with exponential backoff and
+jitter.
+"""
+
+import os
+import time
+import random
+import urlparse
+import threading
+
+import requests
+import requests.adapters
+
+
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30
+
+# (connect, read) timeouts in seconds, the read timeout is the longest wait
+# between bytes rather than for the whole response
+DEFAULT_TIMEOUT = (30, 300)
+
+# for requests the server answers only once it has stored or copied the data
+LONG_TIMEOUT = (30, 30 * 60)
+
+DEFAULT_POOL_SIZE = 16
+
+# methods that are safe to send again after a failure
+IDEMPOTENT_METHODS = ["GET", "HEAD", "PUT", "DELETE", "OPTIONS"]
+
+RETRY_STATUS_CODES = [502, 503, 504]
+
+_settings = {"retries": DEFAULT_RETRIES,
+             "backoff": DEFAULT_BACKOFF,
+             "max_backoff": DEFAULT_MAX_BACKOFF,
+             "timeout": DEFAULT_TIMEOUT,
+             "pool_size": DEFAULT_POOL_SIZE}
+
+_sessions = dict()
+_sessions_pid = [os.getpid()]
+_sessions_lock = threading.Lock()
+
+
+def configure(retries = None,
+              backoff = None,
+              max_backoff = None,
+              timeout = None,
+              pool_size = None):
+    """
+    Change the transport defaults for this process.  Sessions that already
+    exist are replaced so a new pool size takes effect.
+    """
+
+    for name, value in [("retries", retries),
+                        ("backoff", backoff),
+                        ("max_backoff", max_backoff),
+                        ("timeout", timeout),
+                        ("pool_size", pool_size)]:
+        if value is not None:
+            _settings[name] = value
+
+    close_sessions()
+
+
+def base_url(url=None):
+    """
+    Return the scheme and host part of a url, which sessions are keyed by.
+    """
+
+    parts = urlparse.urlsplit(url)
+    return "{0}://{1}".format(parts.scheme, parts.netloc)
+
+
+def get_session(url=None):
+    """
+    Return the pooled session for the base url of url, creating it if needed.
+    Sessions are not shared with forked child processes.
+    """
+
+    key = base_url(url)
+
+    with _sessions_lock:
+        if _sessions_pid[0] != os.getpid():
+            _sessions.clear()
+            _sessions_pid[0] = os.getpid()
+
+        if key not in _sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=_settings["pool_size"])
+            session.mount(key, adapter)
+            _sessions[key] = session
+
+        return _sessions[key]
+
+
+def close_sessions():
+    """
+    Close every pooled session and its connections.
+    """
+
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+
+        _sessions.clear()
+
+
+def backoff_delay(attempt=1, backoff=None, max_backoff=None):
+    """
+    Seconds to wait before retry number attempt, growing exponentially with
+    full jitter so that concurrent clients do not retry in lock step.
+    """
+
+    if backoff is None:
+        backoff = _settings["backoff"]
+
+    if max_backoff is None:
+        max_backoff = _settings["max_backoff"]
+
+    return random.uniform(0, min(max_backoff, backoff * 2**attempt))
+
+
+def _can_retry(method, kwargs):
+    if method.upper() not in IDEMPOTENT_METHODS:
+        return False
+
+    # a streamed body has been consumed by the failed attempt
+    data = kwargs.get("data")
+
+    return data is None or not hasattr(data, "read")
+
+
+def request(method = None, url = None, retries = None, logger = None, **kwargs):
+    """
+    Send a request over the pooled session for url.  Takes the same keyword
+    arguments as requests.request, and returns the response.  The default
+    timeout applies only if no timeout is given, so timeout=None still waits
+    without limit.
+
+    Idempotent requests without a streamed body are retried up to retries
+    times on connection errors, timeouts and gateway errors.
+    """
+
+    if retries is None:
+        retries = _settings["retries"]
+
+    if not _can_retry(method, kwargs):
+        retries = 0
+
+    kwargs.setdefault("timeout", _settings["timeout"])
+
+    session = get_session(url)
+
+    attempt = 0
+    while 1:
+        attempt += 1
+
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+            if attempt > retries:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt > retries:
+                return response
+
+            e = "HTTP status {0:d}".format(response.status_code)
+            response.close()
+
+        wait = backoff_delay(attempt)
+
+        if logger is not None:
+            logger.warning("Retrying {0} {1} in {2:.2f}s after error : {3}".format(method, url, wait, e))
+
+        time.sleep(wait)
+
+
+def get(url=None, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url=None, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url=None, **kwargs):
+    return request("PUT", url, **kwargs)
+
+
+def delete(url=None, **kwargs):
+    return request("DELETE", url, **kwargs)
@@ -0,0 +1,434 @@
+"""
+Provides a pool of warm worker processes for running taskrunner jobs.
+
+The pool process imports the taskrunners and the plugins that opt in to in
+process execution once, then forks long lived workers that accept job specs
+over a Unix socket.  Each worker forks again for every job, so a job starts
+from the already imported image in milliseconds while no state is carried
+over from one job to the next.  A job returns the same stdout, stderr and
+exit code that running the taskrunner as a command would.
+
+A job spec is sent as one line of JSON, and the caller then keeps the
+connection open until the result arrives.  Closing it early terminates the
+job, which is how a caller cancels a job.
+"""
+
+import sys
+import os
+import errno
+import select
+import signal
+import socket
+import random
+import time
+import runpy
+import tempfile
+
+import simplejson
+
+from biokbase.Transform import handler_utils
+from biokbase.Transform import script_utils
+from biokbase.Transform import scratch
+
+
+DEFAULT_WORKERS = 4
+
+# seconds between checks for a cancelled job
+POLL_INTERVAL = 0.1
+
+# taskrunner scripts run for each driver method
+TASKRUNNERS = {"upload": "trns_upload_taskrunner.py",
+               "download": "trns_download_taskrunner.py",
+               "convert": "trns_convert_taskrunner.py"}
+
+
+def _read_all(connection):
+    chunks = list()
+
+    while 1:
+        data = connection.recv(2**16)
+
+        if not data:
+            break
+
+        chunks.append(data)
+
+    return "".join(chunks)
+
+
+def _read_line(connection):
+    chunks = list()
+
+    while 1:
+        data = connection.recv(2**16)
+
+        if not data:
+            break
+
+        chunks.append(data)
+
+        if "\n" in data:
+            break
+
+    return "".join(chunks).split("\n", 1)[0]
+
+
+def _wait_readable(connection, timeout):
+    try:
+        return len(select.select([connection], [], [], timeout)[0]) > 0
+    except select.error, e:
+        if e.args[0] == errno.EINTR:
+            return False
+        raise
+
+
+def _read_output(f):
+    f.seek(0)
+    return f.read()
+
+
+def run_job(socket_path = None,
+            method = None,
+            arguments = None,
+            environment = None,
+            working_directory = None,
+            stop = None):
+    """
+    Send a job to the worker pool listening on socket_path and wait for it
+    to finish.  The arguments are the taskrunner command line options, and
+    the environment and working directory default to those of the caller.
+    Returns the stdout, stderr and exit code of the taskrunner, or None if
+    the threading.Event stop was set and the job was terminated.
+
+    Raises socket.error only if no pool is listening on socket_path.  Once
+    the job has been sent it may have run, so later failures raise Exception.
+    """
+
+    if environment is None:
+        environment = dict(os.environ)
+
+    if working_directory is None:
+        working_directory = os.getcwd()
+
+    job = {"method": method,
+           "arguments": arguments,
+           "environment": environment,
+           "working_directory": working_directory}
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except socket.error:
+        connection.close()
+        raise
+
+    try:
+        connection.sendall(simplejson.dumps(job) + "\n")
+
+        # closing the connection terminates the job
+        while not _wait_readable(connection, POLL_INTERVAL):
+            if stop is not None and stop.is_set():
+                return None
+
+        response = _read_all(connection)
+    except socket.error, e:
+        raise Exception("Worker pool at {0} failed during the job : {1}".format(socket_path, e))
+    finally:
+        connection.close()
+
+    if not response:
+        raise Exception("Worker pool at {0} closed the connection without a result".format(socket_path))
+
+    result = simplejson.loads(response)
+
+    if "error" in result:
+        raise Exception(result["error"])
+
+    return {"stdout": result["stdout"].decode("base64"),
+            "stderr": result["stderr"].decode("base64"),
+            "exit_code": result["exit_code"]}
+
+
+def _run_taskrunner(path, job):
+    """
+    Run a taskrunner script as __main__ in a forked job process.
+    """
+
+    os.environ.clear()
+    os.environ.update(job["environment"])
+    os.chdir(job["working_directory"])
+
+    # forked jobs would otherwise share the random state of the worker
+    random.seed()
+
+    sys.argv = [path] + [str(x) for x in job["arguments"]]
+    runpy.run_path(path, run_name="__main__")
+
+
+class WorkerPool(object):
+    """
+    Listens on a Unix socket with a fixed number of preforked workers that
+    each run one job at a time.  Workers that exit are replaced.
+    """
+
+    def __init__(self, socket_path = None,
+                 plugin_directory = None,
+                 workers = DEFAULT_WORKERS,
+                 logger = None):
+        if socket_path is None:
+            raise Exception("Must provide a socket path for the worker pool!")
+
+        if logger is None:
+            logger = script_utils.stderrlogger(__file__)
+
+        self.socket_path = socket_path
+        self.plugin_directory = plugin_directory
+        self.workers = workers
+        self.logger = logger
+
+        self.taskrunners = dict()
+        self._listener = None
+        self._worker_pids = set()
+        self._purge_pid = None
+        self._job = None
+        self._stopping = False
+
+
+    def preload(self):
+        """
+        Import the taskrunners and every plugin that can run in process, so
+        that forked workers start with them already loaded.
+        """
+
+        for method in TASKRUNNERS:
+            if handler_utils.load_plugin_module(TASKRUNNERS[method], self.logger) is None:
+                self.logger.warning("Unable to load the {0} taskrunner, {0} jobs will fail".format(method))
+                continue
+
+            self.taskrunners[method] = handler_utils.find_plugin_script(TASKRUNNERS[method])
+
+        if self.plugin_directory is None:
+            return
+
+        plugins = handler_utils.PluginManager(self.plugin_directory, self.logger)
+
+        for script_type in ["validate", "upload", "download", "convert"]:
+            for plugin_config in plugins.scripts_config[script_type].values():
+                options = handler_utils.get_execution_options(plugin_config)
+
+                if not options["in_process"]:
+                    continue
+
+                script_name = plugin_config["script_name"]
+
+                if handler_utils.load_plugin_entry_point(script_name, options["entry_point"], self.logger) is not None:
+                    self.logger.info("Preloaded plugin {0}".format(script_name))
+
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error:
+                # left behind by a pool that did not shut down cleanly
+                os.remove(self.socket_path)
+            else:
+                raise Exception("A worker pool is already listening on {0}".format(self.socket_path))
+            finally:
+                probe.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # jobs run with the environment of the caller, so only the owner may connect
+        umask = os.umask(077)
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+
+        listener.listen(128)
+        return listener
+
+
+    def _handle(self, connection):
+        """
+        Run the job sent on connection, returning its result, or None if
+        the caller closed the connection and the job was terminated.
+        """
+
+        job = simplejson.loads(_read_line(connection))
+
+        if job.get("method") not in self.taskrunners:
+            raise Exception("Unrecognized method {0}.  Unable to begin.".format(job.get("method")))
+
+        path = self.taskrunners[job["method"]]
+
+        stdout = tempfile.TemporaryFile()
+        stderr = tempfile.TemporaryFile()
+        try:
+            self._job = handler_utils.ForkedTask(lambda: _run_taskrunner(path, job),
+                                                 stdout.fileno(),
+                                                 stderr.fileno(),
+                                                 [self._listener.fileno(), connection.fileno()])
+
+            # the caller sends nothing more, so anything readable is the connection closing
+            while self._job.poll() is None:
+                if _wait_readable(connection, POLL_INTERVAL):
+                    self.logger.info("Terminating {0} job for a closed connection".format(job["method"]))
+                    self._job.terminate()
+                    self._job.wait()
+                    self._job = None
+                    return None
+
+            exit_code = self._job.returncode
+            self._job = None
+
+            return {"stdout": _read_output(stdout).encode("base64"),
+                    "stderr": _read_output(stderr).encode("base64"),
+                    "exit_code": exit_code}
+        finally:
+            stdout.close()
+            stderr.close()
+
+
+    def _stop_worker(self, signum, frame):
+        if self._job is not None:
+            self._job.terminate()
+            self._job.wait()
+
+        os._exit(1)
+
+
+    def _worker(self):
+        signal.signal(signal.SIGTERM, self._stop_worker)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        while 1:
+            try:
+                connection, address = self._listener.accept()
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            try:
+                try:
+                    result = self._handle(connection)
+                except Exception, e:
+                    self.logger.exception(e)
+                    result = {"error": str(e)}
+
+                if result is not None:
+                    connection.sendall(simplejson.dumps(result))
+            except socket.error, e:
+                self.logger.warning("Unable to return a job result : {0}".format(e))
+            finally:
+                connection.close()
+
+
+    def _start_worker(self):
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                self._worker()
+            except:
+                self.logger.exception("Worker failed")
+            finally:
+                os._exit(1)
+
+        self._worker_pids.add(pid)
+
+
+    def _start_purge(self):
+        # a process of its own, so that the pool forks workers without threads running
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+                self._listener.close()
+
+                # jobs leave their working directories in the trash for this to remove
+                manager = scratch.ScratchManager(logger=self.logger)
+
+                while 1:
+                    try:
+                        manager.purge()
+                    except Exception, e:
+                        self.logger.warning("Unable to purge the scratch trash : {0}".format(e))
+
+                    time.sleep(scratch.PURGE_INTERVAL)
+            except:
+                self.logger.exception("Scratch purge failed")
+            finally:
+                os._exit(1)
+
+        self._purge_pid = pid
+
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+        for pid in list(self._worker_pids) + [self._purge_pid]:
+            if pid is None:
+                continue
+
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+    def serve(self):
+        """
+        Preload, start the workers and replace them as they exit, until the
+        pool receives SIGTERM or SIGINT.
+        """
+
+        self.preload()
+        self._listener = self._listen()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        self.logger.info("Listening on {0} with {1:d} workers".format(self.socket_path, self.workers))
+
+        try:
+            self._start_purge()
+
+            for i in xrange(self.workers):
+                self._start_worker()
+
+            while len(self._worker_pids) > 0 or self._purge_pid is not None:
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                if pid == self._purge_pid:
+                    self._purge_pid = None
+
+                    if not self._stopping:
+                        self.logger.warning("Scratch purge exited with status {0:d}, starting it again".format(status))
+                        self._start_purge()
+
+                    continue
+
+                self._worker_pids.discard(pid)
+
+                if not self._stopping:
+                    self.logger.warning("Worker {0:d} exited with status {1:d}, starting a new one".format(pid, status))
+                    self._start_worker()
+        finally:
+            self._listener.close()
+
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+        self.logger.info("Worker pool on {0} stopped".format(self.socket_path))
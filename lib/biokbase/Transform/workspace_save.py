@@ -0,0 +1,277 @@
+"""
+Provides a streaming save path into the Workspace service.
+
+Transform output files are already the JSON of the objects being saved, so
+instead of loading them and letting the workspace client serialize them again,
+the bytes of each file are spliced into the save_objects JSON-RPC request body
+as it is sent.  All objects from a job are batched into save_objects calls
+bounded by their total size, and the request body can be gzip compressed.
+Objects saved to the same name are never in one call, so each is saved as a
+version of its own in the order given, as separate saves would.
+"""
+
+import os
+import io
+import zlib
+import random
+
+import simplejson
+
+from biokbase.workspace.client import ServerError
+from biokbase.Transform import transport
+
+
+DEFAULT_BATCH_SIZE = 2**28
+
+# object fields passed through to save_objects as given
+OBJECT_FIELDS = ["type", "name", "objid", "meta", "provenance", "hidden"]
+
+
+class JSONRPCBody(object):
+    """
+    Read-only stream over a sequence of strings and file paths, used as a
+    request body so that object files are read in chunks while sending.  The
+    length is the number of bytes left to read.
+    """
+
+    def __init__(self, pieces=None, chunkSize=2**20):
+        self._pieces = list(pieces)
+        self._chunkSize = chunkSize
+        self._remaining = sum([self._piece_size(x) for x in self._pieces])
+        self._index = 0
+        self._file = None
+
+    def _piece_size(self, piece):
+        if isinstance(piece, tuple):
+            return os.path.getsize(piece[1])
+
+        return len(piece)
+
+    def __len__(self):
+        return self._remaining
+
+    def _next_piece_data(self, size):
+        while self._index < len(self._pieces):
+            piece = self._pieces[self._index]
+
+            if isinstance(piece, tuple):
+                if self._file is None:
+                    self._file = io.open(piece[1], 'rb')
+
+                data = self._file.read(size)
+
+                if data:
+                    return data
+
+                self._file.close()
+                self._file = None
+            elif piece:
+                self._pieces[self._index] = piece[size:]
+                return piece[:size]
+
+            self._index += 1
+
+        return str()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._remaining
+
+        chunks = list()
+        wanted = size
+
+        while wanted > 0:
+            data = self._next_piece_data(wanted)
+
+            if not data:
+                break
+
+            chunks.append(data)
+            wanted -= len(data)
+
+        data = "".join(chunks)
+        self._remaining -= len(data)
+        return data
+
+    def iter_gzip(self):
+        """
+        Yield the body gzip compressed, one chunk at a time.
+        """
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        while 1:
+            data = self.read(self._chunkSize)
+
+            if not data:
+                break
+
+            compressed = compressor.compress(data)
+
+            if compressed:
+                yield compressed
+
+        yield compressor.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _object_size(obj):
+    if "json_file" in obj:
+        return os.path.getsize(obj["json_file"])
+
+    return len(simplejson.dumps(obj["data"]))
+
+
+def _object_pieces(obj):
+    """
+    Serialize an object spec with the data left as a gap to be filled in with
+    the contents of its JSON file.
+    """
+
+    spec = dict([(k, obj[k]) for k in OBJECT_FIELDS if k in obj])
+
+    if "json_file" not in obj:
+        spec["data"] = obj["data"]
+        return [simplejson.dumps(spec)]
+
+    encoded = simplejson.dumps(spec)
+
+    if len(spec) > 0:
+        prefix = encoded[:-1] + ', "data": '
+    else:
+        prefix = '{"data": '
+
+    return [prefix, ("file", obj["json_file"]), "}"]
+
+
+def _object_target(obj):
+    if "objid" in obj:
+        return ("objid", obj["objid"])
+
+    return ("name", obj.get("name"))
+
+
+def batch_objects(objects=None, max_batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Split a list of objects into consecutive batches whose data fits in
+    max_batch_size, with any object larger than that in a batch of its own.
+    A batch is also ended before an object saved to a name or id already in
+    it, so one failed version does not fail the versions saved before it.
+    """
+
+    batches = list()
+    current = list()
+    current_size = 0
+    targets = set()
+
+    for obj in objects:
+        size = _object_size(obj)
+        target = _object_target(obj)
+
+        if len(current) > 0 and (current_size + size > max_batch_size or target in targets):
+            batches.append(current)
+            current = list()
+            current_size = 0
+            targets = set()
+
+        current.append(obj)
+        current_size += size
+        targets.add(target)
+
+    if len(current) > 0:
+        batches.append(current)
+
+    return batches
+
+
+def _call_save_objects(workspace_service_url, token, workspace, objects, compress):
+    method_prefix = simplejson.dumps({"method": "Workspace.save_objects",
+                                      "version": "1.1",
+                                      "id": str(random.random())[2:]})[:-1]
+
+    if isinstance(workspace, int):
+        workspace_spec = simplejson.dumps({"id": workspace})[:-1]
+    else:
+        workspace_spec = simplejson.dumps({"workspace": workspace})[:-1]
+
+    pieces = [method_prefix, ', "params": [', workspace_spec, ', "objects": [']
+
+    for i, obj in enumerate(objects):
+        if i > 0:
+            pieces.append(", ")
+
+        pieces.extend(_object_pieces(obj))
+
+    pieces.append("]}]}")
+
+    header = {"Content-Type": "application/json"}
+
+    if token is not None:
+        header["AUTHORIZATION"] = token
+
+    body = JSONRPCBody(pieces)
+    try:
+        # the workspace answers only once it has validated and stored every object
+        if compress:
+            header["Content-Encoding"] = "gzip"
+            response = transport.post(workspace_service_url, headers=header, data=body.iter_gzip(),
+                                      timeout=transport.LONG_TIMEOUT)
+        else:
+            response = transport.post(workspace_service_url, headers=header, data=body,
+                                      timeout=transport.LONG_TIMEOUT)
+    finally:
+        body.close()
+
+    if response.status_code == 500:
+        if response.headers.get("content-type") == "application/json":
+            error = response.json()
+
+            if "error" in error:
+                raise ServerError(**error["error"])
+
+        raise ServerError("Unknown", 0, response.text)
+
+    if not response.ok:
+        response.raise_for_status()
+
+    result = response.json()
+
+    if "result" not in result:
+        raise ServerError("Unknown", 0, "An unknown server error occurred")
+
+    return result["result"][0]
+
+
+def save_objects(logger = None,
+                 workspace_service_url = None,
+                 workspace = None,
+                 objects = None,
+                 token = None,
+                 max_batch_size = DEFAULT_BATCH_SIZE,
+                 compress = False):
+    """
+    Save objects to a workspace, given by name or numeric id, and return the
+    object info for each in order.
+
+    Each object is a dictionary of save_objects fields, such as type, name,
+    meta and provenance, plus either json_file with the path of a file holding
+    the object data or data with the object itself.
+    """
+
+    if token is None:
+        token = os.environ.get("KB_AUTH_TOKEN")
+
+    infos = list()
+    batches = batch_objects(objects, max_batch_size)
+
+    for i, batch in enumerate(batches):
+        if logger is not None:
+            logger.info("Saving batch {0:d} of {1:d} with {2:d} objects to {3}".format(i + 1, len(batches), len(batch), workspace))
+
+        infos.extend(_call_save_objects(workspace_service_url, token, workspace, batch, compress))
+
+    return infos
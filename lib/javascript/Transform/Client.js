@@ -70,6 +70,36 @@ function Transform(url, auth, auth_cb) {
         deprecationWarning();
         return json_call_ajax("Transform.convert", [args], 1, _callback, _error_callback);
     };
+
+    this.upload_bulk = function (args, _callback, _errorCallback) {
+    return json_call_ajax("Transform.upload_bulk",
+        [args], 1, _callback, _errorCallback);
+};
+
+    this.upload_bulk_async = function (args, _callback, _error_callback) {
+        deprecationWarning();
+        return json_call_ajax("Transform.upload_bulk", [args], 1, _callback, _error_callback);
+    };
+
+    this.download_bulk = function (args, _callback, _errorCallback) {
+    return json_call_ajax("Transform.download_bulk",
+        [args], 1, _callback, _errorCallback);
+};
+
+    this.download_bulk_async = function (args, _callback, _error_callback) {
+        deprecationWarning();
+        return json_call_ajax("Transform.download_bulk", [args], 1, _callback, _error_callback);
+    };
+
+    this.convert_bulk = function (args, _callback, _errorCallback) {
+    return json_call_ajax("Transform.convert_bulk",
+        [args], 1, _callback, _errorCallback);
+};
+
+    this.convert_bulk_async = function (args, _callback, _error_callback) {
+        deprecationWarning();
+        return json_call_ajax("Transform.convert_bulk", [args], 1, _callback, _error_callback);
+    };
  
 
     /*
@@ -14,6 +14,7 @@ from biokbase.workspace.client import Workspace
 from biokbase.userandjobstate.client import UserAndJobState
 from biokbase.Transform import handler_utils
 from biokbase.Transform import script_utils
+from biokbase.Transform import scratch
 
 
 def main():
@@ -201,40 +202,77 @@ def main():
                     "ujs_job_id": args.ujs_job_id,
                     "token": kb_token}
 
-    est = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)    
+    est = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+
+    # progress is sent to UJS in the background, see handler_utils.ProgressReporter
+    progress = handler_utils.ProgressReporter(ujs, args.ujs_job_id, kb_token, est, logger=logger)
+    error_object["progress"] = progress
+
+    # resources used by each step, reported with the job results
+    metrics = handler_utils.JobMetrics("convert",
+                                       {"source_kbase_type": args.source_kbase_type,
+                                        "destination_kbase_type": args.destination_kbase_type,
+                                        "plugin": args.job_details["transform"].get("script_name")},
+                                       logger=logger)
+    error_object["metrics"] = metrics
+
     try:
         if args.ujs_job_id is not None:
-            ujs.update_job_progress(args.ujs_job_id, kb_token, "KBase Object Conversion started", 
-                                    1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+            progress.phase("KBase Object Conversion started")
         else:
             logger.info("KBase Object Conversion started")
 
         logger.info("Executing KBase Conversion tasks")
 
-        if not os.path.exists(args.working_directory):
-            os.mkdir(args.working_directory)
+        # reserve scratch space for the conversion, on tmpfs if it is small
+        object_size = handler_utils.get_object_size(logger = logger,
+                                                    workspace_service_url = args.workspace_service_url,
+                                                    token = kb_token,
+                                                    workspace_name = args.source_workspace_name,
+                                                    object_name = args.source_object_name)
+
+        scratch.ScratchManager(logger=logger).reserve(args.working_directory,
+                                                      scratch.estimate_size(args.job_details["transform"], object_size),
+                                                      allow_tmpfs = not args.keep_working_directory and scratch.use_tmpfs(args.job_details["transform"]))
 
         if args.ujs_job_id is not None:
-            ujs.update_job_progress(args.ujs_job_id, kb_token, 
-                                    "Converting from {0} to {1}".format(args.source_kbase_type,args.destination_kbase_type), 
-                                    1, est.strftime('%Y-%m-%dT%H:%M:%S+0000') )
+            progress.phase("Converting from {0} to {1}".format(args.source_kbase_type,args.destination_kbase_type))
 
         # Step 1 : Convert the objects
+        metrics.start_phase("transform")
         try:
             logger.info(args)
-    
-            convert_args = args.job_details["transform"]
-            convert_args["optional_arguments"] = args.optional_arguments
-            convert_args["working_directory"] = args.working_directory
-            convert_args["workspace_service_url"] = args.workspace_service_url
-            convert_args["source_workspace_name"] = args.source_workspace_name
-            convert_args["source_object_name"] = args.source_object_name
-            convert_args["destination_workspace_name"] = args.destination_workspace_name
-            convert_args["destination_object_name"] = args.destination_object_name
+
+            convert_chain = args.job_details.get("convert_chain", list())
+
+            if len(convert_chain) > 0:
+                # no single plugin converts between the types, convert through intermediate objects
+                task_output = handler_utils.run_convert_chain(logger = logger,
+                                                              chain = [args.job_details["transform"]] + convert_chain,
+                                                              workspace_service_url = args.workspace_service_url,
+                                                              source_workspace_name = args.source_workspace_name,
+                                                              source_object_name = args.source_object_name,
+                                                              destination_workspace_name = args.destination_workspace_name,
+                                                              destination_object_name = args.destination_object_name,
+                                                              working_directory = args.working_directory,
+                                                              optional_arguments = args.optional_arguments,
+                                                              token = kb_token,
+                                                              callback = progress.update)[-1]
+            else:
+                convert_args = args.job_details["transform"]
+                convert_args["optional_arguments"] = args.optional_arguments
+                convert_args["working_directory"] = args.working_directory
+                convert_args["workspace_service_url"] = args.workspace_service_url
+                convert_args["source_workspace_name"] = args.source_workspace_name
+                convert_args["source_object_name"] = args.source_object_name
+                convert_args["destination_workspace_name"] = args.destination_workspace_name
+                convert_args["destination_object_name"] = args.destination_object_name
         
-            logger.info(convert_args)
+                logger.info(convert_args)
         
-            task_output = handler_utils.run_task(logger, convert_args)
+                task_output = handler_utils.run_task(logger, convert_args,
+                                                     callback=progress.update,
+                                                     **handler_utils.get_execution_options(args.job_details["transform"]))
         
             if task_output["stdout"] is not None:
                 logger.debug("STDOUT : " + str(task_output["stdout"]))
@@ -260,13 +298,17 @@ def main():
                 raise
 
     
+        job_metrics = metrics.finish()
+
         # Report progress on the overall task being completed
         if args.ujs_job_id is not None:
+            progress.close()
             ujs.complete_job(args.ujs_job_id, 
                              kb_token, 
                              "Convert to {0} completed".format(args.destination_workspace_name), 
                              None, 
-                             {"shocknodes" : [], 
+                             {"metrics" : job_metrics,
+                              "shocknodes" : [], 
                               "shockurl" : args.shock_service_url, 
                               "workspaceids" : [], 
                               "workspaceurl" : args.workspace_service_url,
@@ -7,8 +7,6 @@ import logging
 import argparse
 import base64
 import traceback
-import tarfile
-import zipfile
 import shutil
 import struct
 
@@ -18,6 +16,9 @@ from biokbase.workspace.client import Workspace
 from biokbase.userandjobstate.client import UserAndJobState
 import biokbase.Transform.handler_utils as handler_utils
 import biokbase.Transform.script_utils as script_utils
+import biokbase.Transform.scratch as scratch
+import biokbase.Transform.archive_utils as archive_utils
+import biokbase.Transform.shock_upload as shock_upload
 
 
 def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
@@ -34,8 +35,8 @@ def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
     
     Step 1 - Convert the objects to local files
     Step 2 - Extract provenance and metadata
-    Step 3 - Package all files into a tarball or zip
-    Step 4 - Upload the compressed file to shock and return the download url
+    Step 3 - Package all files into a zip while uploading it to shock
+    Step 4 - Return the download url
 
     Args:
         workspace_service_url: URL for a KBase Workspace service where KBase objects 
@@ -116,10 +117,22 @@ def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
                     "token": kb_token}
 
     est = datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+
+    # progress is sent to UJS in the background, see handler_utils.ProgressReporter
+    progress = handler_utils.ProgressReporter(ujs, ujs_job_id, kb_token, est, logger=logger)
+    error_object["progress"] = progress
+
+    # resources used by each step, reported with the job results
+    metrics = handler_utils.JobMetrics("download",
+                                       {"kbase_type": kbase_type,
+                                        "external_type": external_type,
+                                        "plugin": job_details["transform"].get("script_name")},
+                                       logger=logger)
+    error_object["metrics"] = metrics
+
     try:
         if ujs_job_id is not None:
-            ujs.update_job_progress(ujs_job_id, kb_token, "KBase Data Download to external formats started", 
-                                    1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+            progress.phase("KBase Data Download to external formats started")
         else:
             logger.info("KBase Data Download to external formats started")
 
@@ -127,21 +140,52 @@ def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
 
         current_directory = os.getcwd()
     
-        if not os.path.exists(working_directory):
-            os.mkdir(working_directory)
+        # reserve scratch space for the files made from the object, on tmpfs if it is small
+        object_size = handler_utils.get_object_size(logger = logger,
+                                                    workspace_service_url = workspace_service_url,
+                                                    token = kb_token,
+                                                    workspace_name = workspace_name,
+                                                    object_name = object_name,
+                                                    object_id = object_id)
+
+        scratch.ScratchManager(logger=logger).reserve(working_directory,
+                                                      scratch.estimate_size(job_details["transform"], object_size),
+                                                      allow_tmpfs = not keep_working_directory and scratch.use_tmpfs(job_details["transform"]))
 
         # setup subdirectories to pass to subtasks for working directories
         transform_directory = os.path.join(working_directory, "user_external")
 
         if ujs_job_id is not None:
-            ujs.update_job_progress(ujs_job_id, kb_token, 
-                                    "Gathering workspace data from {0}".format(workspace_name)[:handler_utils.UJS_STATUS_MAX], 
-                                    1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+            progress.phase("Gathering workspace data from {0}".format(workspace_name)[:handler_utils.UJS_STATUS_MAX])
         else:
             logger.info("Gathering workspace data from {0}".format(workspace_name))
 
         # Step 1 : Call the transform task to convert the objects to local files
+        metrics.start_phase("transform")
+
+        # without a direct plugin, convert plugins first save an intermediate object to download
+        convert_chain = job_details.get("convert_chain", list())
+        source_object_name = object_name
+        source_object_id = object_id
+
         try:
+            if len(convert_chain) > 0:
+                source_object_name = handler_utils.intermediate_object_name(object_name, len(convert_chain))
+                source_object_id = None
+
+                handler_utils.run_convert_chain(logger = logger,
+                                                chain = convert_chain,
+                                                workspace_service_url = workspace_service_url,
+                                                source_workspace_name = workspace_name,
+                                                source_object_name = object_name,
+                                                destination_workspace_name = workspace_name,
+                                                destination_object_name = source_object_name,
+                                                working_directory = working_directory,
+                                                optional_arguments = optional_arguments,
+                                                token = kb_token,
+                                                callback = progress.update,
+                                                debug = debug)
+
             os.mkdir(transform_directory)        
             os.chdir(transform_directory)
 
@@ -153,8 +197,8 @@ def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
             copy_fields["handle_service_url"] = handle_service_url
             copy_fields["fba_service_url"] = fba_service_url
             copy_fields["workspace_name"] = workspace_name
-            copy_fields["object_name"] = object_name
-            copy_fields["object_id"] = object_id     
+            copy_fields["object_name"] = source_object_name
+            copy_fields["object_id"] = source_object_id
         
             transformation_args = dict()
             transformation_args["script_name"] = job_details["transform"]["script_name"]
@@ -193,7 +237,14 @@ def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
 
             logger.debug(transformation_args)
 
-            task_output = handler_utils.run_task(logger, transformation_args, debug=debug)
+            try:
+                task_output = handler_utils.run_task(logger, transformation_args, debug=debug,
+                                                     callback=progress.update,
+                                                     **handler_utils.get_execution_options(job_details["transform"]))
+            finally:
+                if len(convert_chain) > 0:
+                    handler_utils.delete_workspace_objects(logger, workspace_service_url, kb_token,
+                                                           workspace_name, [source_object_name])
         
             if task_output["stdout"] is not None:
                 logger.debug("STDOUT : " + str(task_output["stdout"]))
@@ -226,8 +277,7 @@ def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
 
         # Report progress on success of the download step
         if ujs_job_id is not None:
-            ujs.update_job_progress(ujs_job_id, kb_token, "Workspace objects transformed to {0}".format(external_type)[:handler_utils.UJS_STATUS_MAX], 
-                                    1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+            progress.phase("Workspace objects transformed to {0}".format(external_type)[:handler_utils.UJS_STATUS_MAX])
         else:
             logger.info("Workspace objects transformed to {0}".format(external_type))
 
@@ -236,6 +286,8 @@ def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
         #
 
         # Step 2: Extract provenance and metadata
+        metrics.start_phase("provenance")
+        metrics.details["output_bytes"] = handler_utils.directory_size(transform_directory)
         try:    
             workspaceClient = Workspace(url=workspace_service_url, token=kb_token)
         
@@ -280,6 +332,7 @@ def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
     
         shock_id = None
         # Step 3: Package data files into a single compressed file and send to shock
+        metrics.start_phase("save")
         try:
             workspace_id = object_details["metadata"][0][4]
             object_version = object_details["metadata"][0][2]
@@ -287,34 +340,23 @@ def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
             name = "KBase_{0}_{1}_{2}".format(workspace_name, object_name, object_version)
 
             # gather a list of all files downloaded
-            files = [x for x in handler_utils.gen_recursive_filelist(transform_directory)]
-
-            # gather total size of all files
-            total = 0
-            for x in files:
-                total += os.path.getsize(x)
-
-            # TODO
-            # Workaround for Python 2.7.3 bug 9720, http://bugs.python.org/issue9720
-            # The awe workers and KBase V26 are at Python 2.7.3 and we should migrate
-            # to the same version of Python that Narrative uses, which is currently
-            # Python 2.7.6, after which this workaround can be removed                    
-            if total < 2**31:
-                archive_name = os.path.join(working_directory, name) + ".zip"
-                with zipfile.ZipFile(archive_name, 'w', zipfile.ZIP_DEFLATED) as archive:
-                    for n in files:
-                        archive.write(n, arcname=os.path.join(name, n.split(transform_directory + os.sep)[1]))
-            else:
-                archive_name = os.path.join(working_directory, name) + ".tar.bz2"
-                with tarfile.open(archive_name, 'w:bz2') as archive:
-                    for n in files:
-                        archive.add(n, arcname=os.path.join(name, n.split(transform_directory + os.sep)[1]))
-                
-        
-            shock_info = script_utils.upload_file_to_shock(logger = logger,
-                                                           shock_service_url = shock_service_url,
-                                                           filePath = archive_name,
-                                                           token= kb_token)
+            files = [(x, os.path.join(name, x.split(transform_directory + os.sep)[1]))
+                     for x in handler_utils.gen_recursive_filelist(transform_directory)]
+
+            # the archive is streamed into SHOCK parts as it is compressed,
+            # so it is never written to the working directory
+            upload = shock_upload.StreamingUpload(logger = logger,
+                                                  shock_service_url = shock_service_url,
+                                                  file_name = name + ".zip",
+                                                  token = kb_token)
+            try:
+                archive_utils.write_zip(logger = logger,
+                                        fileobj = upload,
+                                        files = files)
+                shock_info = upload.finish()
+            finally:
+                upload.close()
+
             shock_id = shock_info["id"]
         except Exception, e:
             logger.debug("Caught exception while creating archive and sending to SHOCK!")
@@ -336,13 +378,17 @@ def download_taskrunner(ujs_service_url = None, workspace_service_url = None,
                 logger.error("Download from {0} failed.".format(workspace_name))
                 raise
     
+        job_metrics = metrics.finish()
+
         # Report progress on the overall task being completed
         if ujs_job_id is not None:
+            progress.close()
             ujs.complete_job(ujs_job_id, 
                              kb_token, 
                              "Download from {0} completed".format(workspace_name), 
                              None, 
-                             {"shocknodes" : ["{0}/node/{1}?download_raw".format(shock_service_url,shock_id)], 
+                             {"metrics" : job_metrics,
+                              "shocknodes" : ["{0}/node/{1}?download_raw".format(shock_service_url,shock_id)], 
                               "shockurl" : shock_service_url, 
                               "results" : [{"server_type" : "Shock", 
                                             "url" : "{0}/node/{1}?download_raw".format(shock_service_url,shock_id), 
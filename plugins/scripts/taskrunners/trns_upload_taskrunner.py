@@ -14,6 +14,8 @@ from biokbase.workspace.client import Workspace
 from biokbase.userandjobstate.client import UserAndJobState
 import biokbase.Transform.handler_utils as handler_utils
 import biokbase.Transform.script_utils as script_utils
+import biokbase.Transform.scratch as scratch
+import biokbase.Transform.workspace_save as workspace_save
 
 
 def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
@@ -120,15 +122,45 @@ def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
                     "token": kb_token}
 
     est = datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+
+    # progress is sent to UJS in the background, see handler_utils.ProgressReporter
+    progress = handler_utils.ProgressReporter(ujs, ujs_job_id, kb_token, est, logger=logger)
+    error_object["progress"] = progress
+
+    # resources used by each step, reported with the job results
+    metrics = handler_utils.JobMetrics("upload",
+                                       {"external_type": external_type,
+                                        "kbase_type": kbase_type,
+                                        "plugin": job_details["transform"].get("script_name")},
+                                       logger=logger)
+    error_object["metrics"] = metrics
+
+    # working directory space is reserved from the size of the urls, and again once the input is downloaded
+    scratch_manager = scratch.ScratchManager(logger=logger)
+
+    # without a direct plugin, the upload saves an intermediate object that convert plugins continue from
+    convert_chain = job_details.get("convert_chain", list())
+    destination_object_name = object_name
+    destination_kbase_type = kbase_type
+
+    if len(convert_chain) > 0:
+        object_name = handler_utils.intermediate_object_name(destination_object_name, 0)
+        object_id = None
+        kbase_type = job_details["transform"]["kbase_type"]
+
     try:
         if ujs_job_id is not None:
-            ujs.update_job_progress(ujs_job_id, kb_token, "KBase Data Upload started", 
-                                    1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+            progress.phase("KBase Data Upload started")
         else:
             logger.info("KBase Data Upload started")
 
-        if not os.path.exists(working_directory):
-            os.mkdir(working_directory)
+        # small inputs are run on tmpfs, inputs of unknown size never are
+        url_bytes = script_utils.get_urls_size(logger, url_mapping, token=kb_token)
+
+        scratch_manager.reserve(working_directory,
+                                scratch.estimate_size(job_details["transform"], url_bytes or 0),
+                                allow_tmpfs = url_bytes is not None and not keep_working_directory and \
+                                              scratch.use_tmpfs(job_details["transform"]))
 
         # setup subdirectories to pass to subtasks for working directories
         download_directory = os.path.join(working_directory, "user_external")
@@ -136,14 +168,13 @@ def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
         transform_directory = os.path.join(working_directory, "objects")
 
         if ujs_job_id is not None:
-            ujs.update_job_progress(ujs_job_id, kb_token, 
-                                    "Downloading input data", 
-                                    1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+            progress.phase("Downloading input data")
         else:
             logger.info("Downloading input data")
 
         
         # Step 1 : Download the data to disk
+        metrics.start_phase("download")
         try:
             os.mkdir(download_directory)
             script_utils.download_from_urls(logger, 
@@ -164,23 +195,26 @@ def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
                 logger.error("Upload to {0} failed.".format(workspace_name))
                 raise
 
+        metrics.details["input_bytes"] = handler_utils.directory_size(download_directory)
+        scratch_manager.reserve(working_directory,
+                                scratch.estimate_size(job_details["transform"], metrics.details["input_bytes"]))
+
         # Report progress on success of the download step
         if ujs_job_id is not None:
-            ujs.update_job_progress(ujs_job_id, kb_token, "Input data download completed", 
-                                    1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+            progress.phase("Input data download completed")
         else:
             logger.info("Input data download completed")            
 
         logger.debug(job_details)
         
         # Step 2 : Validate the data files, if there is a separate validation script
+        metrics.start_phase("validate")
         if job_details.has_key("validate") and \
            job_details["transform"]["handler_options"].has_key("must_own_validation") and \
            not job_details["transform"]["handler_options"]["must_own_validation"]:        
             try:
                 if ujs_job_id is not None:
-                    ujs.update_job_progress(ujs_job_id, kb_token, "Validation started", 
-                                            1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+                    progress.phase("Validation started")
                 else:
                     logger.info("Validation started")            
 
@@ -256,14 +290,14 @@ def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
                         if ujs_job_id is not None:
                             # Update on validation steps
                             logger.info("UJS message : " + "Attempting to validate {0}".format(filename)[:handler_utils.UJS_STATUS_MAX])
-                            ujs.update_job_progress(ujs_job_id, kb_token, "Attempting to validate {0}".format(filename)[:handler_utils.UJS_STATUS_MAX], 
-                                                    1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+                            progress.phase("Attempting to validate {0}".format(filename)[:handler_utils.UJS_STATUS_MAX])
 
-                            task_output = handler_utils.run_task(logger, validation_args, callback=lambda msg: \
-                                ujs.update_job_progress(ujs_job_id, kb_token, msg[:handler_utils.UJS_STATUS_MAX], 1, est.strftime('%Y-%m-%dT%H:%M:%S+0000')))
+                            task_output = handler_utils.run_task(logger, validation_args, callback=progress.update,
+                                **handler_utils.get_execution_options(job_details["validate"]))
                         else:
                             logger.info("Attempting to validate {0}".format(filename))
-                            task_output = handler_utils.run_task(logger, validation_args)
+                            task_output = handler_utils.run_task(logger, validation_args,
+                                                                 **handler_utils.get_execution_options(job_details["validate"]))
                     except Exception, e:
                         logger.debug("Caught exception while validating!")
 
@@ -299,8 +333,7 @@ def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
                     if ujs_job_id is not None:
                         logger.info("UJS message : " + "Validation completed on {0}".format(filename)[:handler_utils.UJS_STATUS_MAX])
                         # Update on validation steps
-                        ujs.update_job_progress(ujs_job_id, kb_token, "Validation completed on {0}".format(filename)[:handler_utils.UJS_STATUS_MAX], 
-                                                1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+                        progress.phase("Validation completed on {0}".format(filename)[:handler_utils.UJS_STATUS_MAX])
                     else:
                         logger.info("Validation completed on {0}".format(filename))
             except Exception, e:
@@ -320,24 +353,25 @@ def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
 
             # Report progress on success of validation step
             if ujs_job_id is not None:
-                ujs.update_job_progress(ujs_job_id, kb_token, 'Input data has passed validation', 1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+                progress.phase('Input data has passed validation')
             else:
                 logger.info("Input data has passed validation")
         else:
             if ujs_job_id is not None:
-                ujs.update_job_progress(ujs_job_id, kb_token, 'Validation not available, skipping.', 1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+                progress.phase('Validation not available, skipping.')
             else:
                 logger.warning("Validation not available, skipping.")
 
 
         # Report progress of transformation about to begin
         if ujs_job_id is not None:
-            ujs.update_job_progress(ujs_job_id, kb_token, 'Performing data transformation to KBase', 1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+            progress.phase('Performing data transformation to KBase')
         else:
             logger.info("Performing data transformation to KBase")
 
         
         # Step 3: Transform the data
+        metrics.start_phase("transform")
         try:
             copy_fields = dict()
             copy_fields["workspace_service_url"] = workspace_service_url
@@ -426,9 +460,11 @@ def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
             try:
                 if ujs_job_id is not None:
                     task_output = handler_utils.run_task(logger, transformation_args, debug=debug, callback=lambda msg: \
-                        ujs.update_job_progress(ujs_job_id, kb_token, msg[-handler_utils.UJS_STATUS_MAX:], 1, est.strftime('%Y-%m-%dT%H:%M:%S+0000')))
+                        progress.update(msg[-handler_utils.UJS_STATUS_MAX:]),
+                        **handler_utils.get_execution_options(job_details["transform"]))
                 else:
-                    task_output = handler_utils.run_task(logger, transformation_args, debug=debug)
+                    task_output = handler_utils.run_task(logger, transformation_args, debug=debug,
+                                                         **handler_utils.get_execution_options(job_details["transform"]))
             except Exception, e:
                 if ujs_job_id is not None:                    
                     task_output = dict()
@@ -476,14 +512,18 @@ def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
         logger.debug(job_details["transform"]["handler_options"])
 
         # Step 4: Save the data to the Workspace
+        metrics.start_phase("save")
+
+        # the version saved by this job, taken from the save reply since a later
+        # save to the same name makes another version, None if a plugin saved it
+        object_ref = None
+
         if not job_details["transform"]["handler_options"].has_key("must_own_saving_to_workspace") or \
            not job_details["transform"]["handler_options"]["must_own_saving_to_workspace"]:        
 
             # Report progress on success of transform step
             if ujs_job_id is not None:
-                ujs.update_job_progress(ujs_job_id, kb_token, 
-                                        'Data is in a KBase format, preparing to save...', 
-                                        1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+                progress.phase('Data is in a KBase format, preparing to save...')
             else:
                 logger.info("Data is in a KBase format, preparing to save...")
 
@@ -492,45 +532,47 @@ def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
         
                 assert len(files) != 0
         
+                objects = list()
                 for f in files:
                     path = os.path.join(transform_directory, f)
             
                     if os.path.isfile(path):
-                        object_details = dict()
-                        object_details["workspace_service_url"] = workspace_service_url
-                        object_details["workspace_name"] = workspace_name
-                        object_details["object_name"] = object_name
-                        object_details["kbase_type"] = kbase_type
-                        object_details["object_meta"] = {}
-                        object_details["provenance"] = [{
-                            "time": datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S+0000'),
-                            "service": "KBase Transform",
-                            "service_ver": "0.1",
-                            "method": "upload",
-                            "method_params": [kbase_type,
-                                              external_type,
-                                              workspace_name,
-                                              object_name,
-                                              url_mapping,
-                                              optional_arguments],
-                            "script": __file__,
-                            "script_ver": "0.0.1",
-                            "description": "KBase Upload"}]
+                        objects.append({"type": kbase_type,
+                                        "json_file": path,
+                                        "name": object_name,
+                                        "meta": {},
+                                        "provenance": [{
+                                            "time": datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S+0000'),
+                                            "service": "KBase Transform",
+                                            "service_ver": "0.1",
+                                            "method": "upload",
+                                            "method_params": [kbase_type,
+                                                              external_type,
+                                                              workspace_name,
+                                                              object_name,
+                                                              url_mapping,
+                                                              optional_arguments],
+                                            "script": __file__,
+                                            "script_ver": "0.0.1",
+                                            "description": "KBase Upload"}]})
+
+                # stream every output object to the workspace in size bounded batches
+                saved = workspace_save.save_objects(logger = logger,
+                                                    workspace_service_url = workspace_service_url,
+                                                    workspace = workspace_name,
+                                                    objects = objects,
+                                                    token = kb_token)
                 
-                        script_utils.save_json_to_workspace(logger = logger,
-                                                            json_file = path,
-                                                            workspace_service_url = workspace_service_url,
-                                                            object_details = object_details,
-                                                            token = kb_token)
-                
-                        # Report progress on success of saving the object
-                        if ujs_job_id is not None:
-                            ujs.update_job_progress(ujs_job_id, 
-                                                    kb_token, 
-                                                    "Saved object {0} to {1}".format(object_name, workspace_name)[:handler_utils.UJS_STATUS_MAX], 
-                                                    1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
-                        else:
-                            logger.info("Saved object {0} to {1}".format(object_name, workspace_name))
+                for object_info in saved:
+                    # Report progress on success of saving the object
+                    if ujs_job_id is not None:
+                        progress.update("Saved object {0} to {1}".format(object_info[1], workspace_name)[:handler_utils.UJS_STATUS_MAX])
+                    else:
+                        logger.info("Saved object {0} to {1}".format(object_info[1], workspace_name))
+
+                # outputs that share the object name are saved in order, so the last is the version left
+                if len(saved) > 0:
+                    object_ref = "{0}/{1}/{2}".format(saved[-1][6], saved[-1][0], saved[-1][4])
                         
             except Exception, e:
                 logger.debug("Caught exception while trying to save objects!")
@@ -547,37 +589,86 @@ def upload_taskrunner(ujs_service_url = None, workspace_service_url = None,
                     raise                    
     
             if ujs_job_id is not None:
-                ujs.update_job_progress(ujs_job_id, kb_token, 
-                                        'Objects saved to {0}'.format(workspace_name)[:handler_utils.UJS_STATUS_MAX], 
-                                        1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+                progress.phase('Objects saved to {0}'.format(workspace_name)[:handler_utils.UJS_STATUS_MAX])
             else:
                 logger.info("Objects saved to {0}".format(workspace_name))
             
         else:
             # Report progress on success of transform step
             if ujs_job_id is not None:
-                ujs.update_job_progress(ujs_job_id, kb_token, 
-                                        'Data is in a KBase format and objects saved to {0}'.format(workspace_name)[:handler_utils.UJS_STATUS_MAX], 
-                                        1, est.strftime('%Y-%m-%dT%H:%M:%S+0000'))
+                progress.phase('Data is in a KBase format and objects saved to {0}'.format(workspace_name)[:handler_utils.UJS_STATUS_MAX])
             else:
                 logger.info("Data is in a KBase format and objects saved to {0}".format(workspace_name))
         
+
+        # Step 5: Convert the saved object to the requested type
+        if len(convert_chain) > 0:
+            metrics.start_phase("convert")
+
+            if ujs_job_id is not None:
+                progress.phase("Converting from {0} to {1}".format(kbase_type, destination_kbase_type)[:handler_utils.UJS_STATUS_MAX])
+            else:
+                logger.info("Converting from {0} to {1}".format(kbase_type, destination_kbase_type))
+
+            try:
+                handler_utils.run_convert_chain(logger = logger,
+                                                chain = convert_chain,
+                                                workspace_service_url = workspace_service_url,
+                                                source_workspace_name = workspace_name,
+                                                source_object_name = object_name,
+                                                destination_workspace_name = workspace_name,
+                                                destination_object_name = destination_object_name,
+                                                working_directory = working_directory,
+                                                optional_arguments = optional_arguments,
+                                                token = kb_token,
+                                                callback = progress.update,
+                                                debug = debug,
+                                                delete_source = True)
+            except Exception, e:
+                logger.debug("Caught exception while converting objects!")
+
+                if ujs_job_id is not None:
+                    error_object["status"] = "ERROR : Converting object {0} to {1} - {2}".format(object_name, destination_kbase_type, e.message)[:handler_utils.UJS_STATUS_MAX]
+                    error_object["error_message"] = traceback.format_exc()
+
+                    handler_utils.report_exception(logger, error_object, cleanup_details)
+                    sys.exit(1)
+                else:
+                    logger.error("Converting object {0} to {1}".format(object_name, destination_kbase_type))
+                    logger.error("Upload to {0} failed.".format(workspace_name))
+                    raise
+
+            object_name = destination_object_name
+            kbase_type = destination_kbase_type
+
+            # the converted object is saved by the plugin
+            object_ref = None
     
+        job_metrics = metrics.finish()
+
         # Report progress on the overall task being completed
         if ujs_job_id is not None:
+            result = {"server_type" : "Workspace", 
+                      "url" : workspace_service_url, 
+                      "id" : "{}/{}".format(workspace_name, 
+                                            object_name), 
+                      "description" : "description"}
+
+            # the job cache reuses only the version this job saved
+            if object_ref is not None:
+                result["ref"] = object_ref
+
+            progress.close()
             ujs.complete_job(ujs_job_id, 
                              kb_token, 
                              "Upload to {0} completed".format(workspace_name)[:handler_utils.UJS_STATUS_MAX], 
                              None, 
-                             {"shocknodes" : [], 
+                             {"metrics" : job_metrics,
+                              "shocknodes" : [], 
                               "shockurl" : shock_service_url, 
                               "workspaceids" : [], 
                               "workspaceurl" : workspace_service_url,
-                              "results" : [{"server_type" : "Workspace", 
-                                            "url" : workspace_service_url, 
-                                            "id" : "{}/{}".format(workspace_name, 
-                                                                  object_name), 
-                                            "description" : "description"}]})
+                              "results" : [result]})
         else:
             logger.info("Upload to {0} completed".format(workspace_name))
     
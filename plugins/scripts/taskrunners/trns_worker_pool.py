@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import sys
+import os
+
+from biokbase.Transform import script_utils
+from biokbase.Transform import worker_pool
+
+
+def main():
+    """
+    KBase Transform worker pool for running upload, download and convert taskrunners
+    from preforked workers that have the taskrunners and in process plugins already
+    imported.  Jobs are sent to the pool by TransformTaskRunnerDriver when it is
+    given the socket path.
+
+    Args:
+        socket_path: Path of the Unix socket to accept jobs on.
+        plugin_directory: Directory of plugin configs, used to find the plugins to
+                          preload.
+        workers: Number of jobs that can run at the same time.
+
+    Returns:
+        Runs until it receives SIGTERM or SIGINT.
+
+    Authors:
+        KBase Transform
+    """
+
+    script_details = script_utils.parse_docs(main.__doc__)
+
+    parser = script_utils.ArgumentParser(description=script_details["Description"],
+                                         epilog=script_details["Authors"])
+    parser.add_argument('--socket_path',
+                        help=script_details["Args"]["socket_path"],
+                        action='store',
+                        required=True)
+    parser.add_argument('--plugin_directory',
+                        help=script_details["Args"]["plugin_directory"],
+                        action='store',
+                        default=None)
+    parser.add_argument('--workers',
+                        help=script_details["Args"]["workers"],
+                        action='store',
+                        type=int,
+                        default=worker_pool.DEFAULT_WORKERS)
+
+    args, unknown = parser.parse_known_args()
+
+    logger = script_utils.stderrlogger(__file__)
+
+    pool = worker_pool.WorkerPool(socket_path = args.socket_path,
+                                  plugin_directory = args.plugin_directory,
+                                  workers = args.workers,
+                                  logger = logger)
+    pool.serve()
+
+
+if __name__ == "__main__":
+    main()
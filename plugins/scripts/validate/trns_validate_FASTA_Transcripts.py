@@ -12,6 +12,9 @@ import json
 import gzip
 import io
 import cStringIO
+import shutil
+
+from biokbase.Transform import compression_utils
 
 desc1 = '''
 NAME
@@ -94,12 +97,8 @@ def validate_fasta(filename):
                 ext = os.path.splitext(filename)[-1]
                 if ext == '.gz':
                         decomp_file = os.path.splitext(filename)[-2]
-                        p = subprocess.Popen(["zcat", filename], stdout = subprocess.PIPE)
-                        fh = io_method(p.communicate()[0])
-                        assert p.returncode == 0
-                        text_file = open(decomp_file, "w")
-                        text_file.write(fh.getvalue())
-                        text_file.close()
+                        with compression_utils.open_decompressed(filename, "gzip") as fh, open(decomp_file, "wb") as text_file:
+                            shutil.copyfileobj(fh, text_file, 2**22)
                 if ext == '.gz':
                         cmd2 = ["java","-classpath",impt,mc,os.path.splitext(filename)[-2]]
 		else:
@@ -12,10 +12,13 @@ import json
 import gzip
 import io
 import cStringIO
+import shutil
 import pipes
 import tempfile
 import re
 
+from biokbase.Transform import compression_utils
+
 desc1 = '''
 NAME
       trns_validate_KBaseAssembly.FQ -- Validate the fastq files (1.0)
@@ -142,12 +145,8 @@ class Validate(object):
 			ext = os.path.splitext(filename)[-1]
         	        if ext == '.gz':
                 	        decomp_file = os.path.splitext(filename)[-2]
-                       		p = subprocess.Popen(["zcat", filename], stdout = subprocess.PIPE)
-                        	fh = io_method(p.communicate()[0])
-                       		assert p.returncode == 0
-                        	text_file = open(decomp_file, "w")
-                        	text_file.write(fh.getvalue())
-                        	text_file.close()
+                       		with compression_utils.open_decompressed(filename, "gzip") as fh, open(decomp_file, "wb") as text_file:
+                       		    shutil.copyfileobj(fh, text_file, 2**22)
 				#print(decomp_file)
 				stat = check_interleavedPE(decomp_file)
 				#print("stat from gz option" + stat)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+'''
+Unit tests for the streaming zip writer in biokbase.Transform.archive_utils.
+
+These need no KBase services and can be run with nosetests or py.test.
+'''
+import os
+import io
+import sys
+import gzip
+import shutil
+import struct
+import zipfile
+import tempfile
+
+FILE_LOC = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(FILE_LOC, '../../../lib'))
+
+from biokbase.Transform import archive_utils
+
+
+class WriteOnly(object):
+    # a pipe or socket, which can not seek or tell
+    def __init__(self):
+        self.buf = io.BytesIO()
+
+    def write(self, data):
+        self.buf.write(data)
+
+
+class TestZipWriter(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name)
+
+        with io.open(path, 'wb') as f:
+            f.write(data)
+
+        return path
+
+    def test_round_trip_across_chunks(self):
+        contents = {"a.txt": "".join(["row {0:d}\t{1:d}\n".format(i, i * i) for i in xrange(20000)]),
+                    "empty.txt": "",
+                    "b.bin": os.urandom(50000)}
+
+        files = [(self._write(name, data), name) for name, data in sorted(contents.items())]
+
+        output = WriteOnly()
+        archive_utils.write_zip(None, output, files, threads=4, chunk_size=4096)
+
+        archive = zipfile.ZipFile(io.BytesIO(output.buf.getvalue()))
+
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == sorted(contents)
+
+        for name in contents:
+            assert archive.read(name) == contents[name]
+
+        assert archive.getinfo("a.txt").compress_type == zipfile.ZIP_DEFLATED
+
+    def test_compressed_member_is_stored(self):
+        path = os.path.join(self.directory, "reads.fastq.gz")
+
+        f = gzip.open(path, 'wb')
+        f.write("@read\nACGT\n+\nIIII\n" * 1000)
+        f.close()
+
+        archive_name = os.path.join(self.directory, "out.zip")
+        archive_utils.create_zip(None, archive_name, [(path, u"reads.fastq.gz")], threads=2)
+
+        archive = zipfile.ZipFile(archive_name)
+
+        assert archive.getinfo("reads.fastq.gz").compress_type == zipfile.ZIP_STORED
+
+        with open(path, 'rb') as f:
+            assert archive.read("reads.fastq.gz") == f.read()
+
+    def test_large_member_has_zip64_local_header(self):
+        member = archive_utils._Member(self._write("small", "x"), "big")
+        member.zip64 = True
+
+        output = io.BytesIO()
+        writer = archive_utils.ZipWriter(output, threads=1)
+        writer._write_local_header(member)
+
+        header = archive_utils.LOCAL_HEADER.unpack(output.getvalue()[:archive_utils.LOCAL_HEADER.size])
+
+        assert header[1] == archive_utils.ZIP64_VERSION
+        assert header[7] == header[8] == archive_utils.ZIP64_LIMIT
+
+        extra = output.getvalue()[archive_utils.LOCAL_HEADER.size + len("big"):]
+        assert struct.unpack("<HH", extra[:4]) == (0x0001, 16)
+
+    def test_zip64_central_directory(self):
+        # only the records written by close() are checked, for a member past 4 GB
+        member = archive_utils._Member(self._write("small", "x"), "huge.txt")
+        member.zip64 = True
+        member.file_size = 5 * 2**30
+        member.compressed_size = 5 * 2**30 + 123
+        member.offset = 2**32 + 10
+        member.crc = 1234
+
+        output = io.BytesIO()
+        writer = archive_utils.ZipWriter(output, threads=1)
+        writer.members.append(member)
+        writer.offset = member.offset + 2**33
+
+        writer.close()
+
+        data = output.getvalue()
+
+        assert "PK\x06\x06" in data and "PK\x06\x07" in data
+
+        info = zipfile.ZipFile(io.BytesIO(data)).getinfo("huge.txt")
+
+        assert info.file_size == member.file_size
+        assert info.compress_size == member.compressed_size
+        assert info.CRC == member.crc
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+'''
+Unit tests for reading truncated and corrupt input with
+biokbase.Transform.compression_utils.
+
+These need no KBase services and can be run with nosetests or py.test.
+'''
+import os
+import io
+import sys
+import bz2
+import gzip
+import shutil
+import tempfile
+
+FILE_LOC = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(FILE_LOC, '../../../lib'))
+
+from biokbase.Transform import compression_utils
+
+
+DATA = "".join(["line {0:d} of the test input\n".format(i) for i in xrange(20000)])
+
+
+class TestTruncatedInput(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name)
+
+        with io.open(path, 'wb') as f:
+            f.write(data)
+
+        return path
+
+    def _gzip(self, data):
+        buf = io.BytesIO()
+
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write(data)
+        f.close()
+
+        return buf.getvalue()
+
+    def _read(self, path, compression):
+        stream = compression_utils.open_decompressed(path, compression, threads=1)
+
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+    def _assert_corrupt(self, path, compression):
+        try:
+            self._read(path, compression)
+        except Exception, e:
+            assert "Truncated or corrupt {0}".format(compression) in str(e), str(e)
+        else:
+            raise AssertionError("{0} read without an error".format(path))
+
+    def test_complete_gzip(self):
+        path = self._write("complete.gz", self._gzip(DATA))
+
+        assert self._read(path, "gzip") == DATA
+
+    def test_gzip_without_trailer(self):
+        self._assert_corrupt(self._write("trailer.gz", self._gzip(DATA)[:-4]), "gzip")
+
+    def test_gzip_truncated_in_data(self):
+        compressed = self._gzip(DATA)
+
+        self._assert_corrupt(self._write("data.gz", compressed[:len(compressed) // 2]), "gzip")
+
+    def test_concatenated_bzip2(self):
+        path = self._write("concatenated.bz2", bz2.compress(DATA) + bz2.compress(DATA))
+
+        assert self._read(path, "bzip2") == DATA + DATA
+
+    def test_bzip2_truncated(self):
+        compressed = bz2.compress(DATA)
+
+        self._assert_corrupt(self._write("truncated.bz2", compressed[:-10]), "bzip2")
+
+    def test_bzip2_truncated_in_second_stream(self):
+        compressed = bz2.compress(DATA)
+
+        self._assert_corrupt(self._write("second.bz2", compressed + compressed[:100]), "bzip2")
+
+    def test_zstd_truncated(self):
+        # only checked where the zstandard module is installed
+        if compression_utils.zstandard is None:
+            return
+
+        compressed = compression_utils.zstandard.ZstdCompressor(write_checksum=True).compress(DATA)
+
+        assert self._read(self._write("complete.zst", compressed + compressed), "zstd") == DATA + DATA
+
+        self._assert_corrupt(self._write("truncated.zst", compressed + compressed[:-5]), "zstd")
+
+    def test_zstd_frames_complete(self):
+        if compression_utils.zstandard is None:
+            return
+
+        compressed = compression_utils.zstandard.ZstdCompressor().compress(DATA)
+
+        assert compression_utils.zstd_frames_complete(self._write("a.zst", compressed))
+        assert not compression_utils.zstd_frames_complete(self._write("b.zst", compressed[:-1]))
+        assert not compression_utils.zstd_frames_complete(self._write("c.zst", compressed + "\x00"))
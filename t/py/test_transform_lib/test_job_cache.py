@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+'''
+Unit tests for reusing job results in biokbase.Transform.job_cache, with the
+workspace client replaced by an in memory fake.
+
+These need no KBase services and can be run with nosetests or py.test.
+'''
+import os
+import sys
+
+FILE_LOC = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(FILE_LOC, '../../../lib'))
+
+import biokbase.workspace.client
+from biokbase.Transform import job_cache
+
+
+class FakeWorkspace(object):
+    '''
+    Objects are kept by (workspace name, object name) as a list of versions.
+    '''
+
+    objects = dict()
+    copies = list()
+
+    def __init__(self, url=None, token=None):
+        pass
+
+    @classmethod
+    def save(cls, workspace_name, object_name):
+        versions = cls.objects.setdefault((workspace_name, object_name), list())
+        versions.append(len(versions) + 1)
+        return cls.info(workspace_name, object_name)
+
+    @classmethod
+    def info(cls, workspace_name, object_name, version=None):
+        names = sorted(set([x[0] for x in cls.objects]))
+        keys = sorted(cls.objects)
+        return [keys.index((workspace_name, object_name)) + 1, object_name, "Type", "",
+                version or cls.objects[(workspace_name, object_name)][-1],
+                "user", names.index(workspace_name) + 1, workspace_name, "", 10, {}]
+
+    def get_object_info_new(self, params):
+        result = list()
+        for x in params["objects"]:
+            key = (x["workspace"], x["name"])
+            if key in self.objects and self.objects[key]:
+                result.append(self.info(*key))
+            elif params.get("ignoreErrors"):
+                result.append(None)
+            else:
+                raise Exception("No object {0}".format(key))
+        return result
+
+    def copy_object(self, params):
+        ref = params["from"]["ref"]
+        for key, versions in self.objects.items():
+            info = self.info(*key)
+            for v in versions:
+                if "{0}/{1}/{2}".format(info[6], info[0], v) == ref:
+                    self.copies.append((ref, params["to"]))
+                    return self.save(params["to"]["workspace"], params["to"]["name"])
+        raise Exception("No object {0}".format(ref))
+
+
+def _ref(info):
+    return "{0}/{1}/{2}".format(info[6], info[0], info[4])
+
+
+class TestCloneResults(object):
+
+    def setup(self):
+        self._workspace = biokbase.workspace.client.Workspace
+        biokbase.workspace.client.Workspace = FakeWorkspace
+        FakeWorkspace.objects = dict()
+        FakeWorkspace.copies = list()
+
+    def teardown(self):
+        biokbase.workspace.client.Workspace = self._workspace
+
+    def _results(self, ref, name="w/o"):
+        result = {"server_type": "Workspace", "url": "ws", "id": name, "description": ""}
+
+        if ref is not None:
+            result["ref"] = ref
+
+        return {"workspaceids": [], "results": [result]}
+
+    def test_same_destination_is_not_copied(self):
+        ref = _ref(FakeWorkspace.save("w", "o"))
+        args = {"workspace_name": "w", "object_name": "o"}
+
+        results = job_cache.clone_results("upload", args, self._results(ref), True, {"workspace_service_url": "ws"})
+
+        assert results["results"][0]["ref"] == ref
+        assert results["results"][0]["id"] == "w/o"
+        assert FakeWorkspace.copies == []
+
+    def test_new_destination_gets_the_version_made(self):
+        ref = _ref(FakeWorkspace.save("w", "o"))
+        FakeWorkspace.save("w", "o")
+        args = {"workspace_name": "w2", "object_name": "copy"}
+
+        results = job_cache.clone_results("upload", args, self._results(ref), False, {"workspace_service_url": "ws"})
+
+        assert FakeWorkspace.copies[0][0] == ref
+        assert results["results"][0]["ref"] == _ref(FakeWorkspace.info("w2", "copy"))
+        assert results["results"][0]["id"] == "w2/copy"
+        assert results["workspaceids"] == []
+
+    def test_overwritten_destination_is_restored(self):
+        ref = _ref(FakeWorkspace.save("w", "o"))
+        FakeWorkspace.save("w", "o")
+        args = {"destination_workspace_name": "w", "destination_object_name": "o"}
+
+        results = job_cache.clone_results("convert", args, self._results(ref), True, {"workspace_service_url": "ws"})
+
+        assert FakeWorkspace.copies[0][0] == ref
+        assert results["results"][0]["ref"].endswith("/3")
+
+    def test_deleted_result_is_a_miss(self):
+        ref = _ref(FakeWorkspace.save("w", "o"))
+        FakeWorkspace.objects[("w", "o")] = list()
+        args = {"workspace_name": "w", "object_name": "o"}
+
+        try:
+            job_cache.clone_results("upload", args, self._results(ref), True, {"workspace_service_url": "ws"})
+        except Exception:
+            pass
+        else:
+            raise AssertionError("A deleted result was reused")
+
+    def test_unversioned_result_is_a_miss(self):
+        FakeWorkspace.save("w", "o")
+        args = {"workspace_name": "w", "object_name": "o"}
+
+        try:
+            job_cache.clone_results("upload", args, self._results(None), True, {"workspace_service_url": "ws"})
+        except Exception, e:
+            assert "versioned" in str(e)
+        else:
+            raise AssertionError("An unversioned result was reused")
+
+
+class TestCacheable(object):
+
+    def test_taskrunner_saved_upload(self):
+        assert job_cache.cacheable("upload", {"validate": {"handler_options": {}},
+                                              "transform": {"handler_options": {"must_own_saving_to_workspace": False}}})
+
+    def test_plugin_saved_upload(self):
+        assert not job_cache.cacheable("upload", {"transform": {"handler_options": {"must_own_saving_to_workspace": True}}})
+
+    def test_convert_chain(self):
+        assert not job_cache.cacheable("upload", {"transform": {"handler_options": {}},
+                                                  "convert_chain": [{"handler_options": {}}]})
+        assert not job_cache.cacheable("convert", {"transform": {"handler_options": {}}})
+        assert not job_cache.cacheable("convert", {"transform": {"handler_options": {"job_cache": True}}})
+
+    def test_turned_off(self):
+        assert not job_cache.cacheable("upload", {"transform": {"handler_options": {"job_cache": False}}})
+
+    def test_download(self):
+        assert job_cache.cacheable("download", {"transform": {"handler_options": {}},
+                                                "convert_chain": [{"handler_options": {}}]})
+        assert not job_cache.cacheable("download", {"transform": {"handler_options": {"job_cache": False}}})
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+'''
+Unit tests for planning chains of plugins in biokbase.Transform.handler_utils.
+
+These need no KBase services and can be run with nosetests or py.test.
+'''
+import os
+import sys
+import shutil
+import tempfile
+
+import simplejson
+
+FILE_LOC = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(FILE_LOC, '../../../lib'))
+
+from biokbase.Transform import handler_utils
+
+
+def upload(name, external_type, kbase_type):
+    return {"script_name": name, "script_type": "upload",
+            "external_type": external_type, "kbase_type": kbase_type}
+
+
+def convert(name, source_kbase_type, destination_kbase_type):
+    return {"script_name": name, "script_type": "convert",
+            "source_kbase_type": source_kbase_type, "destination_kbase_type": destination_kbase_type}
+
+
+def download(name, kbase_type, external_type):
+    return {"script_name": name, "script_type": "download",
+            "kbase_type": kbase_type, "external_type": external_type}
+
+
+class TestPlan(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.configs = os.path.join(self.directory, "configs")
+        os.mkdir(self.configs)
+
+    def teardown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _plugins(self, configs, metrics_file=None):
+        for pconfig in configs:
+            with open(os.path.join(self.configs, pconfig["script_name"] + ".json"), 'w') as f:
+                simplejson.dump(pconfig, f)
+
+        return handler_utils.PlugIns(self.configs, index_directory=os.path.join(self.directory, "index"),
+                                     metrics_file=metrics_file)
+
+    def _names(self, path):
+        return [x["script_name"] for x in path]
+
+    def test_direct_upload_beats_measured_chain(self):
+        plugins = self._plugins([upload("direct", "Ext", "KB.B"),
+                                 upload("first", "Ext", "KB.A"),
+                                 convert("second", "KB.A", "KB.B")])
+
+        costs = {"direct": {"seconds": 5000.0, "bytes_per_second": None},
+                 "first": {"seconds": 1.0, "bytes_per_second": None},
+                 "second": {"seconds": 1.0, "bytes_per_second": None}}
+
+        assert self._names(plugins.plan("upload", "Ext", "KB.B", 10, costs)) == ["direct"]
+
+    def test_direct_download_beats_unmeasured_chain(self):
+        plugins = self._plugins([download("direct", "KB.B", "Ext"),
+                                 convert("first", "KB.B", "KB.A"),
+                                 download("second", "KB.A", "Ext")])
+
+        assert self._names(plugins.plan("download", "KB.B", "Ext", None, dict())) == ["direct"]
+
+    def test_input_size_is_not_looked_up_for_direct_plugin(self):
+        plugins = self._plugins([convert("direct", "KB.A", "KB.B")])
+
+        def size():
+            raise AssertionError("input size looked up")
+
+        details = plugins.get_job_details("convert", {"source_kbase_type": "KB.A",
+                                                      "destination_kbase_type": "KB.B"}, size)
+
+        assert details["transform"]["script_name"] == "direct"
+        assert "convert_chain" not in details
+
+    def test_chain_depends_on_input_size(self):
+        plugins = self._plugins([upload("fast", "Ext", "KB.A"),
+                                 convert("fast_convert", "KB.A", "KB.C"),
+                                 upload("steady", "Ext", "KB.B"),
+                                 convert("steady_convert", "KB.B", "KB.C")])
+
+        costs = {"fast": {"seconds": 10.0, "bytes_per_second": 1.0e4},
+                 "steady": {"seconds": 100.0, "bytes_per_second": None}}
+
+        assert self._names(plugins.plan("upload", "Ext", "KB.C", 1000, costs)) == ["fast", "fast_convert"]
+        assert self._names(plugins.plan("upload", "Ext", "KB.C", 10 ** 7, costs)) == ["steady", "steady_convert"]
+        assert self._names(plugins.plan("upload", "Ext", "KB.C", lambda: 10 ** 7, costs)) == \
+            ["steady", "steady_convert"]
+
+    def test_costs_are_read_from_metrics_file(self):
+        metrics_file = os.path.join(self.directory, "metrics.json")
+
+        with open(metrics_file, 'w') as f:
+            for plugin, seconds in [("slow", 500.0), ("quick", 5.0)]:
+                f.write(simplejson.dumps({"status": "completed",
+                                          "details": {"plugin": plugin, "input_bytes": None},
+                                          "phases": {"transform": {"wall_time": seconds}}}) + "\n")
+
+        plugins = self._plugins([upload("slow", "Ext", "KB.A"),
+                                 convert("slow_convert", "KB.A", "KB.C"),
+                                 upload("quick", "Ext", "KB.B"),
+                                 convert("quick_convert", "KB.B", "KB.C")], metrics_file)
+
+        details = plugins.get_job_details("upload", {"external_type": "Ext", "kbase_type": "KB.C"})
+
+        assert details["transform"]["script_name"] == "quick"
+        assert self._names(details["convert_chain"]) == ["quick_convert"]
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+'''
+Unit tests for the scratch space ledger in biokbase.Transform.scratch.
+
+These need no KBase services and can be run with nosetests or py.test.
+'''
+import os
+import sys
+import fcntl
+import shutil
+import tempfile
+
+FILE_LOC = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(FILE_LOC, '../../../lib'))
+
+from biokbase.Transform import scratch
+
+
+class TestScratch(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.manager = scratch.ScratchManager(ledger_path=os.path.join(self.directory, "ledger.json"),
+                                              tmpfs_directory=None)
+
+    def teardown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write(self, path, size):
+        with open(path, 'wb') as f:
+            f.write("x" * size)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _free(self):
+        fs = os.statvfs(self.directory)
+        return fs.f_bavail * fs.f_frsize
+
+    def test_available_counts_only_unwritten_reservations(self):
+        other = os.path.join(self.directory, "other")
+        os.mkdir(other)
+        self._write(os.path.join(other, "data"), 2**20)
+
+        with self.manager._ledger() as ledger:
+            ledger["reservations"][other] = {"pid": os.getpid(),
+                                             "device": os.stat(other).st_dev,
+                                             "bytes": 4 * 2**20}
+
+        self.manager._measure()
+
+        with self.manager._ledger() as ledger:
+            unwritten = 4 * 2**20 - scratch.disk_usage(other)
+            available = self.manager._available(ledger, self.directory, None)
+
+        assert 0 < unwritten <= 3 * 2**20
+        # free space can move a little while the test runs
+        assert abs(self._free() - unwritten - available) < 2**20
+
+    def test_available_ignores_reservations_already_written(self):
+        other = os.path.join(self.directory, "other")
+        os.mkdir(other)
+        self._write(os.path.join(other, "data"), 2**20)
+
+        with self.manager._ledger() as ledger:
+            ledger["reservations"][other] = {"pid": os.getpid(),
+                                             "device": os.stat(other).st_dev,
+                                             "bytes": 1024}
+
+        self.manager._measure()
+
+        with self.manager._ledger() as ledger:
+            available = self.manager._available(ledger, self.directory, None)
+
+        assert abs(self._free() - available) < 2**20
+
+    def test_usage_is_measured_outside_the_ledger_lock_and_reused(self):
+        other = os.path.join(self.directory, "other")
+        os.mkdir(other)
+        self._write(os.path.join(other, "data"), 2**20)
+
+        with self.manager._ledger() as ledger:
+            ledger["reservations"][other] = {"pid": os.getpid(),
+                                             "device": os.stat(other).st_dev,
+                                             "bytes": 4 * 2**20}
+
+        walks = list()
+        disk_usage = scratch.disk_usage
+
+        def measured(path):
+            # the ledger must not be locked while a directory is walked
+            fd = os.open(self.manager.ledger_path, os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            finally:
+                os.close(fd)
+
+            walks.append(path)
+            return disk_usage(path)
+
+        scratch.disk_usage = measured
+        try:
+            self.manager.reserve(os.path.join(self.directory, "job"), 0, allow_tmpfs=False)
+            self.manager.reserve(os.path.join(self.directory, "job"), 0, allow_tmpfs=False)
+        finally:
+            scratch.disk_usage = disk_usage
+
+        assert walks == [other]
+
+        with self.manager._ledger() as ledger:
+            assert ledger["reservations"][other]["written"] == disk_usage(other)
+
+    def test_empty_reservation_is_never_refused(self):
+        with self.manager._ledger() as ledger:
+            ledger["reservations"]["/nonexistent"] = {"pid": os.getpid(),
+                                                      "device": os.stat(self.directory).st_dev,
+                                                      "bytes": 2**62}
+
+        job = os.path.join(self.directory, "job")
+        self.manager.reserve(job, 0, allow_tmpfs=False)
+
+        assert os.path.isdir(job)
+
+        try:
+            self.manager.reserve(job, 1, allow_tmpfs=False)
+        except Exception, e:
+            assert "Not enough scratch space" in str(e)
+        else:
+            raise AssertionError("A reservation larger than the free space was accepted")
+
+    def test_purge_skips_foreign_paths(self):
+        victim = os.path.join(self.directory, "victim")
+        os.mkdir(victim)
+        self._write(os.path.join(victim, "keep"), 10)
+
+        job = os.path.join(self.directory, "job")
+        self.manager.reserve(job, 0, allow_tmpfs=False)
+        self._write(os.path.join(job, "data"), 10)
+        self.manager.release(job)
+
+        with self.manager._ledger() as ledger:
+            ledger["trash"].append(victim)
+
+        self.manager.purge()
+
+        assert os.path.exists(os.path.join(victim, "keep"))
+        assert os.listdir(os.path.join(self.directory, scratch.TRASH_DIRECTORY)) == []
+
+    def test_ledger_writable_by_others_is_refused(self):
+        with self.manager._ledger() as ledger:
+            pass
+
+        os.chmod(self.manager.ledger_path, 0666)
+
+        try:
+            with self.manager._ledger() as ledger:
+                pass
+        except Exception, e:
+            assert "other users" in str(e)
+        else:
+            raise AssertionError("A world writable ledger was used")
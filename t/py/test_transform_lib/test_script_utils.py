@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+Unit tests for unpacking input files with biokbase.Transform.script_utils.
+
+These need no KBase services and can be run with nosetests or py.test.
+'''
+import os
+import io
+import sys
+import gzip
+import shutil
+import tarfile
+import tempfile
+
+FILE_LOC = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(FILE_LOC, '../../../lib'))
+
+from biokbase.Transform import script_utils
+
+
+class TestExtractData(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _members(self):
+        # the large member is read across several decompressed chunks and copy calls
+        return {"reads.fastq": os.urandom(3 * 2**20 + 17),
+                "small.txt": "a small member\n",
+                "empty.txt": ""}
+
+    def _tar(self, path, members, mode):
+        source = os.path.join(self.directory, "source")
+        os.mkdir(source)
+
+        with tarfile.open(path, mode) as f:
+            for name in sorted(members):
+                with io.open(os.path.join(source, name), 'wb') as member:
+                    member.write(members[name])
+
+                f.add(os.path.join(source, name), arcname="data/" + name)
+
+        shutil.rmtree(source)
+
+    def _assert_extracted(self, members):
+        assert sorted(os.listdir(self.directory)) == sorted(members)
+
+        for name in members:
+            with io.open(os.path.join(self.directory, name), 'rb') as f:
+                assert f.read() == members[name], name
+
+    def test_tar_round_trip(self):
+        members = self._members()
+        path = os.path.join(self.directory, "data.tar")
+        self._tar(path, members, 'w')
+
+        script_utils.extract_data(filePath=path, chunkSize=4096)
+
+        self._assert_extracted(members)
+
+    def test_tar_gz_round_trip(self):
+        members = self._members()
+        path = os.path.join(self.directory, "data.tar.gz")
+        self._tar(path, members, 'w:gz')
+
+        script_utils.extract_data(filePath=path, chunkSize=4096)
+
+        self._assert_extracted(members)
+
+    def test_gz_round_trip(self):
+        data = self._members()["reads.fastq"]
+        path = os.path.join(self.directory, "reads.fastq.gz")
+
+        f = gzip.open(path, 'wb')
+        f.write(data)
+        f.close()
+
+        script_utils.extract_data(filePath=path, chunkSize=4096)
+
+        self._assert_extracted({"reads.fastq": data})
+
+    def test_prefixed_stream(self):
+        stream = script_utils._PrefixedStream("abc", io.BytesIO("defgh"))
+
+        assert stream.read(2) == "ab"
+        assert stream.read(3) == "cde"
+        assert stream.read() == "fgh"
+        assert stream.read(1) == ""
+
+    def test_spreadsheet_is_not_unpacked(self):
+        path = os.path.join(self.directory, "media_example.xlsx")
+        shutil.copy(os.path.join(FILE_LOC, '../../media_example.xlsx'), path)
+
+        with open(path, 'rb') as f:
+            contents = f.read()
+
+        script_utils.extract_data(filePath=path)
+
+        assert os.listdir(self.directory) == ["media_example.xlsx"]
+
+        with open(path, 'rb') as f:
+            assert f.read() == contents
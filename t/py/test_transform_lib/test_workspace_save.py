@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+'''
+Unit tests for batching objects in biokbase.Transform.workspace_save.
+
+These need no KBase services and can be run with nosetests or py.test.
+'''
+import os
+import sys
+
+FILE_LOC = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(FILE_LOC, '../../../lib'))
+
+from biokbase.Transform import workspace_save
+
+
+def named(name, size=10, **fields):
+    fields.update({"name": name, "data": "x" * size})
+    return fields
+
+
+class TestBatchObjects(object):
+
+    def _names(self, batches):
+        return [[x.get("name", x.get("objid")) for x in batch] for batch in batches]
+
+    def test_distinct_names_share_a_batch(self):
+        batches = workspace_save.batch_objects([named("a"), named("b"), named("c")])
+
+        assert self._names(batches) == [["a", "b", "c"]]
+
+    def test_repeated_name_starts_a_new_batch(self):
+        batches = workspace_save.batch_objects([named("a"), named("b"), named("a"), named("c"), named("a")])
+
+        assert self._names(batches) == [["a", "b"], ["a", "c"], ["a"]]
+
+    def test_repeated_objid_starts_a_new_batch(self):
+        objects = [{"objid": 7, "data": 1}, {"objid": 8, "data": 1}, {"objid": 7, "data": 1}]
+
+        assert self._names(workspace_save.batch_objects(objects)) == [[7, 8], [7]]
+
+    def test_batches_are_bounded_by_size(self):
+        batches = workspace_save.batch_objects([named("a", 40), named("b", 40), named("c", 100), named("d", 10)],
+                                               max_batch_size=100)
+
+        assert self._names(batches) == [["a", "b"], ["c"], ["d"]]